@@ -2,13 +2,17 @@ from django.contrib import admin
 from django.utils.safestring import mark_safe
 from unfold.admin import ModelAdmin as UnfoldModelAdmin
 
+from .search import search_products
+
 from .models import (
     Category,
     Subcategory,
     Product,
     ProductImage,
     Promotion,
+    PriceRule,
     UsedPromotion,
+    PromotionRedemption,
     Subscriber,
     Cart,
     CartItem,
@@ -18,13 +22,13 @@ from .models import (
 
 @admin.register(Category)
 class CategoryAdmin(UnfoldModelAdmin):
-    list_display = ("name", "slug", "is_active", "order")
+    list_display = ("name", "slug", "is_active", "order", "products_count")
     list_filter = ("is_active",)
     search_fields = ("name",)
     ordering = ("order", "name")
     
     def get_list_display(self, request):
-        return ("name", "slug", "is_active", "order")
+        return ("name", "slug", "is_active", "order", "products_count")
     
     def get_list_filter(self, request):
         return ("is_active",)
@@ -35,7 +39,7 @@ class CategoryAdmin(UnfoldModelAdmin):
 
 @admin.register(Subcategory)
 class SubcategoryAdmin(UnfoldModelAdmin):
-    list_display = ("name", "category", "slug", "is_active", "order")
+    list_display = ("name", "category", "slug", "is_active", "order", "products_count")
     list_filter = ("category", "is_active")
     search_fields = ("name", "category__name")
     ordering = ("category__order", "category__name", "order", "name")
@@ -48,6 +52,14 @@ class ProductImageInline(admin.TabularInline):
     fields = ('image', 'is_main', 'order')
 
 
+class PriceRuleInline(admin.TabularInline):
+    """Inline para las reglas de precio (descuentos) del producto"""
+    model = PriceRule
+    extra = 0
+    fields = ('promotion', 'percentage', 'is_active')
+    autocomplete_fields = ('promotion',)
+
+
 
 
 
@@ -56,10 +68,15 @@ class ProductAdmin(UnfoldModelAdmin):
     list_display = ("name", "price", "stock", "category", "subcategory", "is_active", "is_featured", "stock_status", "list_images")
     list_filter = ("category", "subcategory", "is_active", "is_featured", "created_at")
     search_fields = ("name", "description", "sku")
-    readonly_fields = ("created_at", "updated_at", "stock_status", "list_images")
+    readonly_fields = ("created_at", "updated_at", "reserved", "stock_status", "list_images")
     ordering = ("-created_at",)
-    inlines = [ProductImageInline]
+    inlines = [ProductImageInline, PriceRuleInline]
 
+    def get_search_results(self, request, queryset, search_term):
+        """Usa el mismo índice full-text/trigram que la API"""
+        if not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        return search_products(queryset, search_term), False
     
     def list_images(self, obj):
         """Muestra las imágenes del producto en la lista del admin"""
@@ -104,6 +121,22 @@ class PromotionAdmin(UnfoldModelAdmin):
     search_fields = ("name",)
 
 
+@admin.register(PromotionRedemption)
+class PromotionRedemptionAdmin(UnfoldModelAdmin):
+    """Auditoría de canjes: solo lectura"""
+    list_display = ("promotion", "subscriber", "session_id", "outcome", "discount_amount", "created_at")
+    list_filter = ("outcome", "promotion")
+    search_fields = ("subscriber__phone", "session_id", "idempotency_key")
+    list_select_related = ("promotion", "subscriber")
+    ordering = ("-created_at",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 
 
 
@@ -115,14 +148,20 @@ class CartAdmin(UnfoldModelAdmin):
     readonly_fields = ("created_at", "get_total", "get_items_count")
     ordering = ("-created_at",)
     
+    def get_queryset(self, request):
+        # Total e items anotados en la consulta del listado (sin consultas por fila)
+        return super().get_queryset(request).with_totals().select_related("subscriber")
+    
     def get_total(self, obj):
         return obj.total()
     
     def get_items_count(self, obj):
-        return obj.items.count()
+        return obj.get_items_count()
     
     get_total.short_description = "Total"
+    get_total.admin_order_field = "total_amount"
     get_items_count.short_description = "Items"
+    get_items_count.admin_order_field = "items_count"
 
 
 @admin.register(Discount)
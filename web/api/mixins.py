@@ -0,0 +1,220 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.db import connection
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from web.cache import (
+    get_cached_response, get_catalog_modified, get_catalog_version, get_response_generation,
+    set_cached_response,
+)
+from web.models import CatalogChange, Category, Product, ProductPrice, Promotion, Subcategory
+
+
+class _ShortCircuit(Exception):
+    """Interrumpe la vista para responder directamente (304, respuesta cacheada...)"""
+
+    def __init__(self, response):
+        self.response = response
+
+
+# Modelos cuyo contenido aparece en las respuestas del catálogo (todos con índice en updated_at)
+VALIDATOR_MODELS = (Product, ProductPrice, Category, Subcategory, Promotion)
+
+
+def catalog_validators():
+    """
+    Retorna (version, last_modified) del catálogo: la versión en cache, que las señales
+    incrementan con cada alta, cambio o baja, más Max(updated_at) de VALIDATOR_MODELS
+    y el último registro de CatalogChange, que incluye las bajas (tombstones). Cada
+    máximo se resuelve con un índice, así que la consulta no crece con el catálogo.
+    """
+    subqueries = [f'(SELECT MAX(updated_at) FROM {model._meta.db_table})' for model in VALIDATOR_MODELS]
+    subqueries.append(f'(SELECT MAX(id) FROM {CatalogChange._meta.db_table})')
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {", ".join(subqueries)}')
+        *updated, last_change = cursor.fetchone()
+    last_modified = max(filter(None, [get_catalog_modified(), *updated]))
+    version = ':'.join(str(value) for value in [get_catalog_version(), last_change, *updated])
+    return version, last_modified
+
+
+class ShortCircuitMixin:
+    """Permite que initial() responda sin ejecutar la vista"""
+
+    def handle_exception(self, exc):
+        if isinstance(exc, _ShortCircuit):
+            return exc.response
+        return super().handle_exception(exc)
+
+
+class ConditionalGetMixin(ShortCircuitMixin):
+    """
+    Soporte de GET condicional (ETag / Last-Modified) para vistas del catálogo.
+    Si el cliente ya tiene la versión actual se responde 304 antes de ejecutar la
+    vista, sin consultas de datos ni serialización. Las acciones de uncached_actions,
+    cuya respuesta no depende solo de la versión del catálogo, quedan excluidas.
+    """
+    uncached_actions = ()
+
+    def cached_validators(self, request):
+        """Validadores ya conocidos sin consultar el catálogo (ver ResponseCacheMixin)"""
+        return None
+
+    def get_conditional_validators(self, request):
+        version, last_modified = catalog_validators()
+        # Incluye la URL (con esquema y host, que aparecen en las URLs absolutas) y el
+        # formato negociado: cada representación tiene su ETag
+        raw = f'{version}|{request.build_absolute_uri()}|{request.accepted_media_type}'
+        etag = quote_etag(hashlib.md5(raw.encode('utf-8')).hexdigest())
+        return etag, int(last_modified.timestamp())
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.conditional_validators = None
+        if request.method in ('GET', 'HEAD') and getattr(self, 'action', None) not in self.uncached_actions:
+            etag, last_modified = self.cached_validators(request) or self.get_conditional_validators(request)
+            self.conditional_validators = (etag, last_modified)
+            response = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+            if response is not None:
+                raise _ShortCircuit(response)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        validators = getattr(self, 'conditional_validators', None)
+        if validators and response.status_code in (200, 304):
+            etag, last_modified = validators
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+def instance_tags(instance):
+    """Etiquetas de cache de una instancia y de las relaciones que se anidan en su representación"""
+    tags = {f'{instance._meta.model_name}:{instance.pk}'}
+    for relation in ('category', 'subcategory'):
+        related_id = getattr(instance, f'{relation}_id', None)
+        if related_id is not None:
+            tags.add(f'{relation}:{related_id}')
+    return tags
+
+
+def row_tags(row, model_name):
+    """Como instance_tags, para filas de values() con id y los ids de sus relaciones"""
+    tags = {f'{model_name}:{row["id"]}'}
+    for relation in ('category', 'subcategory'):
+        related_id = row.get(f'{relation}_id')
+        if related_id is not None:
+            tags.add(f'{relation}:{related_id}')
+    return tags
+
+
+class ResponseCacheMixin(ShortCircuitMixin):
+    """
+    Cache completa de respuestas GET anónimas, por ruta y parámetros normalizados.
+
+    Cada respuesta se etiqueta con los objetos serializados (ver instance_tags) y,
+    en los listados, con list_cache_tag. Las señales de los modelos invalidan esas
+    etiquetas, así que una entrada se descarta solo cuando cambia algo que contiene.
+    La entrada guarda también el ETag y Last-Modified de ConditionalGetMixin, así un
+    HIT (o su 304) no consulta la base de datos. Las acciones de uncached_actions no
+    se cachean.
+    """
+    list_cache_tag = None
+    uncached_actions = ()
+
+    def response_cache_key(self, request):
+        params = sorted(
+            (key, value) for key, values in request.query_params.lists() for value in values if value != ''
+        )
+        # Esquema y host: las respuestas incluyen URLs absolutas (imágenes, next/previous)
+        raw = f'{request.scheme}://{request.get_host()}{request.path}?{urlencode(params)}|{request.accepted_media_type}'
+        return 'response:' + hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+    def add_cache_tags(self, *tags):
+        if getattr(self, 'cache_tags', None) is not None:
+            self.cache_tags.update(tags)
+
+    def tag_instances(self, instances):
+        """Etiqueta la respuesta con las instancias (que quedan evaluadas) y las retorna"""
+        if getattr(self, 'cache_tags', None) is not None:
+            for instance in instances:
+                self.cache_tags.update(instance_tags(instance))
+        return instances
+
+    def tag_rows(self, rows, model):
+        """Como tag_instances, para filas de values() (ver row_tags)"""
+        if getattr(self, 'cache_tags', None) is not None:
+            for row in rows:
+                self.cache_tags.update(row_tags(row, model._meta.model_name))
+        return rows
+
+    def get_serializer(self, *args, **kwargs):
+        if args:
+            instance = args[0]
+            self.tag_instances(instance if kwargs.get('many') else [instance])
+        return super().get_serializer(*args, **kwargs)
+
+    def cached_entry(self, request):
+        """
+        Entrada cacheada de la petición (None si no hay o la petición no se cachea).
+        Se busca una sola vez, antes de calcular los validadores del catálogo.
+        """
+        if hasattr(self, '_cached_entry'):
+            return self._cached_entry
+        self._cached_entry = None
+        action = getattr(self, 'action', None)
+        if request.method != 'GET' or request.user.is_authenticated or action in self.uncached_actions:
+            return None
+
+        self.response_cache_key_value = self.response_cache_key(request)
+        self._cached_entry = get_cached_response(self.response_cache_key_value)
+        if self._cached_entry is None:
+            # Antes de leer validadores y datos: una invalidación posterior impide guardar la entrada
+            self.response_cache_generation = get_response_generation()
+        return self._cached_entry
+
+    def cached_validators(self, request):
+        # Un HIT responde con los validadores guardados, sin la consulta de catalog_validators
+        entry = self.cached_entry(request)
+        return entry.get('validators') if entry is not None else super().cached_validators(request)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.cache_tags = None
+        entry = self.cached_entry(request)
+        if entry is not None:
+            response = HttpResponse(entry['content'], content_type=entry['content_type'], status=entry['status'])
+            response['X-Cache'] = 'HIT'
+            raise _ShortCircuit(response)
+        if not hasattr(self, 'response_cache_generation'):
+            return
+
+        self.cache_tags = {'catalog'}
+        if not self.detail and self.list_cache_tag:
+            self.cache_tags.add(self.list_cache_tag)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        tags = getattr(self, 'cache_tags', None)
+        if tags is None or response.status_code != 200 or not hasattr(response, 'add_post_render_callback'):
+            return response
+
+        key = self.response_cache_key_value
+        generation = self.response_cache_generation
+        validators = getattr(self, 'conditional_validators', None)
+
+        def store(rendered):
+            entry = {
+                'content': rendered.content,
+                'content_type': rendered['Content-Type'],
+                'status': rendered.status_code,
+                'validators': validators,
+            }
+            set_cached_response(key, entry, tags, generation)
+
+        response.add_post_render_callback(store)
+        response['X-Cache'] = 'MISS'
+        return response
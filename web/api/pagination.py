@@ -0,0 +1,138 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginación por cursor (keyset) sobre el primer campo de ordenamiento del
+    queryset más el id como desempate estable.
+
+    Cada página filtra las filas posteriores a (último valor, último id) en lugar de
+    usar OFFSET: campo >= valor AND (campo > valor OR (campo = valor AND id > último
+    id)). La cota campo >= valor es redundante pero permite que el planificador
+    recorra el índice del campo desde ese valor, así el costo no crece al avanzar. Con ?count=false se omite el
+    COUNT(*) de la respuesta. Los clientes que aún envían ?page=N siguen usando la
+    paginación por número de página.
+    """
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+
+        self.fallback = None
+        if PageNumberPagination.page_query_param in request.query_params:
+            self.fallback = PageNumberPagination()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)[:1] or ['pk']
+        self.field = ordering[0].lstrip('-')
+        self.descending = ordering[0].startswith('-')
+        self.value_field = self.ordering_field(queryset)
+        tiebreaker = '-pk' if self.descending else 'pk'
+        queryset = queryset.order_by(ordering[0], tiebreaker)
+
+        self.with_count = request.query_params.get(self.count_query_param, 'true').lower() != 'false'
+        self.count = queryset.count() if self.with_count else None
+
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor['r'])
+        if cursor:
+            queryset = queryset.filter(self.keyset_filter(cursor['v'], cursor['pk'], reverse))
+        if reverse:
+            queryset = queryset.reverse()
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.has_next = has_more if not reverse else True
+        self.has_previous = bool(cursor) if not reverse else has_more
+        self.results = results
+        return results
+
+    def keyset_filter(self, value, pk, reverse=False):
+        """Filtro que deja solo las filas posteriores (o anteriores) a (value, pk)"""
+        after = self.descending == reverse
+        op = 'gt' if after else 'lt'
+        # La cota inclusiva es la que se usa como límite del recorrido del índice
+        bound = Q(**{f'{self.field}__{op}e': value})
+        return bound & (Q(**{f'{self.field}__{op}': value}) | Q(**{self.field: value, f'pk__{op}': pk}))
+
+    def ordering_field(self, queryset):
+        """Campo (del modelo o de una anotación como search_rank) por el que se pagina"""
+        if self.field == 'pk':
+            return queryset.model._meta.pk
+        if self.field in queryset.query.annotations:
+            return queryset.query.annotations[self.field].output_field
+        return queryset.model._meta.get_field(self.field)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            # El valor llega como texto: se convierte al tipo del campo para que un cursor
+            # manipulado falle aquí y no al compilar la consulta
+            value = self.value_field.to_python(cursor['v'])
+            if value is None:
+                raise ValueError('Cursor without value')
+            return {'v': value, 'pk': int(cursor['pk']), 'r': bool(cursor.get('r'))}
+        except (TypeError, ValueError, KeyError, UnicodeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, instance, reverse=False):
+        if isinstance(instance, dict):
+            # Filas de values() (ruta rápida de los listados)
+            value = instance['id' if self.field == 'pk' else self.field]
+            pk = instance['id']
+        else:
+            value = getattr(instance, self.field)
+            pk = instance.pk
+        token = {'v': str(value), 'pk': pk}
+        if reverse:
+            token['r'] = 1
+        encoded = urlsafe_b64encode(json.dumps(token).encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.fallback is not None:
+            return self.fallback.get_next_link()
+        if not self.has_next or not self.results:
+            return None
+        return self.encode_cursor(self.results[-1])
+
+    def get_previous_link(self):
+        if self.fallback is not None:
+            return self.fallback.get_previous_link()
+        if not self.has_previous:
+            return None
+        if not self.results:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.results[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        response = OrderedDict()
+        if self.with_count:
+            response['count'] = self.count
+        response['next'] = self.get_next_link()
+        response['previous'] = self.get_previous_link()
+        response['results'] = data
+        return Response(response)
@@ -0,0 +1,172 @@
+"""
+Ruta rápida para los listados de productos.
+
+Construye las filas con values() (sin instanciar modelos ni recorrer los serializers
+anidados), las convierte a dicts con funciones preparadas una sola vez y las codifica
+directamente a JSON. Con esto se generan los documentos de web/documents.py que
+concatenan las vistas. La salida es idéntica byte a byte a la de ProductSerializer
+en modo compacto con JSONRenderer; ProductFastPathTests (web/tests.py) verifica esa
+equivalencia, así que cualquier cambio en ProductSerializer debe reflejarse aquí.
+"""
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.compat import LONG_SEPARATORS, SHORT_SEPARATORS
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.response import Response
+
+from web.models import Product, ProductImage, stock_status_label
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dependencia opcional
+    orjson = None
+
+
+# Columnas de Product y ProductImage que necesita la representación compacta
+PRODUCT_VALUES = (
+    'id', 'name', 'slug', 'description', 'price', 'stock', 'sku', 'category_id', 'category__slug',
+    'subcategory_id', 'subcategory__slug', 'is_active', 'is_featured', 'created_at', 'updated_at',
+    'pricing__price', 'pricing__has_promotion',
+)
+IMAGE_VALUES = ('id', 'product_id', 'image', 'is_main', 'order', 'created_at')
+
+# Parámetros que cambian la forma de la respuesta y por tanto requieren el serializer
+SERIALIZER_PARAMS = ('fields', 'expand')
+
+# Mismas opciones de codificación que JSONRenderer
+_json_encoder = json.JSONEncoder(
+    ensure_ascii=JSONRenderer.ensure_ascii,
+    allow_nan=not JSONRenderer.strict,
+    separators=SHORT_SEPARATORS if JSONRenderer.compact else LONG_SEPARATORS,
+)
+# orjson produce la misma salida que JSONRenderer solo con su configuración por defecto
+_use_orjson = orjson is not None and JSONRenderer.compact and not JSONRenderer.ensure_ascii and JSONRenderer.strict
+
+
+def render_json(data):
+    """Codifica data (solo tipos nativos de JSON) igual que JSONRenderer"""
+    if _use_orjson:
+        content = orjson.dumps(data)
+        return content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    content = _json_encoder.encode(data)
+    return content.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029').encode('utf-8')
+
+
+class PrerenderedJSONResponse(Response):
+    """
+    Response cuyo data ya es JSON codificado (bytes) o contiene solo tipos nativos y
+    se codifica con render_json. Sigue pasando por finalize_response, así que conserva
+    ETag y cache de respuestas.
+    """
+
+    @property
+    def rendered_content(self):
+        self['Content-Type'] = JSONRenderer.media_type
+        if isinstance(self.data, bytes):
+            return self.data
+        return render_json(self.data)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Permite negociar application/x-ndjson; la vista responde en streaming con el contenido ya generado"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+def can_render_fast(request):
+    """La ruta rápida solo aplica a JSON plano sin ?fields ni ?expand"""
+    if not settings.PRODUCT_FAST_RENDERING:
+        return False
+    if type(request.accepted_renderer) is not JSONRenderer or request.accepted_media_type != JSONRenderer.media_type:
+        return False
+    return not any(request.query_params.get(param) for param in SERIALIZER_PARAMS)
+
+
+def product_rows(queryset):
+    """Proyección values() del queryset (conserva filtros, orden y anotaciones como search_rank)"""
+    fields = PRODUCT_VALUES + tuple(queryset.query.annotations)
+    return queryset.prefetch_related(None).values(*fields)
+
+
+def product_converters(absolute_uri=None):
+    """
+    Funciones fila -> dict de productos e imágenes. Los campos de DRF se instancian
+    una sola vez para reutilizar exactamente su formato de decimales y fechas.
+    absolute_uri convierte las URLs de las imágenes (normalmente request.build_absolute_uri).
+    """
+    price_field = Product._meta.get_field('price')
+    to_price = serializers.DecimalField(
+        max_digits=price_field.max_digits, decimal_places=price_field.decimal_places
+    ).to_representation
+    to_datetime = serializers.DateTimeField().to_representation
+    storage_url = ProductImage._meta.get_field('image').storage.url
+
+    def image_url(name):
+        if not name:
+            return None
+        url = storage_url(name)
+        return absolute_uri(url) if absolute_uri is not None else url
+
+    def convert_image(row):
+        url = image_url(row['image'])
+        return {
+            'id': row['id'],
+            'image': url,
+            'image_url': url,
+            'is_main': row['is_main'],
+            'order': row['order'],
+            'created_at': to_datetime(row['created_at']),
+        }
+
+    def convert_product(row, images):
+        price = row['price']
+        current_price = row['pricing__price']
+        stock = row['stock']
+        main_image = next((image for image in images if image['is_main']), images[0] if images else None)
+        subcategory_id = row['subcategory_id']
+        return {
+            'id': row['id'],
+            'name': row['name'],
+            'slug': row['slug'],
+            'description': row['description'],
+            'price': to_price(price),
+            'stock': stock,
+            'sku': row['sku'],
+            'category': {'id': row['category_id'], 'slug': row['category__slug']},
+            'subcategory': (
+                {'id': subcategory_id, 'slug': row['subcategory__slug']} if subcategory_id is not None else None
+            ),
+            'is_active': row['is_active'],
+            'is_featured': row['is_featured'],
+            # ProductSerializer.get_current_price retorna el Decimal, que JSONRenderer codifica como float
+            'current_price': float(current_price if current_price is not None else price),
+            'has_promotion': bool(row['pricing__has_promotion']),
+            'is_in_stock': stock > 0,
+            'stock_status': stock_status_label(stock),
+            'images': images,
+            'main_image': main_image['image'] if main_image else None,
+            'created_at': to_datetime(row['created_at']),
+            'updated_at': to_datetime(row['updated_at']),
+        }
+
+    return convert_product, convert_image
+
+
+def render_product_rows(rows, absolute_uri=None):
+    """Convierte filas de product_rows a la representación compacta (una query para las imágenes)"""
+    rows = list(rows)
+    if not rows:
+        return []
+    convert_product, convert_image = product_converters(absolute_uri)
+    images = defaultdict(list)
+    image_rows = ProductImage.objects.filter(product_id__in=[row['id'] for row in rows]).values(*IMAGE_VALUES)
+    for image in image_rows:
+        images[image['product_id']].append(convert_image(image))
+    return [convert_product(row, images[row['id']]) for row in rows]
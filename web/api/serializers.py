@@ -1,57 +1,121 @@
 from rest_framework import serializers
 from web.models import (
     Category, Subcategory, Product, ProductImage, Promotion, UsedPromotion, 
-    Subscriber, Cart, CartItem, Discount
+    Subscriber, Cart, CartItem, Discount, MAX_BIGINT, MAX_QUANTITY
 )
+from django.conf import settings
 from django.utils import timezone
 
 
+def active_subcategories(category):
+    """Subcategorías activas de la categoría, usando el Prefetch de la vista si existe"""
+    if hasattr(category, 'active_subcategories'):
+        return category.active_subcategories
+    return category.subcategories.filter(is_active=True).order_by('order', 'name')
+
+
 class SubcategorySerializer(serializers.ModelSerializer):
-    products_count = serializers.SerializerMethodField()
-    
     class Meta:
         model = Subcategory
         fields = ['id', 'name', 'slug', 'category', 'is_active', 'order', 'products_count']
-    
-    def get_products_count(self, obj):
-        return obj.products.count()
 
 
 class CategorySerializer(serializers.ModelSerializer):
-    products_count = serializers.SerializerMethodField()
     subcategories = serializers.SerializerMethodField()
     
     class Meta:
         model = Category
         fields = ['id', 'name', 'slug', 'is_active', 'order', 'products_count', 'subcategories']
     
-    def get_products_count(self, obj):
-        return obj.products.count()
-    
     def get_subcategories(self, obj):
-        subcategories = obj.subcategories.filter(is_active=True).order_by('order', 'name')
-        return SubcategorySerializer(subcategories, many=True).data
+        return SubcategorySerializer(active_subcategories(obj), many=True).data
 
 
 class CategoryTreeSerializer(serializers.ModelSerializer):
     """Serializer para mostrar el árbol de categorías con subcategorías"""
     subcategories = serializers.SerializerMethodField()
-    products_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Category
         fields = ['id', 'name', 'slug', 'subcategories', 'products_count']
     
     def get_subcategories(self, obj):
-        subcategories = obj.subcategories.filter(is_active=True).order_by('order', 'name')
-        return SubcategorySerializer(subcategories, many=True).data
-    
-    def get_products_count(self, obj):
-        return obj.products.count()
+        return SubcategorySerializer(active_subcategories(obj), many=True).data
 
 
 
 
+class CategoryCompactSerializer(serializers.ModelSerializer):
+    """Representación mínima de una categoría para listados"""
+    class Meta:
+        model = Category
+        fields = ['id', 'slug']
+
+
+class SubcategoryCompactSerializer(serializers.ModelSerializer):
+    """Representación mínima de una subcategoría para listados"""
+    class Meta:
+        model = Subcategory
+        fields = ['id', 'slug']
+
+
+def _split_param(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [item.strip() for item in value if item.strip()]
+
+
+class SparseFieldsetMixin:
+    """
+    Soporta ?fields=id,name,product.price para limitar los campos de salida y
+    ?expand=category,product.category para anidar completas las relaciones
+    que en modo compacto (context['compact']) se representan solo con id y slug.
+    Los campos anidados se indican con su ruta separada por puntos.
+    """
+    # Campo -> serializer compacto usado cuando no se expande
+    compact_fields = {}
+
+    def _field_path(self):
+        parts = []
+        node = self
+        while node.parent is not None:
+            if node.field_name:
+                parts.append(node.field_name)
+            node = node.parent
+        return '.'.join(reversed(parts))
+
+    def _query_param(self, name):
+        if name in self.context:
+            return _split_param(self.context[name])
+        request = self.context.get('request')
+        if request is None:
+            return []
+        return _split_param(request.query_params.get(name))
+
+    def _names_for_path(self, values, path):
+        prefix = f'{path}.' if path else ''
+        return {value[len(prefix):].split('.')[0] for value in values if value.startswith(prefix)}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        path = self._field_path()
+
+        if self.context.get('compact'):
+            expand = self._names_for_path(self._query_param('expand'), path)
+            for name, compact_serializer in self.compact_fields.items():
+                if name in fields and name not in expand:
+                    fields[name] = compact_serializer(read_only=True)
+
+        only = self._names_for_path(self._query_param('fields'), path)
+        if only:
+            for name in list(fields):
+                if name not in only and not fields[name].write_only:
+                    fields.pop(name)
+        return fields
+
+
 class ProductImageSerializer(serializers.ModelSerializer):
     """Serializer para imágenes de productos"""
     image_url = serializers.SerializerMethodField()
@@ -69,7 +133,18 @@ class ProductImageSerializer(serializers.ModelSerializer):
         return None
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class CatalogImageSerializer(ProductImageSerializer):
+    """Imagen con su producto, para la sincronización incremental"""
+    class Meta(ProductImageSerializer.Meta):
+        fields = ProductImageSerializer.Meta.fields + ['product']
+
+
+class ProductSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    compact_fields = {
+        'category': CategoryCompactSerializer,
+        'subcategory': SubcategoryCompactSerializer,
+    }
+
     category = CategorySerializer(read_only=True)
     category_id = serializers.IntegerField(write_only=True)
     subcategory = SubcategorySerializer(read_only=True)
@@ -88,16 +163,15 @@ class ProductSerializer(serializers.ModelSerializer):
         ]
     
     def get_current_price(self, obj):
-        # Por ahora retorna el precio normal, se puede implementar promociones por producto después
-        return obj.price
+        # Precio efectivo precalculado (ProductPrice); las vistas hacen select_related('pricing')
+        return obj.current_price
     
     def get_has_promotion(self, obj):
-        # Por ahora retorna False, se puede implementar promociones por producto después
-        return False
+        return obj.has_promotion
     
     def get_main_image(self, obj):
         """Retorna la imagen principal del producto"""
-        main_image = obj.main_image
+        main_image = obj.get_main_image()
         if main_image:
             request = self.context.get('request')
             if request is not None:
@@ -136,7 +210,8 @@ class SubscriberSerializer(serializers.ModelSerializer):
     
     def get_active_cart(self, obj):
         # Obtener el carrito activo del suscriptor sin crear referencia circular
-        active_cart = obj.carts.filter(is_active=True).first()
+        # (total e items_count anotados por Subscriber.objects.with_cart_stats())
+        active_cart = obj.get_active_cart()
         if active_cart:
             # Retornar solo datos básicos del carrito, no el serializer completo
             return {
@@ -145,7 +220,7 @@ class SubscriberSerializer(serializers.ModelSerializer):
                 'created_at': active_cart.created_at,
                 'is_active': active_cart.is_active,
                 'total': active_cart.total(),
-                'items_count': active_cart.items.count()
+                'items_count': active_cart.get_items_count()
             }
         return None
     
@@ -165,7 +240,7 @@ class SubscriberSerializer(serializers.ModelSerializer):
         return None
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)
     product_id = serializers.IntegerField(write_only=True)
     subtotal = serializers.SerializerMethodField()
@@ -208,7 +283,7 @@ class CartSerializer(serializers.ModelSerializer):
         return obj.total()
     
     def get_items_count(self, obj):
-        return obj.items.count()
+        return obj.get_items_count()
 
 
 
@@ -240,9 +315,36 @@ class SubscriberResponseSerializer(serializers.ModelSerializer):
 
 
 class AddToCartSerializer(serializers.Serializer):
-    product_id = serializers.IntegerField()
-    quantity = serializers.IntegerField(min_value=1, default=1)
+    product_id = serializers.IntegerField(min_value=1, max_value=MAX_BIGINT)
+    quantity = serializers.IntegerField(min_value=1, max_value=MAX_QUANTITY, default=1)
+    session_id = serializers.CharField(required=False, allow_blank=True)
+
+
+class CartOperationSerializer(serializers.Serializer):
+    """Operación de /api/carts/batch/: add requiere product_id; set y remove aceptan product_id o item_id"""
+    op = serializers.ChoiceField(choices=['add', 'set', 'remove'])
+    product_id = serializers.IntegerField(min_value=1, max_value=MAX_BIGINT, required=False)
+    item_id = serializers.IntegerField(min_value=1, max_value=MAX_BIGINT, required=False)
+    quantity = serializers.IntegerField(min_value=1, max_value=MAX_QUANTITY, required=False)
+
+    def validate(self, data):
+        if data['op'] == 'add':
+            if 'product_id' not in data or 'item_id' in data:
+                raise serializers.ValidationError('add requires product_id and does not accept item_id')
+            data.setdefault('quantity', 1)
+            return data
+        if ('product_id' in data) == ('item_id' in data):
+            raise serializers.ValidationError('Exactly one of product_id or item_id is required')
+        if data['op'] == 'set' and 'quantity' not in data:
+            raise serializers.ValidationError('quantity is required')
+        return data
+
+
+class CartBatchSerializer(serializers.Serializer):
     session_id = serializers.CharField(required=False, allow_blank=True)
+    operations = serializers.ListField(
+        child=CartOperationSerializer(), allow_empty=False, max_length=settings.CART_BATCH_MAX_OPERATIONS
+    )
 
 
 
@@ -33,6 +33,7 @@ urlpatterns = [
     path('carts/remove-item/', views.CartViewSet.as_view({'post': 'remove_item_by_session'}), name='remove-cart-item'),
     path('carts/clear/', views.CartViewSet.as_view({'post': 'clear_by_session'}), name='clear-cart'),
     path('carts/link-to-subscriber/', views.CartViewSet.as_view({'post': 'link_to_subscriber'}), name='link-cart-to-subscriber'),
+    path('carts/redeem-promotion/', views.CartViewSet.as_view({'post': 'redeem_promotion'}), name='redeem-promotion'),
     
     # URLs para suscriptores
     path('subscribers/subscribe/', views.SubscriberViewSet.as_view({'post': 'subscribe'}), name='subscriber-subscribe'),
@@ -1,40 +1,123 @@
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import transaction
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
 from django.utils import timezone
-from decimal import Decimal
 from web.models import (
     Category, Subcategory, Product, ProductImage, Promotion, UsedPromotion, 
-    Subscriber, Cart, CartItem, Discount
+    Subscriber, Cart, CartItem, Discount, apply_cart_operations, cart_summary, get_cart_summary, get_default_discount,
+    get_or_create_cart, redeem_promotion, set_cart_item_quantity, upsert_cart_item, upsert_subscriber,
+    MAX_BIGINT,
 )
+from web.cache import cart_summary_key, get_or_set_catalog, set_cart_summary
+from web.documents import (
+    RESULTS_MARKER, document_rows, load_documents, request_origin, splice_detail, splice_documents,
+)
+from web.export import accepts_gzip, export_product_lines, gzip_stream
+from web.listings import get_product_list_ids
+from web.reservations import hold_cart_stock
+from web.search import product_facets, search_products
+from web.sync import SyncTokenExpired, changes_since, current_changes_token
+from .mixins import ConditionalGetMixin, ResponseCacheMixin
+from .pagination import KeysetPagination
+from .rendering import NDJSONRenderer, PrerenderedJSONResponse, can_render_fast
 from .serializers import (
     CategorySerializer, CategoryTreeSerializer, SubcategorySerializer, ProductImageSerializer, ProductSerializer, PromotionSerializer,
+    CatalogImageSerializer,
     SubscriberSerializer, CartSerializer, CartItemSerializer, DiscountSerializer,
-    SubscribeSerializer, AddToCartSerializer, UpdateCartItemSerializer
+    SubscribeSerializer, AddToCartSerializer, UpdateCartItemSerializer, CartBatchSerializer
 )
 
 
-class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
+def compact_context(view):
+    """Contexto de serializer para listados: relaciones compactas salvo ?expand="""
+    context = view.get_serializer_context()
+    context['compact'] = True
+    return context
+
+
+def expands(request, name):
+    """Si ?expand= pide anidar completa la relación name de los objetos del primer nivel"""
+    return name in [value.strip() for value in request.query_params.get('expand', '').split(',')]
+
+
+def product_expand_prefetches(request):
+    """Prefetches que necesitan las relaciones expandidas de ProductSerializer"""
+    if expands(request, 'category'):
+        # CategorySerializer anida las subcategorías activas de cada categoría
+        return [active_subcategories_prefetch('category__subcategories')]
+    return []
+
+
+def active_subcategories_prefetch(lookup='subcategories'):
+    """Prefetch de subcategorías activas ordenadas, leído por los serializers de categoría"""
+    return Prefetch(
+        lookup,
+        queryset=Subcategory.objects.filter(is_active=True).order_by('order', 'name'),
+        to_attr='active_subcategories'
+    )
+
+
+def cart_items_prefetch():
+    """Prefetch de los items del carrito con todo lo que usa CartItemSerializer"""
+    return Prefetch(
+        'items',
+        queryset=CartItem.objects.select_related(
+            'product__category', 'product__subcategory', 'product__main_image', 'product__pricing'
+        ).prefetch_related(
+            'product__images', active_subcategories_prefetch('product__category__subcategories')
+        )
+    )
+
+
+def with_unheld_lines(data, unheld):
+    """
+    Agrega a la respuesta las líneas del carrito que la operación no tocó y ya no
+    tienen su cantidad reservada (ver hold_cart_stock), sin deshacer la operación
+    """
+    if unheld:
+        data = {**data, 'unavailable_items': [
+            {'product_id': product_id, 'available': available} for product_id, available in unheld
+        ]}
+    return data
+
+
+def cart_queryset():
+    """Carritos con total e items_count anotados y sus items prefetcheados"""
+    return Cart.objects.with_totals().select_related('subscriber__discount').prefetch_related(cart_items_prefetch())
+
+
+class CategoryViewSet(ResponseCacheMixin, ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """
     ViewSet para categorías - solo lectura
     """
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     lookup_field = 'slug'
+    list_cache_tag = 'category-list'
     
     def get_queryset(self):
-        queryset = Category.objects.filter(is_active=True)
+        queryset = Category.objects.filter(is_active=True).prefetch_related(active_subcategories_prefetch())
         return queryset.order_by('order', 'name')
     
     @action(detail=True, methods=['get'])
     def products(self, request, slug=None):
         """Obtener productos de una categoría específica"""
         category = self.get_object()
-        products = Product.objects.filter(category=category, is_active=True)
-        serializer = ProductSerializer(products, many=True)
+        products = Product.objects.filter(category=category, is_active=True).select_related(
+            'category', 'subcategory', 'pricing'
+        ).prefetch_related('images', *product_expand_prefetches(request))
+        self.add_cache_tags('product-list', f'category:{category.pk}')
+        serializer = ProductSerializer(self.tag_instances(products), many=True, context=compact_context(self))
         return Response(serializer.data)
     
     @action(detail=True, methods=['get'])
@@ -42,20 +125,25 @@ class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
         """Obtener subcategorías de una categoría"""
         category = self.get_object()
         subcategories = category.subcategories.filter(is_active=True).order_by('order', 'name')
-        serializer = SubcategorySerializer(subcategories, many=True)
+        self.add_cache_tags(f'category:{category.pk}')
+        serializer = SubcategorySerializer(self.tag_instances(subcategories), many=True)
         return Response(serializer.data)
     
     @action(detail=False, methods=['get'])
     def tree(self, request):
-        """Obtener árbol completo de categorías con subcategorías"""
-        categories = Category.objects.filter(is_active=True).select_related().prefetch_related(
-            'subcategories'
-        ).order_by('order', 'name')
-        serializer = CategoryTreeSerializer(categories, many=True)
-        return Response(serializer.data)
+        """Obtener árbol completo de categorías con subcategorías (cacheado por versión del catálogo)"""
+        def build_tree():
+            categories = Category.objects.filter(is_active=True).prefetch_related(
+                active_subcategories_prefetch()
+            ).order_by('order', 'name')
+            return CategoryTreeSerializer(categories, many=True).data
+
+        data = get_or_set_catalog('category-tree', build_tree)
+        self.add_cache_tags(*(f'category:{category["id"]}' for category in data))
+        return Response(data)
 
 
-class SubcategoryViewSet(viewsets.ReadOnlyModelViewSet):
+class SubcategoryViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """
     ViewSet para subcategorías - solo lectura
     """
@@ -81,8 +169,10 @@ class SubcategoryViewSet(viewsets.ReadOnlyModelViewSet):
     def products(self, request, slug=None):
         """Obtener productos de una subcategoría específica"""
         subcategory = self.get_object()
-        products = Product.objects.filter(subcategory=subcategory, is_active=True)
-        serializer = ProductSerializer(products, many=True)
+        products = Product.objects.filter(subcategory=subcategory, is_active=True).select_related(
+            'category', 'subcategory', 'pricing'
+        ).prefetch_related('images', *product_expand_prefetches(request))
+        serializer = ProductSerializer(products, many=True, context=compact_context(self))
         return Response(serializer.data)
 
 
@@ -149,20 +239,56 @@ class ProductImageViewSet(viewsets.ModelViewSet):
             )
 
 
-class ProductViewSet(viewsets.ReadOnlyModelViewSet):
+class ProductViewSet(ResponseCacheMixin, ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """
     ViewSet para productos - solo lectura
     """
     queryset = Product.objects.filter(is_active=True)
     serializer_class = ProductSerializer
     lookup_field = 'slug'
+    pagination_class = KeysetPagination
+    list_cache_tag = 'product-list'
+    # El feed de cambios depende del tiempo transcurrido, no solo de la versión del catálogo,
+    # y la exportación se genera en streaming
+    uncached_actions = ('changes', 'export')
+    
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        # El detalle conserva la forma anidada completa; los listados usan la compacta
+        context['compact'] = self.action != 'retrieve'
+        return context
+    
+    def list(self, request, *args, **kwargs):
+        if not can_render_fast(request):
+            return super().list(request, *args, **kwargs)
+        # Ruta rápida: se concatenan los documentos precalculados (misma salida JSON que el serializer)
+        rows = self.paginate_queryset(document_rows(self.filter_queryset(self.get_queryset())))
+        contents = load_documents(self.tag_rows(rows, Product))
+        envelope = self.get_paginated_response(RESULTS_MARKER).data
+        return PrerenderedJSONResponse(splice_documents(envelope, contents, request_origin(request)))
+    
+    def retrieve(self, request, *args, **kwargs):
+        if not can_render_fast(request):
+            return super().retrieve(request, *args, **kwargs)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        rows = document_rows(self.filter_queryset(self.get_queryset()), 'category__slug', 'subcategory__slug')
+        row = get_object_or_404(rows, **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        content, = load_documents(self.tag_rows([row], Product))
+        return PrerenderedJSONResponse(splice_detail(row, content, request_origin(request)))
     
     def get_queryset(self):
-        queryset = Product.objects.filter(is_active=True).select_related(
-            'category', 'subcategory'
-        ).prefetch_related('images')
+        queryset = self.filter_products(self.get_base_queryset())
+        search = self.request.query_params.get('search', None)
         
-        # Filtros
+        # Ordenamiento (con búsqueda y sin ordering explícito se ordena por relevancia)
+        ordering = self.request.query_params.get('ordering', None if search else 'name')
+        if ordering in ['name', 'price', '-name', '-price', 'created_at', '-created_at']:
+            queryset = queryset.order_by(ordering)
+        
+        return queryset
+    
+    def filter_products(self, queryset):
+        """Aplica los filtros de la query string (compartidos por el listado y las facetas)"""
         category = self.request.query_params.get('category', None)
         if category:
             queryset = queryset.filter(category__slug=category)
@@ -173,7 +299,7 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         
         search = self.request.query_params.get('search', None)
         if search:
-            queryset = queryset.filter(name__icontains=search)
+            queryset = search_products(queryset, search)
         
         # Filtro por precio
         min_price = self.request.query_params.get('min_price', None)
@@ -184,56 +310,177 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         if max_price:
             queryset = queryset.filter(price__lte=max_price)
         
-        # Filtro por productos en oferta (por ahora filtramos por destacados)
+        # Filtro por productos en oferta (con alguna regla de precio activa)
         on_sale = self.request.query_params.get('on_sale', None)
         if on_sale == 'true':
-            queryset = queryset.filter(is_featured=True)
-        
-        # Ordenamiento
-        ordering = self.request.query_params.get('ordering', 'name')
-        if ordering in ['name', 'price', '-name', '-price', 'created_at', '-created_at']:
-            queryset = queryset.order_by(ordering)
+            queryset = queryset.filter(pricing__has_promotion=True)
         
         return queryset
     
+    def get_base_queryset(self):
+        """Productos activos con las relaciones que usa el serializer"""
+        return Product.objects.filter(is_active=True).select_related(
+            'category', 'subcategory', 'main_image', 'pricing'
+        ).prefetch_related('images', *product_expand_prefetches(self.request)).defer('search_vector')
+    
+    def materialized_list(self, request, name):
+        """Pagina una lista materializada de ids y carga solo los productos de la página"""
+        paginator = PageNumberPagination()
+        page_ids = paginator.paginate_queryset(get_product_list_ids(name), request, view=self)
+        if can_render_fast(request):
+            rows = {row['id']: row for row in document_rows(self.get_base_queryset().filter(pk__in=page_ids))}
+            page = [rows[pk] for pk in page_ids if pk in rows]
+            contents = load_documents(self.tag_rows(page, Product))
+            envelope = paginator.get_paginated_response(RESULTS_MARKER).data
+            return PrerenderedJSONResponse(splice_documents(envelope, contents, request_origin(request)))
+        products = self.get_base_queryset().in_bulk(page_ids)
+        page = [products[pk] for pk in page_ids if pk in products]
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+    
+    @action(detail=False, methods=['get'])
+    def facets(self, request):
+        """Conteos por categoría, subcategoría, estado de stock y rango de precio para los filtros actuales"""
+        queryset = self.filter_products(Product.objects.filter(is_active=True))
+        facets = product_facets(queryset)
+        # Las facetas incluyen nombres y slugs: se invalidan al cambiar esas categorías y subcategorías
+        self.add_cache_tags(
+            *[f'category:{facet["id"]}' for facet in facets['categories']],
+            *[f'subcategory:{facet["id"]}' for facet in facets['subcategories']],
+        )
+        return Response(facets)
+    
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """
+        Sincronización incremental: productos, imágenes, categorías y subcategorías
+        creados, modificados (incluye desactivados) o eliminados después de ?since=<token>.
+        Sin since retorna solo el token actual, que el cliente guarda antes de una
+        descarga completa. Con has_more se repite la consulta con next_since. Un token
+        anterior a los cambios conservados responde 410 (hay que descargar todo de nuevo).
+        """
+        since = request.query_params.get('since')
+        if not since:
+            return Response({'next_since': current_changes_token()})
+        try:
+            next_since, has_more, changes = changes_since(since)
+        except SyncTokenExpired:
+            return Response(
+                {'error': 'Sync token expired, a full resync is required'}, 
+                status=status.HTTP_410_GONE
+            )
+        except ValueError:
+            return Response({'error': 'Invalid since token'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        product_ids, _ = changes['product']
+        image_ids, _ = changes['productimage']
+        category_ids, _ = changes['category']
+        subcategory_ids, _ = changes['subcategory']
+        
+        context = self.get_serializer_context()
+        categories = Category.objects.filter(pk__in=category_ids).prefetch_related(
+            active_subcategories_prefetch()
+        ).order_by('pk')
+        envelope = {
+            'since': since,
+            'next_since': next_since,
+            'has_more': has_more,
+            'products': RESULTS_MARKER,
+            'images': CatalogImageSerializer(
+                ProductImage.objects.filter(pk__in=image_ids).order_by('pk'), many=True, context=context
+            ).data,
+            'categories': CategorySerializer(categories, many=True).data,
+            'subcategories': SubcategorySerializer(
+                Subcategory.objects.filter(pk__in=subcategory_ids).order_by('pk'), many=True
+            ).data,
+            'deleted': {
+                'products': sorted(changes['product'][1]),
+                'images': sorted(changes['productimage'][1]),
+                'categories': sorted(changes['category'][1]),
+                'subcategories': sorted(changes['subcategory'][1]),
+            },
+        }
+        # Los productos salen de sus documentos precalculados, como en los listados
+        contents = load_documents(document_rows(Product.objects.filter(pk__in=product_ids).order_by('pk')))
+        return PrerenderedJSONResponse(splice_documents(envelope, contents, request_origin(request)))
+    
+    @action(detail=False, methods=['get'], renderer_classes=[NDJSONRenderer, JSONRenderer])
+    def export(self, request):
+        """Todos los productos activos en NDJSON, en streaming (comprimido con gzip si el cliente lo acepta)"""
+        lines = export_product_lines(request_origin(request))
+        compress = accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        response = StreamingHttpResponse(
+            gzip_stream(lines) if compress else lines, content_type=NDJSONRenderer.media_type
+        )
+        if compress:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ['Accept-Encoding'])
+        response['Content-Disposition'] = 'attachment; filename="products.ndjson"'
+        return response
+    
+    @action(detail=False, methods=['get'])
+    def batch(self, request):
+        """
+        Varios productos en una sola petición por ?ids=1,2,3 o ?slugs=a,b,c (hasta
+        PRODUCT_BATCH_MAX_SIZE), en el orden pedido. Las claves sin producto activo se
+        reportan en missing.
+        """
+        ids = [value.strip() for value in request.query_params.get('ids', '').split(',') if value.strip()]
+        slugs = [value.strip() for value in request.query_params.get('slugs', '').split(',') if value.strip()]
+        if bool(ids) == bool(slugs):
+            return Response({'error': 'Either ids or slugs is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if ids:
+            try:
+                ids = [int(value) for value in ids]
+            except ValueError:
+                return Response({'error': 'ids must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+            # Fuera del rango de bigint fallarían en la consulta y al codificar missing
+            if not all(0 < value <= MAX_BIGINT for value in ids):
+                return Response({'error': 'ids must be positive 64-bit integers'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        field = 'id' if ids else 'slug'
+        keys = list(dict.fromkeys(ids or slugs))
+        if len(keys) > settings.PRODUCT_BATCH_MAX_SIZE:
+            return Response(
+                {'error': f'At most {settings.PRODUCT_BATCH_MAX_SIZE} products can be requested at once'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        lookup = {f'{field}__in': keys}
+        if can_render_fast(request):
+            rows = {row[field]: row for row in document_rows(self.get_base_queryset().filter(**lookup), 'slug')}
+            found = [rows[key] for key in keys if key in rows]
+            contents = load_documents(self.tag_rows(found, Product))
+            envelope = {'results': RESULTS_MARKER, 'missing': [key for key in keys if key not in rows]}
+            return PrerenderedJSONResponse(splice_documents(envelope, contents, request_origin(request)))
+        
+        products = {getattr(product, field): product for product in self.get_base_queryset().filter(**lookup)}
+        serializer = self.get_serializer([products[key] for key in keys if key in products], many=True)
+        return Response({
+            'results': serializer.data,
+            'missing': [key for key in keys if key not in products],
+        })
+    
     @action(detail=False, methods=['get'])
     def featured(self, request):
         """Obtener productos destacados"""
-        featured_products = Product.objects.filter(
-            is_active=True,
-            is_featured=True
-        )
-        serializer = self.get_serializer(featured_products, many=True)
-        return Response(serializer.data)
+        return self.materialized_list(request, 'featured')
     
     @action(detail=False, methods=['get'])
     def on_sale(self, request):
-        """Obtener productos en oferta (por ahora retorna productos destacados)"""
-        # Por ahora retornamos productos destacados ya que no tenemos sistema de promociones por producto
-        on_sale_products = Product.objects.filter(
-            is_active=True,
-            is_featured=True
-        )
-        serializer = self.get_serializer(on_sale_products, many=True)
-        return Response(serializer.data)
+        """Obtener productos en oferta (con alguna regla de precio activa)"""
+        return self.materialized_list(request, 'on-sale')
     
     @action(detail=False, methods=['get'])
     def new_arrivals(self, request):
-        """Obtener productos nuevos (últimos 30 días)"""
-        from datetime import timedelta
-        thirty_days_ago = timezone.now() - timedelta(days=30)
-        new_products = Product.objects.filter(
-            is_active=True,
-            created_at__gte=thirty_days_ago
-        ).order_by('-created_at')
-        serializer = self.get_serializer(new_products, many=True)
-        return Response(serializer.data)
+        """Obtener productos nuevos (últimos NEW_ARRIVALS_DAYS días)"""
+        return self.materialized_list(request, 'new-arrivals')
 
 
 
 
 
-class PromotionViewSet(viewsets.ReadOnlyModelViewSet):
+class PromotionViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """
     ViewSet para promociones - solo lectura
     """
@@ -253,10 +500,8 @@ class SubscriberViewSet(viewsets.ModelViewSet):
     serializer_class = SubscriberSerializer
     
     def get_queryset(self):
-        queryset = Subscriber.objects.filter(is_active=True).select_related('discount').prefetch_related(
-            'carts__items__product__category',
-            'carts__items__product__images'
-        )
+        # Carritos y totales del carrito activo en la misma consulta (ver with_cart_stats)
+        queryset = Subscriber.objects.filter(is_active=True).select_related('discount').with_cart_stats()
         
         # Filtrar por descuento
         discount_id = self.request.query_params.get('discount', None)
@@ -278,31 +523,11 @@ class SubscriberViewSet(viewsets.ModelViewSet):
             )
         
         try:
-            subscriber, created = Subscriber.objects.get_or_create(
-                phone=phone,
-                defaults={
-                    'email': email,
-                    'is_active': True
-                }
-            )
-            
-            if not created:
-                # Actualizar suscriptor si ya existe
-                subscriber.email = email
-                subscriber.save()
-            
-            # Crear descuento del 5% si no existe
-            discount, _ = Discount.objects.get_or_create(
-                name="Descuento Suscriptor",
-                defaults={
-                    'percentage': Decimal('5.00'),
-                    'is_active': True
-                }
-            )
-            
-            # Asignar descuento al suscriptor
-            subscriber.discount = discount
-            subscriber.save()
+            # Descuento del 5% (en memoria del proceso) y suscriptor creado o actualizado con un upsert
+            try:
+                subscriber, _ = upsert_subscriber(phone, email, get_default_discount())
+            except Discount.DoesNotExist:
+                subscriber, _ = upsert_subscriber(phone, email, get_default_discount(refresh=True))
             
             # Usar serializer simplificado para evitar referencias circulares
             from .serializers import SubscriberResponseSerializer
@@ -329,10 +554,7 @@ class CartViewSet(viewsets.ModelViewSet):
     serializer_class = CartSerializer
     
     def get_queryset(self):
-        queryset = Cart.objects.filter(is_active=True).select_related('subscriber').prefetch_related(
-            'items__product__category',
-            'items__product__images'
-        )
+        queryset = cart_queryset().filter(is_active=True)
         
         # Filtrar por suscriptor
         subscriber_id = self.request.query_params.get('subscriber', None)
@@ -350,6 +572,27 @@ class CartViewSet(viewsets.ModelViewSet):
         
         return queryset.order_by('-created_at')
     
+    def get_cart_serializer(self, cart):
+        """
+        Serializa el carrito recargado tras una modificación (totales anotados, items
+        prefetcheados) y escribe su resumen en el cache compartido
+        """
+        key = cart_summary_key(cart.session_id)
+        cart = cart_queryset().get(pk=cart.pk)
+        set_cart_summary(key, cart_summary(cart))
+        return CartSerializer(cart)
+    
+    @action(detail=False, methods=['get'], authentication_classes=[])
+    def summary(self, request):
+        """Total, cantidad de items y total con descuento del carrito de la sesión (desde cache)"""
+        session_id = request.query_params.get('session_id')
+        if not session_id:
+            return Response(
+                {'error': 'session_id is required'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(get_cart_summary(session_id))
+    
     @action(detail=False, methods=['post'])
     def add_item(self, request):
         """Agregar producto al carrito (con o sin suscripción)"""
@@ -360,40 +603,35 @@ class CartViewSet(viewsets.ModelViewSet):
             session_id = serializer.validated_data.get('session_id')
             
             try:
-                # Obtener producto
-                product = get_object_or_404(Product, id=product_id, is_active=True)
-                
                 # Generar session_id si no existe
                 if not session_id:
                     import uuid
                     session_id = str(uuid.uuid4())
                 
-                # Obtener o crear carrito
-                cart, created = Cart.objects.get_or_create(
-                    session_id=session_id,
-                    is_active=True,
-                    defaults={'is_active': True}
-                )
-                
-                # Verificar si ya existe el item en el carrito
-                cart_item, item_created = CartItem.objects.get_or_create(
-                    cart=cart,
-                    product=product,
-                    defaults={'quantity': quantity}
-                )
-                
-                if not item_created:
-                    cart_item.quantity += quantity
-                    cart_item.save()
+                # Carrito e item con upserts atómicos: clics simultáneos no pierden cantidades
+                with transaction.atomic():
+                    cart, created = get_or_create_cart(session_id)
+                    if not cart.is_active:
+                        return Response(
+                            {'error': 'Cart is no longer active'}, 
+                            status=status.HTTP_400_BAD_REQUEST
+                        )
+                    upsert_cart_item(cart, product_id, quantity)
+                    unheld = hold_cart_stock(cart, [product_id])
                 
                 # Serializar carrito actualizado
-                cart_serializer = CartSerializer(cart)
-                return Response({
+                cart_serializer = self.get_cart_serializer(cart)
+                return Response(with_unheld_lines({
                     'cart': cart_serializer.data,
                     'session_id': session_id,
                     'message': 'Producto agregado al carrito'
-                })
+                }, unheld))
                     
+            except Product.DoesNotExist:
+                return Response(
+                    {'error': 'Product not found'}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
             except Exception as e:
                 return Response(
                     {'error': str(e)}, 
@@ -402,6 +640,66 @@ class CartViewSet(viewsets.ModelViewSet):
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Aplica en orden una lista de operaciones add/set/remove al carrito de la sesión
+        en una sola transacción y retorna el carrito final una sola vez
+        """
+        serializer = CartBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        operations = serializer.validated_data['operations']
+        session_id = serializer.validated_data.get('session_id')
+        if not session_id:
+            import uuid
+            session_id = str(uuid.uuid4())
+        
+        try:
+            with transaction.atomic():
+                cart, created = get_or_create_cart(session_id)
+                if not cart.is_active:
+                    return Response(
+                        {'error': 'Cart is no longer active'}, 
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                
+                # Las operaciones por item_id se traducen a su producto (una consulta)
+                item_ids = {operation['item_id'] for operation in operations if 'item_id' in operation}
+                if item_ids:
+                    item_products = dict(
+                        CartItem.objects.filter(cart=cart, pk__in=item_ids).values_list('pk', 'product_id')
+                    )
+                    if len(item_products) < len(item_ids):
+                        return Response(
+                            {'error': 'Item not found'}, 
+                            status=status.HTTP_404_NOT_FOUND
+                        )
+                    for operation in operations:
+                        if 'item_id' in operation:
+                            operation['product_id'] = item_products[operation['item_id']]
+                
+                apply_cart_operations(cart, operations)
+                unheld = hold_cart_stock(cart, [operation['product_id'] for operation in operations])
+        except Product.DoesNotExist:
+            return Response(
+                {'error': 'Product not found'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        except ValidationError as e:
+            return Response(
+                {'error': str(e), 'product_id': e.params['product_id']}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        cart_serializer = self.get_cart_serializer(cart)
+        return Response(with_unheld_lines({
+            'cart': cart_serializer.data,
+            'session_id': session_id,
+            'message': 'Carrito actualizado'
+        }, unheld))
+    
     @action(detail=True, methods=['post'])
     def update_item(self, request, pk=None):
         """Actualizar cantidad de un item en el carrito (con ID del carrito)"""
@@ -413,22 +711,19 @@ class CartViewSet(viewsets.ModelViewSet):
             quantity = serializer.validated_data['quantity']
             
             try:
-                cart_item = CartItem.objects.get(id=item_id, cart=cart)
-                cart_item.quantity = quantity
-                cart_item.save()
-                
-                # Eliminar item si cantidad es 0
-                if quantity <= 0:
-                    cart_item.delete()
-                
-                cart_serializer = CartSerializer(cart)
-                return Response(cart_serializer.data)
+                with transaction.atomic():
+                    product_id = set_cart_item_quantity(cart, item_id, quantity)
+                    unheld = hold_cart_stock(cart, [product_id])
+                cart_serializer = self.get_cart_serializer(cart)
+                return Response(with_unheld_lines(cart_serializer.data, unheld))
                 
             except CartItem.DoesNotExist:
                 return Response(
                     {'error': 'Item not found'}, 
                     status=status.HTTP_404_NOT_FOUND
                 )
+            except ValidationError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
@@ -450,16 +745,11 @@ class CartViewSet(viewsets.ModelViewSet):
             
             try:
                 cart = Cart.objects.get(session_id=session_id, is_active=True)
-                cart_item = CartItem.objects.get(id=item_id, cart=cart)
-                cart_item.quantity = quantity
-                cart_item.save()
-                
-                # Eliminar item si cantidad es 0
-                if quantity <= 0:
-                    cart_item.delete()
-                
-                cart_serializer = CartSerializer(cart)
-                return Response(cart_serializer.data)
+                with transaction.atomic():
+                    product_id = set_cart_item_quantity(cart, item_id, quantity)
+                    unheld = hold_cart_stock(cart, [product_id])
+                cart_serializer = self.get_cart_serializer(cart)
+                return Response(with_unheld_lines(cart_serializer.data, unheld))
                 
             except Cart.DoesNotExist:
                 return Response(
@@ -471,6 +761,8 @@ class CartViewSet(viewsets.ModelViewSet):
                     {'error': 'Item not found'}, 
                     status=status.HTTP_404_NOT_FOUND
                 )
+            except ValidationError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
@@ -489,10 +781,12 @@ class CartViewSet(viewsets.ModelViewSet):
         try:
             cart = Cart.objects.get(session_id=session_id, is_active=True)
             cart_item = CartItem.objects.get(id=item_id, cart=cart)
-            cart_item.delete()
+            with transaction.atomic():
+                cart_item.delete()
+                unheld = hold_cart_stock(cart, [cart_item.product_id])
             
-            cart_serializer = CartSerializer(cart)
-            return Response(cart_serializer.data)
+            cart_serializer = self.get_cart_serializer(cart)
+            return Response(with_unheld_lines(cart_serializer.data, unheld))
             
         except Cart.DoesNotExist:
             return Response(
@@ -513,10 +807,12 @@ class CartViewSet(viewsets.ModelViewSet):
         
         try:
             cart_item = CartItem.objects.get(id=item_id, cart=cart)
-            cart_item.delete()
+            with transaction.atomic():
+                cart_item.delete()
+                unheld = hold_cart_stock(cart, [cart_item.product_id])
             
-            cart_serializer = CartSerializer(cart)
-            return Response(cart_serializer.data)
+            cart_serializer = self.get_cart_serializer(cart)
+            return Response(with_unheld_lines(cart_serializer.data, unheld))
             
         except CartItem.DoesNotExist:
             return Response(
@@ -528,9 +824,11 @@ class CartViewSet(viewsets.ModelViewSet):
     def clear(self, request, pk=None):
         """Vaciar carrito (con ID del carrito)"""
         cart = self.get_object()
-        cart.items.all().delete()
+        with transaction.atomic():
+            cart.items.all().delete()
+            hold_cart_stock(cart)
         
-        cart_serializer = CartSerializer(cart)
+        cart_serializer = self.get_cart_serializer(cart)
         return Response(cart_serializer.data)
     
     @action(detail=False, methods=['post'])
@@ -546,9 +844,11 @@ class CartViewSet(viewsets.ModelViewSet):
         
         try:
             cart = Cart.objects.get(session_id=session_id, is_active=True)
-            cart.items.all().delete()
+            with transaction.atomic():
+                cart.items.all().delete()
+                hold_cart_stock(cart)
             
-            cart_serializer = CartSerializer(cart)
+            cart_serializer = self.get_cart_serializer(cart)
             return Response(cart_serializer.data)
             
         except Cart.DoesNotExist:
@@ -580,7 +880,7 @@ class CartViewSet(viewsets.ModelViewSet):
             # Aplicar descuento si el suscriptor tiene uno
             if subscriber.discount:
                 discount_amount = cart.get_discount_amount(subscriber.discount.percentage / 100)
-                cart_serializer = CartSerializer(cart)
+                cart_serializer = self.get_cart_serializer(cart)
                 return Response({
                     'cart': cart_serializer.data,
                     'discount_applied': True,
@@ -590,7 +890,7 @@ class CartViewSet(viewsets.ModelViewSet):
                     'message': f'Carrito vinculado y descuento del {subscriber.discount.percentage}% aplicado'
                 })
             
-            cart_serializer = CartSerializer(cart)
+            cart_serializer = self.get_cart_serializer(cart)
             return Response({
                 'cart': cart_serializer.data,
                 'discount_applied': False,
@@ -602,6 +902,50 @@ class CartViewSet(viewsets.ModelViewSet):
                 {'error': str(e)}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
+    
+    @action(detail=False, methods=['post'])
+    def redeem_promotion(self, request):
+        """
+        Canjear una promoción en el carrito del suscriptor. La cabecera Idempotency-Key
+        (o idempotency_key en el cuerpo) hace que un reintento devuelva el mismo canje
+        en lugar de rechazarlo como promoción ya usada.
+        """
+        session_id = request.data.get('session_id')
+        phone = request.data.get('phone')
+        promotion_slug = request.data.get('promotion')
+        idempotency_key = request.headers.get('Idempotency-Key') or request.data.get('idempotency_key')
+        
+        if not session_id or not phone or not promotion_slug:
+            return Response(
+                {'error': 'session_id, phone and promotion are required'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if idempotency_key and len(idempotency_key) > 64:
+            return Response(
+                {'error': 'Idempotency key must be at most 64 characters'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        cart = get_object_or_404(Cart, session_id=session_id, is_active=True)
+        subscriber = get_object_or_404(Subscriber, phone=phone, is_active=True)
+        promotion = get_object_or_404(Promotion, slug=promotion_slug)
+        
+        try:
+            discount_amount, cart_total, replayed = redeem_promotion(subscriber, cart, promotion, idempotency_key)
+        except ValidationError as e:
+            return Response(
+                {'error': e.messages[0]}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        return Response({
+            'promotion': promotion.slug,
+            'discount_percentage': promotion.discount,
+            'cart_total': cart_total,
+            'discount_amount': discount_amount,
+            'total_with_discount': cart_total - discount_amount,
+            'replayed': replayed,
+        }, status=status.HTTP_200_OK if replayed else status.HTTP_201_CREATED)
 
 
 # OrderViewSet ya no es necesario porque no manejamos órdenes
@@ -615,9 +959,31 @@ class CartItemViewSet(viewsets.ModelViewSet):
     queryset = CartItem.objects.all()
     serializer_class = CartItemSerializer
     
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['compact'] = self.action == 'list'
+        return context
+    
+    # Las reservas de stock del carrito siguen a sus items (ver web/reservations.py)
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            item = serializer.save()
+            hold_cart_stock(item.cart, [item.product_id])
+    
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            previous_product_id = serializer.instance.product_id
+            item = serializer.save()
+            hold_cart_stock(item.cart, [previous_product_id, item.product_id])
+    
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            instance.delete()
+            hold_cart_stock(instance.cart, [instance.product_id])
+    
     def get_queryset(self):
         queryset = CartItem.objects.all().select_related(
-            'cart', 'product__category', 'product__subcategory'
+            'cart', 'product__category', 'product__subcategory', 'product__pricing'
         ).prefetch_related('product__images')
         
         # Filtrar por carrito
@@ -654,9 +1020,6 @@ class DashboardView(APIView):
     def get(self, request):
         today = timezone.now().date()
         
-        # Usar anotaciones para evitar múltiples queries
-        from django.db.models import Count, Q
-        
         stats = {
             'total_products': Product.objects.filter(is_active=True).count(),
             'total_categories': Category.objects.count(),
@@ -666,9 +1029,7 @@ class DashboardView(APIView):
             'carts_today': Cart.objects.filter(
                 created_at__date=today
             ).count(),
-            'products_by_category': Category.objects.filter(is_active=True).annotate(
-                products_count=Count('products', filter=Q(products__is_active=True))
-            ).values('name', 'products_count')[:5],
+            'products_by_category': Category.objects.filter(is_active=True).values('name', 'products_count')[:5],
         }
         
         return Response(stats)
@@ -0,0 +1,232 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+
+# --- Versión del catálogo ---
+# Todas las claves derivadas del catálogo incluyen esta versión, así que al
+# incrementarla las entradas anteriores dejan de usarse y expiran solas. La versión
+# solo invalida en todos los procesos si la cache es compartida (ver web/checks.py).
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_MODIFIED_KEY = 'catalog:modified'
+
+
+def _initial_version():
+    # Basada en el reloj para no reutilizar versiones si la clave se pierde (reinicio, desalojo)
+    return int(time.time() * 1000)
+
+
+def _get_version(key, timeout=None):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), timeout=timeout)
+        version = cache.get(key)
+    return version
+
+
+def _incr_version(key, timeout=None):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # La clave no existe (cache vacía, reiniciada o expirada)
+        cache.add(key, _initial_version(), timeout=timeout)
+
+
+def get_catalog_version():
+    """Retorna la versión actual del catálogo"""
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def get_catalog_modified():
+    """Fecha del último cambio del catálogo (ahora si no se conoce)"""
+    modified = cache.get(CATALOG_MODIFIED_KEY)
+    if modified is None:
+        # Sin dato se asume un cambio reciente: nunca produce un 304 incorrecto
+        modified = timezone.now()
+        cache.add(CATALOG_MODIFIED_KEY, modified, timeout=None)
+    return modified
+
+
+def _incr_catalog_version():
+    _incr_version(CATALOG_VERSION_KEY)
+    cache.set(CATALOG_MODIFIED_KEY, timezone.now(), timeout=None)
+
+
+def bump_catalog_version():
+    """Invalida las entradas del catálogo cuando la transacción actual se confirma"""
+    # Incrementar antes del commit permitiría cachear datos viejos con la versión nueva
+    transaction.on_commit(_incr_catalog_version)
+
+
+def catalog_cache_key(name):
+    """Clave de cache para un recurso del catálogo en la versión actual"""
+    return f'catalog:v{get_catalog_version()}:{name}'
+
+
+def get_or_set_catalog(name, builder, timeout=None, refresh=False):
+    """
+    Retorna el recurso cacheado o lo construye con builder() y lo guarda.
+    Con refresh=True se reconstruye aunque exista.
+    """
+    key = catalog_cache_key(name)
+    data = None if refresh else cache.get(key)
+    if data is None:
+        data = builder()
+        cache.set(key, data, timeout or settings.CATALOG_CACHE_TIMEOUT)
+    return data
+
+
+# --- Resumen compartido de carritos ---
+# Total, cantidad de items y total con descuento de cada carrito, por session_id.
+# La clave incluye una versión por carrito que las modificaciones incrementan al
+# confirmarse; las vistas escriben el resumen con el carrito recién leído
+# (write-through). Los cambios de precios o de descuentos incrementan la versión de
+# precios, que invalida todos los resúmenes.
+#
+# La clave se calcula antes de leer el carrito: si una modificación se confirma
+# mientras tanto, el resumen leído queda en una versión que ya nadie consulta (con
+# borrar y volver a escribir, una lectura anterior al commit podía reponer datos viejos).
+
+CART_PRICING_VERSION_KEY = 'cart-pricing:version'
+
+
+def bump_cart_pricing_version():
+    """Invalida todos los resúmenes de carrito al confirmar la transacción"""
+    transaction.on_commit(lambda: _incr_version(CART_PRICING_VERSION_KEY))
+
+
+def _cart_digest(session_id):
+    # session_id llega del cliente: se usa su hash para que la clave sea válida en cualquier backend
+    return hashlib.sha256(session_id.encode('utf-8')).hexdigest()
+
+
+def _cart_version_key(session_id):
+    return f'cart-summary-version:{_cart_digest(session_id)}'
+
+
+def cart_summary_key(session_id):
+    """Clave del resumen en las versiones actuales; se obtiene antes de leer el carrito"""
+    # La versión del carrito puede expirar con sus resúmenes: al recrearse (basada en el reloj) es mayor
+    cart_version = _get_version(_cart_version_key(session_id), settings.CART_SUMMARY_TIMEOUT)
+    pricing_version = _get_version(CART_PRICING_VERSION_KEY)
+    return f'cart-summary:v{pricing_version}:{_cart_digest(session_id)}:{cart_version}'
+
+
+def get_cached_cart_summary(key):
+    return cache.get(key)
+
+
+def set_cart_summary(key, summary, overwrite=True):
+    """
+    Guarda el resumen en la clave obtenida con cart_summary_key. Las lecturas usan
+    overwrite=False (solo si no existe) para no reemplazar el que escribió una
+    modificación confirmada mientras tanto.
+    """
+    store = cache.set if overwrite else cache.add
+    store(key, summary, settings.CART_SUMMARY_TIMEOUT)
+
+
+def invalidate_cart_summaries(*session_ids):
+    """Incrementa la versión de los carritos al confirmar la transacción"""
+    session_ids = {session_id for session_id in session_ids if session_id}
+    if not session_ids:
+        return
+
+    def bump():
+        for session_id in session_ids:
+            _incr_version(_cart_version_key(session_id), settings.CART_SUMMARY_TIMEOUT)
+
+    transaction.on_commit(bump)
+
+
+# --- Versión de los descuentos ---
+# Los descuentos que se guardan en la memoria de cada proceso (ver get_default_discount)
+# se validan contra esta versión, que cambia con cada alta, cambio o baja de un Discount.
+
+DISCOUNT_VERSION_KEY = 'discount:version'
+
+
+def get_discount_version():
+    return _get_version(DISCOUNT_VERSION_KEY)
+
+
+def bump_discount_version():
+    """Invalida los descuentos guardados en los procesos al confirmar la transacción"""
+    transaction.on_commit(lambda: _incr_version(DISCOUNT_VERSION_KEY))
+
+
+# --- Cache de respuestas con invalidación por etiquetas ---
+# Cada etiqueta ('product:5', 'category:2', 'product-list'...) tiene un contador en
+# cache. Una entrada guarda la versión de sus etiquetas al generarse y deja de ser
+# válida en cuanto alguna cambia. Funciona con cualquier backend (memoria, archivos).
+
+RESPONSE_TAG_PREFIX = 'response-tag:'
+RESPONSE_GENERATION_KEY = 'response-cache:generation'
+
+
+def _tag_key(tag):
+    return f'{RESPONSE_TAG_PREFIX}{tag}'
+
+
+def get_response_generation():
+    """Contador global que cambia con cada invalidación"""
+    generation = cache.get(RESPONSE_GENERATION_KEY)
+    if generation is None:
+        cache.add(RESPONSE_GENERATION_KEY, _initial_version(), timeout=None)
+        generation = cache.get(RESPONSE_GENERATION_KEY)
+    return generation
+
+
+def _invalidate_tags(tags):
+    for tag in tags:
+        try:
+            cache.incr(_tag_key(tag))
+        except ValueError:
+            # Sin contador no hay entradas válidas que dependan de la etiqueta
+            pass
+    try:
+        cache.incr(RESPONSE_GENERATION_KEY)
+    except ValueError:
+        cache.add(RESPONSE_GENERATION_KEY, _initial_version(), timeout=None)
+
+
+def invalidate_tags(*tags):
+    """Invalida las respuestas con alguna de las etiquetas al confirmar la transacción"""
+    tags = {tag for tag in tags if tag}
+    if tags:
+        transaction.on_commit(lambda: _invalidate_tags(tags))
+
+
+def get_cached_response(key):
+    """Retorna la entrada cacheada si todas sus etiquetas siguen en la misma versión"""
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    tag_keys = {_tag_key(tag): version for tag, version in entry['tags'].items()}
+    current = cache.get_many(list(tag_keys))
+    if any(current.get(tag_key) != version for tag_key, version in tag_keys.items()):
+        return None
+    return entry
+
+
+def set_cached_response(key, entry, tags, generation):
+    """
+    Guarda la entrada con la versión actual de sus etiquetas. Si hubo una
+    invalidación desde que empezó la petición (generation distinta) no se guarda,
+    porque los datos pudieron leerse antes del cambio.
+    """
+    if cache.get(RESPONSE_GENERATION_KEY) != generation:
+        return
+    tag_keys = [_tag_key(tag) for tag in tags]
+    versions = cache.get_many(tag_keys)
+    for tag_key in tag_keys:
+        if tag_key not in versions:
+            cache.add(tag_key, _initial_version(), timeout=None)
+            versions[tag_key] = cache.get(tag_key)
+    entry['tags'] = {tag: versions[_tag_key(tag)] for tag in tags}
+    cache.set(key, entry, settings.RESPONSE_CACHE_TIMEOUT)
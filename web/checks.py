@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    La versión del catálogo (árbol de categorías, ETags), las etiquetas de la cache
+    de respuestas y las versiones de los resúmenes de carrito viven en la cache: con
+    LocMemCache cada proceso tiene las suyas y las invalidaciones de uno no llegan a
+    los demás, que siguen sirviendo datos viejos hasta que expiran.
+    """
+    backend = settings.CACHES['default']['BACKEND']
+    if settings.DEBUG or not backend.endswith('.LocMemCache'):
+        return []
+    return [Error(
+        'The default cache is per-process (LocMemCache); catalog and cart invalidations would not reach other workers.',
+        hint=(
+            'Use a shared backend (DatabaseCache, Redis, Memcached). With a single worker process '
+            'this check can be silenced with SILENCED_SYSTEM_CHECKS = ["web.E001"].'
+        ),
+        id='web.E001',
+    )]
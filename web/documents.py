@@ -0,0 +1,118 @@
+"""
+Documentos JSON precalculados de los productos (ProductDocument).
+
+Cada documento es la representación de listados de ProductSerializer ya codificada,
+así los listados y el detalle solo concatenan fragmentos guardados. Las URLs de las
+imágenes dependen del host de la petición, por eso se guardan con ORIGIN_MARKER en
+lugar del esquema y host, que se sustituye al responder (ver splice_documents).
+"""
+from web.api.rendering import product_rows, render_json, render_product_rows
+from web.api.serializers import CategorySerializer, SubcategorySerializer
+from web.cache import get_or_set_catalog
+from web.models import Category, Subcategory, Product, ProductDocument
+
+# Caracteres de control usados como marcadores: JSON los codifica siempre como \\u00XX,
+# y en los datos del catálogo no aparecen al inicio de un string
+ORIGIN_MARKER = '\x1e'
+RESULTS_MARKER = '\x1f'
+ENCODED_ORIGIN_MARKER = b'"\\u001e'
+ENCODED_RESULTS_MARKER = b'"\\u001f"'
+
+DOCUMENTS_BATCH_SIZE = 500
+
+
+def request_origin(request):
+    """Esquema y host de la petición, tal como los antepone request.build_absolute_uri"""
+    return request.build_absolute_uri('/')[:-1]
+
+
+def document_uri(url):
+    """Equivalente a request.build_absolute_uri para guardar en el documento"""
+    if url.startswith('/') and not url.startswith('//'):
+        return ORIGIN_MARKER + url
+    return url
+
+
+def render_product_documents(queryset):
+    """Documentos de los productos del queryset, sin guardarlos; retorna {id: contenido}"""
+    items = render_product_rows(product_rows(queryset.order_by('pk')), absolute_uri=document_uri)
+    return {item['id']: render_json(item).decode('utf-8') for item in items}
+
+
+def build_product_documents(queryset, batch_size=DOCUMENTS_BATCH_SIZE):
+    """Genera y guarda (upsert) los documentos de los productos del queryset; retorna {id: contenido}"""
+    product_ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+    documents = {}
+    for start in range(0, len(product_ids), batch_size):
+        contents = render_product_documents(
+            queryset.model.objects.filter(pk__in=product_ids[start:start + batch_size])
+        )
+        ProductDocument.objects.bulk_create(
+            [ProductDocument(product_id=pk, content=content) for pk, content in contents.items()],
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=['content', 'updated_at'],
+        )
+        documents.update(contents)
+    return documents
+
+
+def document_rows(queryset, *extra):
+    """
+    values() con el documento de cada producto y las columnas que necesitan la
+    paginación (campo de orden y anotaciones como search_rank) y las etiquetas de cache.
+    """
+    order_by = queryset.query.order_by or queryset.model._meta.ordering
+    ordering = [term.lstrip('-') for term in order_by if isinstance(term, str)]
+    fields = ['id', 'category_id', 'subcategory_id', *ordering, *queryset.query.annotations, *extra]
+    return queryset.prefetch_related(None).values(*dict.fromkeys(fields), 'document__content')
+
+
+def load_documents(rows):
+    """
+    Contenidos de las filas (con 'id' y 'document__content') en su mismo orden. Los
+    productos sin documento (por ejemplo, anteriores a esta tabla) se generan al vuelo
+    en memoria: las lecturas no escriben, guardarlos queda a cargo de las señales y de
+    rebuild_product_documents.
+    """
+    missing = [row['id'] for row in rows if row['document__content'] is None]
+    built = render_product_documents(Product.objects.filter(pk__in=missing)) if missing else {}
+    return [row['document__content'] or built[row['id']] for row in rows]
+
+
+def splice_documents(envelope, contents, origin):
+    """
+    Codifica envelope (con RESULTS_MARKER en lugar de la lista de resultados) e inserta
+    los documentos guardados como lista de resultados, con el origen de la petición.
+    """
+    results = ('[' + ','.join(contents) + ']').encode('utf-8')
+    results = results.replace(ENCODED_ORIGIN_MARKER, b'"' + origin.encode('ascii'))
+    return render_json(envelope).replace(ENCODED_RESULTS_MARKER, results, 1)
+
+
+def _related_fragment(model, serializer_class, pk):
+    """Representación completa de una categoría o subcategoría, cacheada por versión del catálogo"""
+    def build():
+        return serializer_class(model.objects.get(pk=pk)).data
+    return get_or_set_catalog(f'{model._meta.model_name}-document:{pk}', build)
+
+
+def splice_detail(row, content, origin):
+    """
+    Documento de detalle: el de listados con la categoría y subcategoría completas en
+    lugar de las compactas. row debe incluir los slugs (document_rows(..., 'category__slug',
+    'subcategory__slug')).
+    """
+    document = content.encode('utf-8').replace(ENCODED_ORIGIN_MARKER, b'"' + origin.encode('ascii'))
+    for name, model, serializer_class in (
+        ('category', Category, CategorySerializer),
+        ('subcategory', Subcategory, SubcategorySerializer),
+    ):
+        pk = row[f'{name}_id']
+        if pk is None:
+            continue
+        key = f'"{name}":'.encode('ascii')
+        compact = render_json({'id': pk, 'slug': row[f'{name}__slug']})
+        full = render_json(_related_fragment(model, serializer_class, pk))
+        document = document.replace(key + compact, key + full, 1)
+    return document
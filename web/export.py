@@ -0,0 +1,69 @@
+"""
+Exportación completa del catálogo en NDJSON (un producto activo por línea).
+
+Los productos se leen con .iterator(chunk_size=...), que en PostgreSQL usa un cursor
+del lado del servidor, y cada línea es el documento precalculado del producto
+(web/documents.py), así que la memoria usada no depende del tamaño del catálogo.
+"""
+import zlib
+from itertools import islice
+
+from django.conf import settings
+
+from .documents import ENCODED_ORIGIN_MARKER, load_documents
+from .models import Product
+
+
+def export_product_lines(origin='', chunk_size=None):
+    """
+    Genera las líneas NDJSON (bytes) de todos los productos activos por orden de id.
+    origin (esquema y host) se antepone a las URLs relativas de las imágenes.
+    """
+    chunk_size = chunk_size or settings.PRODUCT_EXPORT_CHUNK_SIZE
+    origin = b'"' + origin.encode('ascii')
+    rows = Product.objects.filter(is_active=True).order_by('pk').values('id', 'document__content').iterator(
+        chunk_size=chunk_size
+    )
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield b''.join(
+            content.encode('utf-8').replace(ENCODED_ORIGIN_MARKER, origin) + b'\n'
+            for content in load_documents(chunk)
+        )
+
+
+def gzip_stream(chunks):
+    """Comprime un flujo de bytes en formato gzip sin acumularlo en memoria"""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Si la cabecera Accept-Encoding acepta gzip: gzip (o x-gzip) con q > 0, o sin
+    mencionarlo un * con q > 0. gzip;q=0 es un rechazo explícito.
+    """
+    qualities = {}
+    for part in accept_encoding.split(','):
+        coding, *params = [value.strip() for value in part.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        coding = coding.lower()
+        if coding:
+            qualities[coding] = max(quality, qualities.get(coding, 0.0))
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .cache import get_or_set_catalog
+from .models import Product
+
+
+# --- Listas materializadas de productos ---
+# Cada lista se guarda en cache como ids ordenados bajo la versión del catálogo,
+# así que se invalida con cualquier cambio de productos. Además expira a los
+# PRODUCT_LISTS_TIMEOUT segundos (novedades depende de la fecha) y puede
+# regenerarse periódicamente con el comando refresh_product_lists.
+
+
+def featured_products():
+    return Product.objects.filter(is_active=True, is_featured=True).order_by('name', 'pk')
+
+
+def on_sale_products():
+    # Índice parcial de ProductPrice con solo los productos en oferta
+    return Product.objects.filter(is_active=True, pricing__has_promotion=True).order_by('name', 'pk')
+
+
+def new_arrival_products():
+    since = timezone.now() - timedelta(days=settings.NEW_ARRIVALS_DAYS)
+    return Product.objects.filter(is_active=True, created_at__gte=since).order_by('-created_at', '-pk')
+
+
+PRODUCT_LISTS = {
+    'featured': featured_products,
+    'on-sale': on_sale_products,
+    'new-arrivals': new_arrival_products,
+}
+
+
+def get_product_list_ids(name, refresh=False):
+    """Retorna los ids ordenados de la lista (como máximo PRODUCT_LISTS_MAX_SIZE)"""
+    def build():
+        queryset = PRODUCT_LISTS[name]()
+        return list(queryset.values_list('pk', flat=True)[:settings.PRODUCT_LISTS_MAX_SIZE])
+
+    return get_or_set_catalog(
+        f'product-list:{name}', build, timeout=settings.PRODUCT_LISTS_TIMEOUT, refresh=refresh
+    )
+
+
+def refresh_product_lists():
+    """Regenera todas las listas y retorna el tamaño de cada una"""
+    return {name: len(get_product_list_ids(name, refresh=True)) for name in PRODUCT_LISTS}
@@ -0,0 +1,112 @@
+import random
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Sum
+from web.models import Category, Product, Cart, StockReservation, get_or_create_cart, upsert_cart_items
+from web.reservations import hold_cart_stock
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark stock reservations under contention: many threads add items to their own carts '
+        'for a few scarce products. Creates temporary products and carts and deletes them afterwards'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Concurrent database connections')
+        parser.add_argument('--carts', type=int, default=500, help='Carts (one reservation request each)')
+        parser.add_argument('--products', type=int, default=5, help='Contended products')
+        parser.add_argument('--stock', type=int, default=200, help='Stock of each product')
+        parser.add_argument('--max-quantity', type=int, default=3, help='Maximum units per product and cart')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the requested quantities')
+
+    def handle(self, *args, **options):
+        run_id = uuid.uuid4().hex[:8]
+        category = Category.objects.create(name=f'Benchmark reservas {run_id}')
+        products = [
+            Product.objects.create(
+                name=f'Benchmark {run_id} {i}', sku=f'BENCH-{run_id}-{i}', price=Decimal('1.00'),
+                stock=options['stock'], category=category,
+            )
+            for i in range(options['products'])
+        ]
+        product_ids = [product.pk for product in products]
+
+        rng = random.Random(options['seed'])
+        requests = [
+            {
+                product_id: rng.randint(1, options['max_quantity'])
+                for product_id in rng.sample(product_ids, rng.randint(1, len(product_ids)))
+            }
+            for _ in range(options['carts'])
+        ]
+
+        def reserve(index, quantities):
+            started = time.perf_counter()
+            try:
+                with transaction.atomic():
+                    cart, _ = get_or_create_cart(f'benchmark-{run_id}-{index}')
+                    upsert_cart_items(cart, quantities)
+                    hold_cart_stock(cart)
+                held = True
+            except ValidationError:
+                held = False
+            return held, time.perf_counter() - started
+
+        def worker(tasks):
+            # Una conexión por hilo durante toda la prueba
+            try:
+                return [reserve(index, quantities) for index, quantities in tasks]
+            finally:
+                connection.close()
+
+        tasks = list(enumerate(requests))
+        slices = [tasks[i::options['threads']] for i in range(options['threads'])]
+
+        self.stdout.write(
+            f'Reserving {options["products"]} products x {options["stock"]} units from '
+            f'{options["carts"]} carts with {options["threads"]} threads...'
+        )
+        try:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                results = [result for chunk in executor.map(worker, slices) for result in chunk]
+            elapsed = time.perf_counter() - started
+            self.report(results, elapsed, product_ids)
+        finally:
+            Cart.objects.filter(session_id__startswith=f'benchmark-{run_id}-').delete()
+            Product.objects.filter(pk__in=product_ids).delete()
+            category.delete()
+
+    def report(self, results, elapsed, product_ids):
+        latencies = sorted(latency * 1000 for _, latency in results)
+        held = sum(ok for ok, _ in results)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        self.stdout.write(f'Requests:   {len(results)} ({held} held, {len(results) - held} rejected for stock)')
+        self.stdout.write(f'Throughput: {len(results) / elapsed:.1f} requests/s')
+        self.stdout.write(
+            f'Latency ms: p50 {statistics.median(latencies):.2f}, p95 {percentile(0.95):.2f}, '
+            f'p99 {percentile(0.99):.2f}, max {latencies[-1]:.2f}'
+        )
+
+        # Invariantes: reserved es la suma de las reservas y nunca supera el stock
+        totals = dict(
+            StockReservation.objects.filter(product_id__in=product_ids)
+            .values_list('product_id').annotate(total=Sum('quantity'))
+        )
+        for product in Product.objects.filter(pk__in=product_ids).order_by('pk'):
+            self.stdout.write(f'  {product.sku}: {product.reserved}/{product.stock} reserved')
+            if product.reserved != totals.get(product.pk, 0) or product.reserved > product.stock:
+                raise CommandError(f'Inconsistent reservations for {product.sku}')
+
+        self.stdout.write(self.style.SUCCESS('Successfully benchmarked stock reservations!'))
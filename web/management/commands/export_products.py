@@ -0,0 +1,34 @@
+import gzip
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from web.export import export_product_lines
+
+
+class Command(BaseCommand):
+    help = 'Export every active product as NDJSON (one JSON document per line), optionally gzip-compressed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Output file path (compressed with gzip if it ends in .gz)')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip')
+        parser.add_argument(
+            '--chunk-size', type=int, default=settings.PRODUCT_EXPORT_CHUNK_SIZE,
+            help='Rows fetched per round trip from the server-side cursor'
+        )
+        parser.add_argument(
+            '--base-url', default='',
+            help='Scheme and host prepended to image URLs, e.g. https://example.com (relative URLs by default)'
+        )
+
+    def handle(self, *args, **options):
+        output = options['output']
+        compress = options['gzip'] or output.endswith('.gz')
+        self.stdout.write(f'Exporting products to {output}...')
+
+        lines = 0
+        with (gzip.open if compress else open)(output, 'wb') as file:
+            for chunk in export_product_lines(options['base_url'].rstrip('/'), options['chunk_size']):
+                file.write(chunk)
+                lines += chunk.count(b'\n')
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully exported {lines} products!'))
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from web.sync import prune_catalog_changes
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete catalog change log entries older than the retention period (run periodically, e.g. from cron). '
+        'Clients whose sync token predates the pruned entries get a 410 and must do a full resync'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.CATALOG_CHANGES_RETENTION_DAYS,
+            help='Keep entries from the last N days'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Pruning catalog changes older than {options["days"]} days...')
+
+        deleted = prune_catalog_changes(options['days'])
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully pruned {deleted} catalog changes!'))
@@ -0,0 +1,44 @@
+import gzip
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from web.purge import purge_carts
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete inactive and abandoned anonymous carts older than the retention period in chunks '
+        'ordered by primary key, optionally archiving them to gzip-compressed JSONL first'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.CART_RETENTION_DAYS,
+            help='Purge carts created (and without items added) more than this many days ago'
+        )
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Carts per chunk (one transaction each)')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Seconds to pause between chunks')
+        parser.add_argument('--archive', help='Write purged carts with their items to this .jsonl.gz file first')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the carts that would be purged')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        self.stdout.write(f'Purging carts older than {cutoff:%Y-%m-%d %H:%M}...')
+
+        archive = gzip.open(options['archive'], 'wt', encoding='utf-8') if options['archive'] else None
+        total_carts = total_items = 0
+        try:
+            for last_id, carts, items in purge_carts(
+                cutoff, options['chunk_size'], options['sleep'], archive, options['dry_run']
+            ):
+                total_carts += carts
+                total_items += items
+                self.stdout.write(f'  up to id {last_id}: {carts} carts, {items} items')
+        finally:
+            if archive is not None:
+                archive.close()
+
+        verb = 'Would purge' if options['dry_run'] else 'Successfully purged'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {total_carts} carts and {total_items} items!'))
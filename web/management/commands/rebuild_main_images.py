@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from web.models import Product, refresh_main_images
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized main image pointer of every product'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding product main images...')
+
+        refresh_main_images()
+
+        with_image = Product.objects.filter(main_image__isnull=False).count()
+        self.stdout.write(
+            self.style.SUCCESS(f'Successfully rebuilt main images! Products with image: {with_image}/{Product.objects.count()}')
+        )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from web.models import Category, Subcategory, refresh_products_count
+
+
+class Command(BaseCommand):
+    help = 'Rebuild active product counters for categories and subcategories'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding product counters...')
+
+        refresh_products_count()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Successfully rebuilt counters for {Category.objects.count()} categories '
+                f'and {Subcategory.objects.count()} subcategories!'
+            )
+        )
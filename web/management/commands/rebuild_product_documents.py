@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from web.models import ProductDocument, refresh_product_documents
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the precomputed JSON document of every product'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding product documents...')
+
+        refresh_product_documents()
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Successfully rebuilt {ProductDocument.objects.count()} product documents!')
+        )
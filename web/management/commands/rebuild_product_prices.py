@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from web.models import pricing_changed, refresh_product_prices
+
+
+class Command(BaseCommand):
+    help = 'Recompute the effective price of every product from its price rules'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding effective prices...')
+
+        changed = refresh_product_prices()
+        pricing_changed(changed)
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully updated {len(changed)} effective prices!'))
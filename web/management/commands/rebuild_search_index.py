@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from web.models import Product, refresh_search_vectors
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search vector of every product'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding product search vectors...')
+
+        refresh_search_vectors()
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Successfully rebuilt search vectors for {Product.objects.count()} products!')
+        )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from web.listings import refresh_product_lists
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the cached featured, on-sale and new-arrivals product lists (run periodically from cron)'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Refreshing product lists...')
+
+        for name, size in refresh_product_lists().items():
+            self.stdout.write(f'{name}: {size} products')
+
+        self.stdout.write(self.style.SUCCESS('Successfully refreshed product lists!'))
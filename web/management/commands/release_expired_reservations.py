@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from web.reservations import RELEASE_BATCH_SIZE, release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = 'Release expired cart stock reservations in bulk (run periodically, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=RELEASE_BATCH_SIZE,
+            help='Reservations released per statement'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Releasing expired stock reservations...')
+
+        released = release_expired_reservations(batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully released {released} reserved units!'))
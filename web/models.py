@@ -1,16 +1,48 @@
-from django.db import models
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Func, OuterRef, Prefetch, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce
 from django.template.defaultfilters import slugify
-from django.core.exceptions import ValidationError
+from django.utils import timezone
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from decimal import Decimal
+
+from .cache import (
+    bump_cart_pricing_version, bump_catalog_version, cart_summary_key, get_cached_cart_summary, get_discount_version,
+    invalidate_cart_summaries, invalidate_tags, set_cart_summary,
+)
 
 
 # --- Modelos de Categorías y Productos ---
 
 
+def exclude_from_full_save(instance, args, kwargs, *names):
+    """
+    Convierte el guardado completo de una instancia existente en uno con update_fields
+    que omite names: campos desnormalizados que se mantienen con UPDATE y que pudieron
+    cambiar desde que se cargó la instancia.
+    """
+    if (
+        not instance._state.adding and instance.pk is not None and not args
+        and kwargs.get('update_fields') is None and not kwargs.get('force_insert')
+        and not instance.get_deferred_fields()
+    ):
+        kwargs['update_fields'] = [
+            field.name for field in instance._meta.concrete_fields
+            if not field.primary_key and field.name not in names
+        ]
+
+
 class Category(models.Model):
     name = models.CharField(max_length=100, unique=True, verbose_name="Nombre")
     slug = models.SlugField(max_length=100, unique=True, blank=True, verbose_name="Slug")
     is_active = models.BooleanField(default=True, verbose_name="Activo")
     order = models.PositiveIntegerField(default=0, verbose_name="Orden")
+    products_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Productos activos")
+    # Validaciones HTTP del catálogo (ver catalog_validators)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Fecha de actualización")
     
     class Meta:
         ordering = ['order', 'name']
@@ -19,21 +51,19 @@ class Category(models.Model):
         indexes = [
             models.Index(fields=['is_active', 'order']),
             models.Index(fields=['slug']),
+            models.Index(fields=['updated_at']),
         ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
+        # products_count lo mantiene refresh_products_count
+        exclude_from_full_save(self, args, kwargs, 'products_count')
         super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
 
-    class Meta:
-        ordering = ['order', 'name']
-        verbose_name = 'Categoría'
-        verbose_name_plural = 'Categorías'
-
 
 class Subcategory(models.Model):
     name = models.CharField(max_length=100, verbose_name="Nombre")
@@ -41,10 +71,21 @@ class Subcategory(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='subcategories', verbose_name="Categoría")
     is_active = models.BooleanField(default=True, verbose_name="Activo")
     order = models.PositiveIntegerField(default=0, verbose_name="Orden")
+    products_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Productos activos")
+    # Validaciones HTTP del catálogo (ver catalog_validators)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Fecha de actualización")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Categoría original: si la subcategoría se mueve, la anterior también deja de anidarla
+        instance._loaded_category_id = instance.__dict__.get('category_id')
+        return instance
 
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
+        exclude_from_full_save(self, args, kwargs, 'products_count')
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -57,15 +98,207 @@ class Subcategory(models.Model):
         indexes = [
             models.Index(fields=['category', 'is_active', 'order']),
             models.Index(fields=['slug']),
+            models.Index(fields=['updated_at']),
         ]
 
 
+def refresh_products_count(category_ids=None, subcategory_ids=None):
+    """
+    Recalcula los contadores de productos activos de las categorías y subcategorías indicadas.
+    Con None se recalculan todas; con una colección vacía no se hace nada.
+    """
+    def _refresh(model, fk, ids):
+        if ids is not None:
+            ids = {pk for pk in ids if pk is not None}
+            if not ids:
+                return
+        active_count = Product.objects.filter(
+            **{fk: OuterRef('pk')}, is_active=True
+        ).order_by().values(fk).annotate(total=Count('pk')).values('total')
+        queryset = model.objects.all()
+        if ids is not None:
+            queryset = queryset.filter(pk__in=ids)
+        queryset.update(products_count=Coalesce(Subquery(active_count), 0))
+        # El contador forma parte de la representación que recibe la sincronización
+        log_catalog_changes(model, ids if ids is not None else queryset.values_list('pk', flat=True))
+
+    _refresh(Category, 'category', category_ids)
+    _refresh(Subcategory, 'subcategory', subcategory_ids)
+
+    if category_ids is None or subcategory_ids is None:
+        invalidate_tags('catalog')
+    else:
+        invalidate_tags(
+            *(f'category:{pk}' for pk in category_ids if pk is not None),
+            *(f'subcategory:{pk}' for pk in subcategory_ids if pk is not None),
+        )
+
+
+def product_search_vector():
+    """
+    Expresión del vector de búsqueda de Product: nombre y SKU (A), nombres de
+    categoría y subcategoría (B) y descripción (C).
+    """
+    config = settings.SEARCH_CONFIG
+    category_name = Category.objects.filter(pk=OuterRef('category_id')).values('name')[:1]
+    subcategory_name = Subcategory.objects.filter(pk=OuterRef('subcategory_id')).values('name')[:1]
+    return (
+        SearchVector('name', 'sku', weight='A', config=config)
+        + SearchVector(Subquery(category_name), Subquery(subcategory_name), weight='B', config=config)
+        + SearchVector('description', weight='C', config=config)
+    )
+
+
+def refresh_search_vectors(product_ids=None, category_ids=None, subcategory_ids=None):
+    """
+    Recalcula Product.search_vector de los productos indicados o de los de las
+    categorías/subcategorías indicadas. Sin argumentos se recalculan todos.
+    """
+    queryset = Product.objects.all()
+    if product_ids is not None or category_ids is not None or subcategory_ids is not None:
+        condition = models.Q(pk__in=product_ids or [])
+        condition |= models.Q(category__in=category_ids or [])
+        condition |= models.Q(subcategory__in=subcategory_ids or [])
+        queryset = queryset.filter(condition)
+    # El vector es un dato derivado: update() base, sin mover updated_at ni regenerar documentos
+    models.QuerySet.update(queryset, search_vector=product_search_vector())
+
+
+# Stock a partir del cual (inclusive) un producto se considera con stock bajo
+LOW_STOCK_LIMIT = 5
+
+
+def stock_status_label(stock):
+    """Estado del stock para una cantidad (Product.stock_status y la ruta rápida de la API)"""
+    if stock == 0:
+        return "Sin stock"
+    elif stock <= LOW_STOCK_LIMIT:
+        return "Stock bajo"
+    else:
+        return "En stock"
+
+# Campos de Product que afectan a los contadores de categorías y subcategorías
+COUNTER_FIELDS = {'category', 'category_id', 'subcategory', 'subcategory_id', 'is_active'}
+
+# Campos de Product que forman parte del vector de búsqueda
+SEARCH_FIELDS = {'name', 'description', 'sku', 'category', 'category_id', 'subcategory', 'subcategory_id'}
+
+# Campos (attname) de Product que deciden si aparece en un listado, en qué orden y en qué facetas
+LIST_FIELDS = {
+    'name', 'description', 'sku', 'price', 'stock', 'is_active', 'is_featured',
+    'category_id', 'subcategory_id', 'created_at',
+}
+
+
+class ProductQuerySet(models.QuerySet):
+    """QuerySet que mantiene contadores y vectores de búsqueda en operaciones masivas"""
+
+    def _counter_keys(self):
+        keys = self.order_by().values_list('category_id', 'subcategory_id').distinct()
+        category_ids = {category_id for category_id, _ in keys}
+        subcategory_ids = {subcategory_id for _, subcategory_id in keys}
+        return category_ids, subcategory_ids
+
+    def update(self, **kwargs):
+        # auto_now no se aplica en update(); mantener updated_at para las validaciones HTTP
+        kwargs.setdefault('updated_at', timezone.now())
+        update_counters = bool(COUNTER_FIELDS.intersection(kwargs))
+        update_search = bool(SEARCH_FIELDS.intersection(kwargs))
+        if 'price' in kwargs:
+            bump_cart_pricing_version()
+
+        with transaction.atomic(using=self.db):
+            # Se leen antes de actualizar porque el filtro puede dejar de coincidir después
+            product_ids = list(self.order_by().values_list('pk', flat=True))
+            if update_counters:
+                category_ids, subcategory_ids = self._counter_keys()
+
+            rows = super().update(**kwargs)
+
+            if update_counters:
+                for field, ids in (('category', category_ids), ('subcategory', subcategory_ids)):
+                    value = kwargs.get(field, kwargs.get(f'{field}_id'))
+                    if isinstance(value, models.Model):
+                        value = value.pk
+                    if isinstance(value, (int, str)):
+                        ids.add(value)
+                    elif value is not None:
+                        # Expresiones (F(), Subquery...): no se conoce el destino, recalcular todo
+                        category_ids = subcategory_ids = None
+                        break
+                refresh_products_count(category_ids, subcategory_ids)
+            if update_search and product_ids:
+                refresh_search_vectors(product_ids)
+            if 'price' in kwargs and product_ids:
+                refresh_product_prices(product_ids)
+            if product_ids:
+                refresh_product_documents(product_ids)
+                log_catalog_changes(Product, product_ids)
+            products_changed(product_ids)
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        refresh_products_count(
+            {obj.category_id for obj in objs},
+            {obj.subcategory_id for obj in objs},
+        )
+        product_ids = [obj.pk for obj in objs if obj.pk is not None]
+        if product_ids:
+            refresh_search_vectors(product_ids)
+            refresh_product_prices(product_ids)
+            refresh_product_documents(product_ids)
+            log_catalog_changes(Product, product_ids)
+        products_changed(product_ids)
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        product_ids = [obj.pk for obj in objs]
+        update_counters = bool(COUNTER_FIELDS.intersection(fields))
+        update_search = bool(SEARCH_FIELDS.intersection(fields))
+        if 'price' in fields:
+            bump_cart_pricing_version()
+
+        with transaction.atomic(using=self.db):
+            if update_counters:
+                category_ids, subcategory_ids = self.filter(pk__in=product_ids)._counter_keys()
+            rows = super().bulk_update(objs, fields, *args, **kwargs)
+            if update_counters:
+                category_ids.update(obj.category_id for obj in objs)
+                subcategory_ids.update(obj.subcategory_id for obj in objs)
+                refresh_products_count(category_ids, subcategory_ids)
+            if update_search:
+                refresh_search_vectors(product_ids)
+            if 'price' in fields:
+                refresh_product_prices(product_ids)
+            refresh_product_documents(product_ids)
+            log_catalog_changes(Product, product_ids)
+            products_changed(product_ids)
+        return rows
+
+
+def products_changed(product_ids, list_changed=True):
+    """
+    Invalida las caches del catálogo que dependen de estos productos: la versión del
+    catálogo y las respuestas etiquetadas con cada producto (y con los listados si
+    list_changed, es decir si pudo cambiar qué productos aparecen o en qué orden).
+    """
+    bump_catalog_version()
+    invalidate_tags(
+        'product-list' if list_changed else None,
+        *(f'product:{pk}' for pk in product_ids),
+    )
+
+
 class Product(models.Model):
     name = models.CharField(max_length=100, verbose_name="Nombre")
     slug = models.SlugField(max_length=100, unique=True, blank=True, verbose_name="Slug")
     description = models.TextField(blank=True, null=True, verbose_name="Descripción")
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Precio")
     stock = models.PositiveIntegerField(default=0, verbose_name="Stock")
+    # Unidades retenidas por carritos; solo cambia con UPDATE condicionales (ver web/reservations.py)
+    reserved = models.PositiveIntegerField(default=0, editable=False, verbose_name="Reservado")
     sku = models.CharField(max_length=50, unique=True, blank=True, null=True, verbose_name="SKU")
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="products", verbose_name="Categoría")
     subcategory = models.ForeignKey(Subcategory, on_delete=models.CASCADE, related_name="products", null=True, blank=True, verbose_name="Subcategoría")
@@ -73,11 +306,46 @@ class Product(models.Model):
     is_featured = models.BooleanField(default=False, verbose_name="Destacado")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de creación")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Fecha de actualización")
+    # Puntero desnormalizado mantenido por ProductImage (ver refresh_main_images)
+    main_image = models.ForeignKey(
+        'ProductImage', on_delete=models.SET_NULL, related_name='+', null=True, blank=True,
+        editable=False, verbose_name="Imagen principal"
+    )
+    # Vector de búsqueda desnormalizado (ver refresh_search_vectors)
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Valores originales para detectar cambios que afectan a los contadores
+        instance._counter_state = instance.counter_state()
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def changed_fields(self):
+        """Campos (attname) cuyo valor difiere del cargado de la base de datos"""
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            return {field.attname for field in self._meta.concrete_fields}
+        return {name for name, value in loaded.items() if self.__dict__.get(name, value) != value}
+
+    def counter_state(self):
+        """Retorna (category_id, subcategory_id, is_active) tal como están cargados"""
+        return (
+            self.__dict__.get('category_id'),
+            self.__dict__.get('subcategory_id'),
+            self.__dict__.get('is_active'),
+        )
 
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
+        # reserved lo mantienen las reservas de stock (ver web/reservations.py)
+        exclude_from_full_save(self, args, kwargs, 'reserved')
         super().save(*args, **kwargs)
+        self._loaded_values = {field.attname: self.__dict__.get(field.attname) for field in self._meta.concrete_fields}
 
     def __str__(self):
         return self.name
@@ -87,32 +355,48 @@ class Product(models.Model):
         """Verifica si el producto tiene stock disponible"""
         return self.stock > 0
     
+    @property
+    def current_price(self):
+        """Precio efectivo (con el descuento de sus reglas de precio, ver ProductPrice)"""
+        pricing = self.get_pricing()
+        return pricing.price if pricing is not None else self.price
+    
+    @property
+    def has_promotion(self):
+        pricing = self.get_pricing()
+        return pricing is not None and pricing.has_promotion
+    
+    def get_pricing(self):
+        """Fila de ProductPrice (usar select_related('pricing') para no consultarla por producto)"""
+        try:
+            return self.pricing
+        except ObjectDoesNotExist:
+            return None
+    
+    @property
+    def available_stock(self):
+        """Stock no reservado por carritos"""
+        return max(self.stock - self.reserved, 0)
+    
     @property
     def stock_status(self):
         """Retorna el estado del stock"""
-        if self.stock == 0:
-            return "Sin stock"
-        elif self.stock <= 5:
-            return "Stock bajo"
-        else:
-            return "En stock"
+        return stock_status_label(self.stock)
     
-    @property
-    def main_image(self):
-        """Retorna la imagen principal del producto"""
-        # Cache local para evitar múltiples queries
-        if not hasattr(self, '_main_image_cache'):
-            main_image = self.images.filter(is_main=True).first()
-            if not main_image:
-                # Si no hay imagen principal, tomar la primera disponible
-                main_image = self.images.first()
-            self._main_image_cache = main_image
-        return self._main_image_cache
+    def get_main_image(self):
+        """Retorna la imagen principal del producto o, si no hay, la primera disponible"""
+        # Si la vista ya hizo prefetch_related('images') no se lanza ninguna query
+        prefetched = getattr(self, '_prefetched_objects_cache', {}).get('images')
+        if prefetched is not None:
+            images = list(prefetched)
+            return next((image for image in images if image.is_main), images[0] if images else None)
+        # Sin prefetch se usa el puntero desnormalizado (sin query con select_related('main_image'))
+        return self.main_image
     
     def clear_cache(self):
         """Limpia el cache local del producto"""
-        if hasattr(self, '_main_image_cache'):
-            delattr(self, '_main_image_cache')
+        self._state.fields_cache.pop('main_image', None)
+        getattr(self, '_prefetched_objects_cache', {}).pop('images', None)
 
     class Meta:
         ordering = ['name']
@@ -124,6 +408,16 @@ class Product(models.Model):
             models.Index(fields=['subcategory', 'is_active']),
             models.Index(fields=['slug']),
             models.Index(fields=['sku']),
+            # Validaciones HTTP (Max(updated_at)) y sincronización por fecha de cambio
+            models.Index(fields=['updated_at']),
+            # Paginación keyset: (orden, id) para cada ordenamiento permitido en la API
+            models.Index(fields=['is_active', 'name', 'id']),
+            models.Index(fields=['is_active', 'price', 'id']),
+            models.Index(fields=['is_active', 'created_at', 'id']),
+            GinIndex(fields=['search_vector'], name='web_product_search_gin'),
+            # Índices trigram (pg_trgm) para tolerar errores de escritura y búsquedas parciales
+            GinIndex(fields=['name'], name='web_product_name_trgm', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['sku'], name='web_product_sku_trgm', opclasses=['gin_trgm_ops']),
         ]
 
 
@@ -140,6 +434,7 @@ class ProductImage(models.Model):
         if self.is_main:
             ProductImage.objects.filter(product=self.product, is_main=True).update(is_main=False)
         super().save(*args, **kwargs)
+        refresh_main_images([self.product_id])
 
     def __str__(self):
         return f"Imagen de {self.product.name}"
@@ -154,12 +449,188 @@ class ProductImage(models.Model):
         ]
 
 
+def refresh_main_images(product_ids=None):
+    """
+    Recalcula Product.main_image (la imagen principal o la primera por orden) en una sola UPDATE.
+    Con None se recalculan todos los productos.
+    """
+    main_image = ProductImage.objects.filter(product=OuterRef('pk')).order_by(
+        '-is_main', 'order', 'created_at', 'pk'
+    ).values('pk')[:1]
+    queryset = Product.objects.all()
+    if product_ids is not None:
+        queryset = queryset.filter(pk__in=product_ids)
+    queryset.update(main_image=Subquery(main_image))
+
+
+class ProductDocument(models.Model):
+    """
+    Representación JSON precalculada de un producto (la de los listados), que las
+    vistas concatenan en lugar de serializar. Se regenera al cambiar el producto,
+    sus imágenes, su categoría o su subcategoría (ver web/documents.py).
+    """
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True, related_name='document', verbose_name="Producto"
+    )
+    content = models.TextField(verbose_name="Contenido JSON")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Fecha de actualización")
+
+    def __str__(self):
+        return f"Documento de {self.product_id}"
+
+    class Meta:
+        verbose_name = 'Documento de producto'
+        verbose_name_plural = 'Documentos de productos'
+
+
+def refresh_product_documents(product_ids=None, category_ids=None, subcategory_ids=None):
+    """
+    Regenera los documentos de los productos indicados por id, categoría o subcategoría.
+    Con todos los argumentos en None se regeneran todos los productos.
+    """
+    # Import diferido: la construcción usa los conversores de la API, que importan los modelos
+    from .documents import build_product_documents
+
+    queryset = Product.objects.all()
+    if product_ids is not None or category_ids is not None or subcategory_ids is not None:
+        condition = models.Q(pk__in=product_ids or [])
+        condition |= models.Q(category__in=category_ids or [])
+        condition |= models.Q(subcategory__in=subcategory_ids or [])
+        queryset = queryset.filter(condition)
+    build_product_documents(queryset)
+
+
+class ProductPrice(models.Model):
+    """
+    Precio efectivo precalculado de cada producto: el precio de lista con el mayor
+    descuento de sus reglas activas (PriceRule). Se recalcula al cambiar el precio o
+    las reglas y sus promociones (ver refresh_product_prices).
+    """
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True, related_name='pricing', verbose_name="Producto"
+    )
+    price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Precio efectivo")
+    has_promotion = models.BooleanField(default=False, verbose_name="En oferta")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Fecha de actualización")
+
+    def __str__(self):
+        return f"Precio de {self.product_id}: {self.price}"
+
+    class Meta:
+        verbose_name = 'Precio efectivo'
+        verbose_name_plural = 'Precios efectivos'
+        indexes = [
+            # Productos en oferta: índice parcial solo con las filas con promoción
+            models.Index(fields=['product'], condition=models.Q(has_promotion=True), name='web_productprice_on_sale'),
+            models.Index(fields=['updated_at']),
+        ]
+
+
+def refresh_product_prices(product_ids=None, promotion_ids=None):
+    """
+    Recalcula en una sola sentencia los precios efectivos de los productos indicados
+    por id o por promoción de sus reglas (todos si ambos son None). Retorna los ids
+    cuyo precio efectivo cambió; regenerar sus documentos queda a cargo del llamador
+    (ver pricing_changed).
+    """
+    params = {'now': timezone.now()}
+    conditions = []
+    if product_ids is not None:
+        conditions.append('product.id = ANY(%(products)s)')
+        params['products'] = list(product_ids)
+    if promotion_ids is not None:
+        conditions.append(
+            f'product.id IN (SELECT product_id FROM {PriceRule._meta.db_table} WHERE promotion_id = ANY(%(promotions)s))'
+        )
+        params['promotions'] = list(promotion_ids)
+    if conditions and not any(params.get(key) for key in ('products', 'promotions')):
+        return []
+
+    price_table = ProductPrice._meta.db_table
+    sql = f"""
+        INSERT INTO {price_table} (product_id, price, has_promotion, updated_at)
+        SELECT product.id, ROUND(product.price * (100 - COALESCE(best.percentage, 0)) / 100, 2),
+               COALESCE(best.percentage, 0) > 0, %(now)s
+        FROM {Product._meta.db_table} product
+        LEFT JOIN LATERAL (
+            SELECT LEAST(GREATEST(MAX(COALESCE(promotion.discount, rule.percentage)), 0), 100) AS percentage
+            FROM {PriceRule._meta.db_table} rule
+            LEFT JOIN {Promotion._meta.db_table} promotion ON promotion.id = rule.promotion_id
+            WHERE rule.product_id = product.id AND rule.is_active AND (promotion.id IS NULL OR promotion.is_active)
+        ) best ON TRUE
+        WHERE {' OR '.join(conditions) or 'TRUE'}
+        ON CONFLICT (product_id) DO UPDATE
+        SET price = EXCLUDED.price, has_promotion = EXCLUDED.has_promotion, updated_at = EXCLUDED.updated_at
+        WHERE ({price_table}.price, {price_table}.has_promotion) IS DISTINCT FROM (EXCLUDED.price, EXCLUDED.has_promotion)
+        RETURNING product_id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [product_id for product_id, in cursor.fetchall()]
+
+
+def pricing_changed(product_ids):
+    """Propaga un cambio de precios efectivos: documentos, registro de cambios y caches"""
+    if not product_ids:
+        return
+    refresh_product_documents(product_ids)
+    log_catalog_changes(Product, product_ids)
+    products_changed(product_ids)
+    bump_cart_pricing_version()
+
+
+class CatalogChange(models.Model):
+    """
+    Registro de altas, cambios y bajas del catálogo para la sincronización incremental
+    (/api/products/changes/). Los registros se ordenan por (txid, id), donde txid es
+    la transacción que los insertó; el token de sincronización es esa posición (ver
+    web/sync.py).
+    """
+    # Tipo del registro que marca hasta dónde se purgó el registro (ver prune_catalog_changes)
+    PRUNED = 'pruned'
+
+    kind = models.CharField(max_length=20, verbose_name="Tipo")  # model_name del objeto
+    object_id = models.BigIntegerField(verbose_name="ID del objeto")
+    deleted = models.BooleanField(default=False, verbose_name="Eliminado")
+    # pg_current_xact_id() es xid8, sin conversión directa a bigint
+    txid = models.BigIntegerField(
+        db_default=Cast(
+            Cast(Func(function='pg_current_xact_id', output_field=models.TextField()), models.TextField()),
+            models.BigIntegerField(),
+        ),
+        editable=False, verbose_name="Transacción",
+    )
+    created_at = models.DateTimeField(default=timezone.now, verbose_name="Fecha")
+
+    def __str__(self):
+        return f"{self.kind}:{self.object_id}{' (eliminado)' if self.deleted else ''}"
+
+    class Meta:
+        ordering = ['txid', 'id']
+        verbose_name = 'Cambio del catálogo'
+        verbose_name_plural = 'Cambios del catálogo'
+        indexes = [
+            models.Index(fields=['txid', 'id']),
+            models.Index(fields=['created_at']),
+        ]
+
+
+def log_catalog_changes(model, object_ids, deleted=False):
+    """Registra un cambio (o baja si deleted) de cada objeto de model en el registro de sincronización"""
+    object_ids = {pk for pk in object_ids if pk is not None}
+    CatalogChange.objects.bulk_create([
+        CatalogChange(kind=model._meta.model_name, object_id=pk, deleted=deleted) for pk in sorted(object_ids)
+    ])
+
+
 # --- Modelo de Promociones y control de uso ---
 class Promotion(models.Model):
     name = models.CharField(max_length=100, verbose_name="Nombre de la promoción")
     slug = models.SlugField(max_length=100, unique=True, blank=True, verbose_name="Slug")
     discount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Descuento (%)")  # Descuento en porcentaje
     is_active = models.BooleanField(default=True, verbose_name="Activo")
+    # Validaciones HTTP del catálogo (ver catalog_validators)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Fecha de actualización")
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -173,6 +644,7 @@ class Promotion(models.Model):
         indexes = [
             models.Index(fields=['is_active']),
             models.Index(fields=['slug']),
+            models.Index(fields=['updated_at']),
         ]
 
 
@@ -181,6 +653,10 @@ class UsedPromotion(models.Model):
     promotion = models.ForeignKey(Promotion, on_delete=models.CASCADE, verbose_name="Promoción")
     cart = models.ForeignKey('Cart', on_delete=models.CASCADE, verbose_name="Carrito")
     applied_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de uso")
+    cart_total = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name="Total del carrito")
+    discount_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name="Descuento aplicado")
+    # Clave enviada por el cliente: un reintento con la misma clave devuelve este canje
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, verbose_name="Clave de idempotencia")
 
     def __str__(self):
         return f"Promoción {self.promotion.name} usada por {self.subscriber.phone} en el carrito {self.cart.session_id}"
@@ -193,7 +669,113 @@ class UsedPromotion(models.Model):
         ]
 
 
+class PromotionRedemption(models.Model):
+    """
+    Registro de auditoría de cada intento de canje de una promoción (también los
+    reintentos y los rechazos). Guarda el session_id y no el carrito, así el registro
+    sobrevive a la purga de carritos.
+    """
+    REDEEMED = 'redeemed'
+    REPLAYED = 'replayed'
+    REJECTED = 'rejected'
+    OUTCOME_CHOICES = [
+        (REDEEMED, 'Canjeada'),
+        (REPLAYED, 'Reintento'),
+        (REJECTED, 'Rechazada'),
+    ]
+
+    subscriber = models.ForeignKey(
+        'Subscriber', on_delete=models.CASCADE, related_name="promotion_redemptions", verbose_name="Suscriptor"
+    )
+    promotion = models.ForeignKey(
+        Promotion, on_delete=models.CASCADE, related_name="redemptions", verbose_name="Promoción"
+    )
+    session_id = models.CharField(max_length=100, verbose_name="ID de sesión")
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, verbose_name="Clave de idempotencia")
+    outcome = models.CharField(max_length=10, choices=OUTCOME_CHOICES, verbose_name="Resultado")
+    cart_total = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True, verbose_name="Total del carrito")
+    discount_amount = models.DecimalField(
+        max_digits=12, decimal_places=2, null=True, blank=True, verbose_name="Descuento aplicado"
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha")
+
+    def __str__(self):
+        return f"{self.promotion} - {self.subscriber} ({self.get_outcome_display()})"
+
+    class Meta:
+        verbose_name = 'Canje de promoción'
+        verbose_name_plural = 'Canjes de promociones'
+        indexes = [
+            models.Index(fields=['promotion', 'created_at']),
+            models.Index(fields=['subscriber', 'created_at']),
+        ]
+
+
+class PriceRule(models.Model):
+    """
+    Descuento por producto: el de la promoción si tiene una (y mientras esté activa)
+    o el porcentaje propio. Con varias reglas activas se aplica el mayor descuento.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="price_rules", verbose_name="Producto")
+    promotion = models.ForeignKey(
+        Promotion, on_delete=models.CASCADE, null=True, blank=True, related_name="price_rules", verbose_name="Promoción"
+    )
+    percentage = models.DecimalField(
+        max_digits=5, decimal_places=2, null=True, blank=True, verbose_name="Descuento (%)"
+    )
+    is_active = models.BooleanField(default=True, verbose_name="Activo")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de creación")
+
+    def clean(self):
+        if self.promotion_id is None and self.percentage is None:
+            raise ValidationError('Indica una promoción o un porcentaje de descuento')
+
+    def __str__(self):
+        discount = self.promotion.name if self.promotion_id else f'{self.percentage}%'
+        return f"{self.product} - {discount}"
+
+    class Meta:
+        verbose_name = 'Regla de precio'
+        verbose_name_plural = 'Reglas de precio'
+        indexes = [
+            models.Index(fields=['product', 'is_active']),
+            models.Index(fields=['promotion']),
+        ]
+
+
 # --- Modelo de Suscriptores ---
+class SubscriberQuerySet(models.QuerySet):
+    def with_cart_stats(self):
+        """
+        Anota carts_count y, del primer carrito activo, active_cart_id, active_cart_total
+        (a precios efectivos) y active_cart_items_count con subconsultas en la misma
+        consulta, y prefetchea solo ese carrito en active_carts. Subscriber.total_carts y
+        Subscriber.get_active_cart() usan estas anotaciones cuando están presentes.
+        """
+        amount_field = models.DecimalField(max_digits=14, decimal_places=2)
+        carts = Cart.objects.filter(subscriber=OuterRef('pk')).order_by()
+        first_active = Cart.objects.filter(
+            subscriber=OuterRef('subscriber'), is_active=True
+        ).order_by('pk').values('pk')[:1]
+        items = CartItem.objects.filter(cart_id=OuterRef('active_cart_id')).order_by().values('cart_id')
+        price = Coalesce(F('product__pricing__price'), F('product__price'))
+        return self.annotate(
+            carts_count=Coalesce(Subquery(carts.values('subscriber').annotate(count=Count('pk')).values('count')), 0),
+            active_cart_id=Subquery(carts.filter(is_active=True).order_by('pk').values('pk')[:1]),
+        ).annotate(
+            active_cart_total=Coalesce(
+                Subquery(items.annotate(
+                    total=Sum(price * F('quantity'), output_field=amount_field)
+                ).values('total')),
+                Value(0),
+                output_field=amount_field,
+            ),
+            active_cart_items_count=Coalesce(Subquery(items.annotate(count=Count('pk')).values('count')), 0),
+        ).prefetch_related(
+            Prefetch('carts', queryset=Cart.objects.filter(pk=Subquery(first_active)), to_attr='active_carts')
+        )
+
+
 class Subscriber(models.Model):
     phone = models.CharField(max_length=20, unique=True, verbose_name="Teléfono")  # Teléfono de WhatsApp
     email = models.EmailField(verbose_name="Correo electrónico")
@@ -202,6 +784,8 @@ class Subscriber(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de creación")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Fecha de actualización")
 
+    objects = SubscriberQuerySet.as_manager()
+
     def __str__(self):
         return f"Suscriptor {self.phone}"
 
@@ -212,8 +796,22 @@ class Subscriber(models.Model):
     @property
     def total_carts(self):
         """Retorna el total de carritos del suscriptor"""
+        # Anotado por Subscriber.objects.with_cart_stats(): sin consultas adicionales
+        if hasattr(self, 'carts_count'):
+            return self.carts_count
         return self.carts.count()
     
+    def get_active_cart(self):
+        """Primer carrito activo (o None) con su total y cantidad de items ya calculados"""
+        if hasattr(self, 'active_carts'):
+            if not self.active_carts:
+                return None
+            cart = self.active_carts[0]
+            cart.total_amount = self.active_cart_total
+            cart.items_count = self.active_cart_items_count
+            return cart
+        return self.carts.with_totals().filter(is_active=True).order_by('pk').first()
+    
     @property
     def subscription_status(self):
         """Retorna el estado de la suscripción"""
@@ -230,35 +828,88 @@ class Subscriber(models.Model):
 
 
 # --- Modelo de Carrito y Carrito de Productos ---
+class CartQuerySet(models.QuerySet):
+    def with_totals(self):
+        """
+        Anota total_amount (suma de precio efectivo por cantidad de los items) e items_count
+        (líneas del carrito) en la misma consulta. Cart.total() y Cart.get_items_count()
+        usan estas anotaciones cuando están presentes.
+        """
+        amount_field = models.DecimalField(max_digits=14, decimal_places=2)
+        price = Coalesce(F('items__product__pricing__price'), F('items__product__price'))
+        return self.annotate(
+            total_amount=Coalesce(
+                Sum(price * F('items__quantity'), output_field=amount_field),
+                Value(0),
+                output_field=amount_field,
+            ),
+            items_count=Count('items'),
+        )
+
+
 class Cart(models.Model):
     session_id = models.CharField(max_length=100, unique=True, verbose_name="ID de Sesión")  # Identificador único para carritos anónimos
     subscriber = models.ForeignKey(Subscriber, on_delete=models.CASCADE, related_name="carts", null=True, blank=True, verbose_name="Suscriptor")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de creación")
     is_active = models.BooleanField(default=True, verbose_name="Activo")
     
+    objects = CartQuerySet.as_manager()
+    
     def __str__(self):
         return f"Carrito {self.session_id}"
 
     def total(self):
-        """Calcula el total del carrito"""
+        """Calcula el total del carrito a precios efectivos"""
+        # Anotado por Cart.objects.with_totals(): sin consultas adicionales
+        if hasattr(self, 'total_amount'):
+            return self.total_amount
         # Cache local para evitar múltiples cálculos
         if not hasattr(self, '_total_cache'):
-            self._total_cache = sum(item.subtotal() for item in self.items.all())
+            prefetched = getattr(self, '_prefetched_objects_cache', {}).get('items')
+            if prefetched is not None:
+                self._total_cache = sum((item.subtotal() for item in prefetched), Decimal(0))
+            else:
+                # Una sola consulta agregada en lugar de recorrer los items
+                self._total_cache = Cart.objects.filter(pk=self.pk).with_totals().values_list(
+                    'total_amount', flat=True
+                ).get()
         return self._total_cache
+    
+    def get_discount_amount(self, rate):
+        """Monto que descuenta la tasa rate (por ejemplo 0.10) sobre el total"""
+        return (self.total() * Decimal(rate)).quantize(Decimal('0.01'))
+    
+    def apply_subscriber_discount(self, rate):
+        """Total con la tasa de descuento del suscriptor aplicada"""
+        return self.total() - self.get_discount_amount(rate)
+    
+    def get_items_count(self):
+        """Cantidad de líneas del carrito (anotada, prefetcheada o con un COUNT)"""
+        if hasattr(self, 'items_count'):
+            return self.items_count
+        prefetched = getattr(self, '_prefetched_objects_cache', {}).get('items')
+        if prefetched is not None:
+            return len(prefetched)
+        return self.items.count()
 
     def is_empty(self):
         """Verifica si el carrito está vacío"""
         # Cache local para evitar múltiples queries
         if not hasattr(self, '_is_empty_cache'):
-            self._is_empty_cache = self.items.count() == 0
+            self._is_empty_cache = self.get_items_count() == 0
         return self._is_empty_cache
     
     def clear_cache(self):
-        """Limpia el cache local del carrito"""
+        """Limpia el cache local del carrito y su resumen compartido"""
+        invalidate_cart_summaries(self.session_id)
         if hasattr(self, '_total_cache'):
             delattr(self, '_total_cache')
         if hasattr(self, '_is_empty_cache'):
             delattr(self, '_is_empty_cache')
+        # Las anotaciones de with_totals() y los items prefetcheados también quedan desactualizados
+        self.__dict__.pop('total_amount', None)
+        self.__dict__.pop('items_count', None)
+        getattr(self, '_prefetched_objects_cache', {}).pop('items', None)
     
     class Meta:
         indexes = [
@@ -275,35 +926,40 @@ class CartItem(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de creación")
 
     def subtotal(self):
-        return self.product.price * self.quantity
+        return self.product.current_price * self.quantity
     
     def clean(self):
-        """Validar que no se exceda el stock disponible"""
-        if self.quantity > self.product.stock:
-            raise ValidationError(f'No hay suficiente stock. Disponible: {self.product.stock}')
+        """
+        Validar que no se exceda el stock disponible: stock - reserved, como en
+        hold_cart_stock, más lo que este carrito ya tiene reservado del producto
+        """
+        stock = Product.objects.filter(pk=self.product_id).values_list('stock', 'reserved').first()
+        if stock is None:
+            raise ValidationError('El producto no existe')
+        held = StockReservation.objects.filter(
+            cart_id=self.cart_id, product_id=self.product_id
+        ).values_list('quantity', flat=True).first() or 0
+        available = max(stock[0] - stock[1], 0) + held
+        if self.quantity > available:
+            raise ValidationError(f'No hay suficiente stock. Disponible: {available}')
     
     def save(self, *args, **kwargs):
         self.clean()
-        # Limpiar cache del carrito cuando se modifica un item
-        if self.pk:  # Si ya existe
-            old_instance = CartItem.objects.get(pk=self.pk)
-            if old_instance.cart:
-                old_instance.cart.clear_cache()
-        
         super().save(*args, **kwargs)
-        
-        # Limpiar cache del carrito actual
-        if self.cart:
-            self.cart.clear_cache()
     
     def __str__(self):
         return f"{self.quantity}x {self.product.name}"
     
-    def delete(self, *args, **kwargs):
-        # Limpiar cache del carrito antes de eliminar
-        if self.cart:
-            self.cart.clear_cache()
-        super().delete(*args, **kwargs)
+    def clear_cart_cache(self):
+        """
+        Limpia el cache del carrito (el local solo si ya está cargado) y su resumen
+        compartido. Lo llaman las señales de CartItem en cada alta, cambio o baja.
+        """
+        cart = self._state.fields_cache.get('cart')
+        if cart is not None:
+            cart.clear_cache()
+        else:
+            invalidate_cart_summaries(*Cart.objects.filter(pk=self.cart_id).values_list('session_id', flat=True))
     
     class Meta:
         unique_together = ['cart', 'product']  # Un producto por carrito
@@ -312,22 +968,308 @@ class CartItem(models.Model):
         ]
 
 
-# --- Función para aplicar el descuento de la promoción ---
-def apply_discount_to_cart(subscriber, cart, promotion):
-    # Verificar si el suscriptor ya utilizó esta promoción
-    if UsedPromotion.objects.filter(subscriber=subscriber, promotion=promotion).exists():
-        raise ValidationError(f"Ya has utilizado esta promoción anteriormente.")
-    
-    # Calcular el descuento
-    discount_percentage = promotion.discount
-    cart_total = cart.total()
-    discounted_total = cart_total - (cart_total * (discount_percentage / 100))
+def cart_summary(cart):
+    """Resumen del carrito que se guarda en el cache compartido (ver web/cache.py)"""
+    total = cart.total()
+    discount = cart.subscriber.discount if cart.subscriber_id else None
+    percentage = discount.percentage if discount is not None and discount.is_active else Decimal(0)
+    return {
+        'session_id': cart.session_id,
+        'total': total,
+        'items_count': cart.get_items_count(),
+        'discount_percentage': percentage,
+        'discounted_total': cart.apply_subscriber_discount(percentage / 100),
+    }
+
+
+def get_cart_summary(session_id):
+    """
+    Resumen del carrito activo de la sesión; sin consultas si está en cache. Una sesión
+    sin carrito activo tiene un resumen vacío, que también se cachea.
+    """
+    key = cart_summary_key(session_id)
+    summary = get_cached_cart_summary(key)
+    if summary is None:
+        cart = Cart.objects.with_totals().select_related('subscriber__discount').filter(
+            session_id=session_id, is_active=True
+        ).first()
+        if cart is not None:
+            summary = cart_summary(cart)
+        else:
+            summary = {
+                'session_id': session_id, 'total': Decimal(0), 'items_count': 0,
+                'discount_percentage': Decimal(0), 'discounted_total': Decimal('0.00'),
+            }
+        set_cart_summary(key, summary, overwrite=False)
+    return summary
+
+
+class StockReservation(models.Model):
+    """Stock retenido por un carrito; Product.reserved es la suma de estas filas (ver web/reservations.py)"""
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name="reservations", verbose_name="Carrito")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="reservations", verbose_name="Producto")
+    quantity = models.PositiveIntegerField(verbose_name="Cantidad")
+    expires_at = models.DateTimeField(verbose_name="Vence")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de creación")
+
+    def __str__(self):
+        return f"{self.quantity}x {self.product_id} ({self.cart_id})"
+
+    class Meta:
+        unique_together = ['cart', 'product']
+        verbose_name = 'Reserva de stock'
+        verbose_name_plural = 'Reservas de stock'
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+
+# Rangos de las columnas que usan las sentencias del carrito: ids bigint y cantidades integer
+MAX_BIGINT = 2 ** 63 - 1
+MAX_QUANTITY = 2 ** 31 - 1
+
+
+def get_or_create_cart(session_id):
+    """
+    Retorna (carrito, creado) para la sesión con una sola sentencia
+    INSERT ... ON CONFLICT, así dos peticiones simultáneas no chocan al crearlo.
+    El carrito retornado puede estar inactivo si la sesión ya cerró su carrito.
+    """
+    table = Cart._meta.db_table
+    sql = f"""
+        INSERT INTO {table} (session_id, created_at, is_active) VALUES (%s, %s, TRUE)
+        ON CONFLICT (session_id) DO UPDATE SET session_id = EXCLUDED.session_id
+        RETURNING id, session_id, subscriber_id, created_at, is_active, (xmax = 0) AS created
+    """
+    cart = next(iter(Cart.objects.raw(sql, [session_id, timezone.now()])))
+    return cart, cart.created
+
+
+def upsert_cart_item(cart, product_id, quantity, increment=True):
+    """
+    Agrega quantity unidades del producto al carrito (o fija la cantidad si increment
+    es False) en una sola sentencia INSERT ... ON CONFLICT DO UPDATE. La cantidad
+    final se valida contra el stock en la misma sentencia, con el registro bloqueado,
+    así que clics simultáneos no pierden incrementos ni superan el stock.
+
+    Retorna (id del item, cantidad final). Lanza Product.DoesNotExist si el producto
+    no existe o no está activo y ValidationError si no hay stock suficiente.
+    """
+    return upsert_cart_items(cart, {product_id: quantity}, increment)[product_id]
+
+
+def upsert_cart_items(cart, quantities, increment=True):
+    """
+    Versión de upsert_cart_item para varios productos ({product_id: cantidad}) en una
+    sola sentencia. Retorna {product_id: (id del item, cantidad final)}. Si algún
+    producto falla lanza la misma excepción que upsert_cart_item (el ValidationError
+    lleva el producto en params['product_id']); los demás ya quedaron escritos, así que
+    debe llamarse dentro de una transacción para deshacerlos.
+    """
+    if not quantities:
+        return {}
+    item_table = CartItem._meta.db_table
+    product_table = Product._meta.db_table
+    # En bigint: la suma puede superar el rango de integer; el WHERE la descarta por superar el stock
+    new_quantity = f'{item_table}.quantity::bigint + EXCLUDED.quantity' if increment else 'EXCLUDED.quantity'
+    requested_rows = ', '.join(['(%s::bigint, %s::integer)'] * len(quantities))
+    sql = f"""
+        INSERT INTO {item_table} (cart_id, product_id, quantity, created_at)
+        SELECT %s, product.id, requested.quantity, %s
+        FROM (VALUES {requested_rows}) AS requested (product_id, quantity)
+        JOIN {product_table} product ON product.id = requested.product_id
+        WHERE product.is_active AND product.stock >= requested.quantity
+        ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {new_quantity}
+        WHERE {new_quantity} <= (SELECT stock FROM {product_table} WHERE id = EXCLUDED.product_id)
+        RETURNING product_id, id, quantity
+    """
+    params = [cart.pk, timezone.now()]
+    for product_id, quantity in quantities.items():
+        params.extend([product_id, quantity])
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = {product_id: (item_id, quantity) for product_id, item_id, quantity in cursor.fetchall()}
+    cart.clear_cache()
+    failed = [product_id for product_id in quantities if product_id not in rows]
+    if not failed:
+        return rows
+
+    # Sin fila: el producto no está disponible o la cantidad supera el stock
+    stocks = dict(Product.objects.filter(pk__in=failed, is_active=True).values_list('pk', 'stock'))
+    for product_id in failed:
+        if product_id not in stocks:
+            raise Product.DoesNotExist('Product not found')
+    product_id = failed[0]
+    raise ValidationError(
+        f'No hay suficiente stock. Disponible: {stocks[product_id]}', params={'product_id': product_id}
+    )
 
-    # Registrar que la promoción fue utilizada
-    UsedPromotion.objects.create(subscriber=subscriber, promotion=promotion, cart=cart)
 
-    # Actualizar el carrito con el nuevo precio (esto se puede usar para aplicar cambios en la base de datos)
-    return discounted_total
+def fold_cart_operations(operations):
+    """
+    Reduce una lista ordenada de operaciones ({'op': 'add' | 'set' | 'remove',
+    'product_id', 'quantity'}) al efecto final por producto, como (incrementos,
+    cantidades fijas, productos a eliminar). Aplicar ese resultado equivale a
+    aplicar las operaciones una por una. Lanza ValidationError si la suma de los
+    incrementos de un producto supera MAX_QUANTITY.
+    """
+    states = {}
+    for operation in operations:
+        product_id = operation['product_id']
+        op = operation['op']
+        if op == 'add':
+            previous = states.get(product_id)
+            if previous is None:
+                states[product_id] = ('add', operation['quantity'])
+            elif previous[0] == 'remove':
+                states[product_id] = ('set', operation['quantity'])
+            else:
+                states[product_id] = (previous[0], previous[1] + operation['quantity'])
+                if states[product_id][1] > MAX_QUANTITY:
+                    raise ValidationError(
+                        f'La cantidad no puede superar {MAX_QUANTITY}', params={'product_id': product_id}
+                    )
+        elif op == 'set':
+            states[product_id] = ('set', operation['quantity'])
+        else:
+            states[product_id] = ('remove', None)
+
+    increments, quantities, removed = {}, {}, []
+    for product_id, (op, quantity) in states.items():
+        if op == 'add':
+            increments[product_id] = quantity
+        elif op == 'set':
+            quantities[product_id] = quantity
+        else:
+            removed.append(product_id)
+    return increments, quantities, removed
+
+
+def apply_cart_operations(cart, operations):
+    """
+    Aplica al carrito una lista ordenada de operaciones (ver fold_cart_operations)
+    con a lo sumo tres sentencias, un DELETE y dos upserts, todo o nada. Lanza las
+    mismas excepciones que upsert_cart_items.
+    """
+    increments, quantities, removed = fold_cart_operations(operations)
+    with transaction.atomic():
+        if removed:
+            CartItem.objects.filter(cart=cart, product_id__in=removed).delete()
+        upsert_cart_items(cart, increments)
+        upsert_cart_items(cart, quantities, increment=False)
+    cart.clear_cache()
+
+
+def set_cart_item_quantity(cart, item_id, quantity):
+    """
+    Fija la cantidad de un item del carrito con una sola UPDATE condicionada al stock y
+    retorna el id de su producto. Lanza CartItem.DoesNotExist si el item no es del
+    carrito y ValidationError si no hay stock.
+    """
+    updated = CartItem.objects.filter(pk=item_id, cart=cart, product__stock__gte=quantity).update(quantity=quantity)
+    cart.clear_cache()
+    if updated:
+        return CartItem.objects.filter(pk=item_id).values_list('product_id', flat=True).get()
+    stock = CartItem.objects.filter(pk=item_id, cart=cart).values_list('product__stock', flat=True).first()
+    if stock is None:
+        raise CartItem.DoesNotExist('Item not found')
+    raise ValidationError(f'No hay suficiente stock. Disponible: {stock}')
+
+
+# --- Canje de promociones ---
+# Inserta el uso de la promoción con el descuento calculado sobre el total del carrito
+# (a precios efectivos) y, en la misma sentencia, el registro de auditoría del intento.
+# Si el suscriptor ya la usó, el INSERT no hace nada y se retorna el canje existente:
+# un reintento si trae la misma clave de idempotencia, un rechazo si no.
+REDEEM_PROMOTION_SQL = """
+    WITH promotion AS (
+        SELECT id, discount FROM {promotion} WHERE id = %(promotion)s AND is_active
+    ), total AS (
+        SELECT COALESCE(SUM(COALESCE(price.price, product.price) * item.quantity), 0) AS amount
+        FROM {item} item
+        JOIN {product} product ON product.id = item.product_id
+        LEFT JOIN {price} price ON price.product_id = item.product_id
+        WHERE item.cart_id = %(cart)s
+    ), redeemed AS (
+        INSERT INTO {used} (subscriber_id, promotion_id, cart_id, applied_at, cart_total, discount_amount, idempotency_key)
+        SELECT %(subscriber)s, promotion.id, %(cart)s, %(now)s, total.amount,
+               ROUND(total.amount * LEAST(GREATEST(promotion.discount, 0), 100) / 100, 2), %(key)s
+        FROM promotion, total
+        ON CONFLICT (subscriber_id, promotion_id) DO NOTHING
+        RETURNING cart_total, discount_amount
+    ), outcome AS (
+        SELECT '{redeemed_outcome}' AS outcome, cart_total, discount_amount FROM redeemed
+        UNION ALL
+        SELECT CASE WHEN used.idempotency_key = %(key)s THEN '{replayed_outcome}' ELSE '{rejected_outcome}' END,
+               used.cart_total, used.discount_amount
+        FROM {used} used
+        WHERE used.subscriber_id = %(subscriber)s AND used.promotion_id = %(promotion)s
+          AND NOT EXISTS (SELECT 1 FROM redeemed)
+    ), logged AS (
+        INSERT INTO {redemption} (subscriber_id, promotion_id, session_id, idempotency_key, outcome, cart_total,
+                                  discount_amount, created_at)
+        SELECT %(subscriber)s, %(promotion)s, %(session)s, %(key)s, outcome, cart_total,
+               CASE WHEN outcome = '{rejected_outcome}' THEN NULL ELSE discount_amount END, %(now)s
+        FROM outcome
+    )
+    SELECT outcome, cart_total, discount_amount FROM outcome
+"""
+
+
+def redeem_promotion(subscriber, cart, promotion, idempotency_key=None):
+    """
+    Canjea la promoción para el suscriptor en el carrito con una sola sentencia (sin
+    exists() previo: la restricción única resuelve los canjes simultáneos). Retorna
+    (descuento, total del carrito, reintento); reintento es True si la promoción ya
+    se había canjeado con la misma idempotency_key, y entonces se retornan los montos
+    de ese canje. Lanza ValidationError si ya se usó con otra clave o no está activa.
+    El intento queda registrado en PromotionRedemption aunque se rechace.
+    """
+    sql = REDEEM_PROMOTION_SQL.format(
+        promotion=Promotion._meta.db_table, item=CartItem._meta.db_table, product=Product._meta.db_table,
+        price=ProductPrice._meta.db_table, used=UsedPromotion._meta.db_table,
+        redemption=PromotionRedemption._meta.db_table, redeemed_outcome=PromotionRedemption.REDEEMED,
+        replayed_outcome=PromotionRedemption.REPLAYED, rejected_outcome=PromotionRedemption.REJECTED,
+    )
+    params = {
+        'subscriber': subscriber.pk, 'promotion': promotion.pk, 'cart': cart.pk, 'session': cart.session_id,
+        'key': idempotency_key or None, 'now': timezone.now(),
+    }
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is None:
+            # El canje que provocó el conflicto se confirmó después de iniciada la
+            # sentencia (no lo ve su snapshot) o la promoción no está activa
+            used = UsedPromotion.objects.filter(subscriber=subscriber, promotion=promotion).first()
+            if used is None:
+                row = (PromotionRedemption.REJECTED, None, None)
+            else:
+                replayed = idempotency_key and used.idempotency_key == idempotency_key
+                row = (
+                    PromotionRedemption.REPLAYED if replayed else PromotionRedemption.REJECTED,
+                    used.cart_total, used.discount_amount,
+                )
+            outcome, cart_total, discount_amount = row
+            PromotionRedemption.objects.create(
+                subscriber=subscriber, promotion=promotion, session_id=cart.session_id,
+                idempotency_key=idempotency_key or None, outcome=outcome, cart_total=cart_total,
+                discount_amount=discount_amount if outcome != PromotionRedemption.REJECTED else None,
+            )
+
+    outcome, cart_total, discount_amount = row
+    if outcome == PromotionRedemption.REJECTED:
+        if cart_total is None:
+            raise ValidationError("La promoción no está disponible.")
+        raise ValidationError("Ya has utilizado esta promoción anteriormente.")
+    return discount_amount, cart_total, outcome == PromotionRedemption.REPLAYED
+
+
+def apply_discount_to_cart(subscriber, cart, promotion, idempotency_key=None):
+    """Canjea la promoción (ver redeem_promotion) y retorna el total del carrito con el descuento"""
+    discount_amount, cart_total, _ = redeem_promotion(subscriber, cart, promotion, idempotency_key)
+    return cart_total - discount_amount
 
 
 # --- Modelo para descuentos de suscripción (si deseas aplicar un descuento global) ---
@@ -340,3 +1282,64 @@ class Discount(models.Model):
     
     def __str__(self):
         return self.name
+
+
+DEFAULT_DISCOUNT_NAME = "Descuento Suscriptor"
+DEFAULT_DISCOUNT_PERCENTAGE = Decimal('5.00')
+
+# (versión de descuentos, Discount) leído por este proceso
+_default_discount = None
+
+
+def get_default_discount(refresh=False):
+    """
+    Descuento que recibe todo nuevo suscriptor (se crea la primera vez). Se guarda en
+    la memoria del proceso y solo se vuelve a consultar cuando cambia la versión de
+    descuentos (cualquier Discount guardado o eliminado) o con refresh=True.
+    """
+    global _default_discount
+    version = get_discount_version()
+    if refresh or _default_discount is None or _default_discount[0] != version:
+        discount = Discount.objects.filter(name=DEFAULT_DISCOUNT_NAME).order_by('pk').first()
+        if discount is None:
+            discount = Discount.objects.create(
+                name=DEFAULT_DISCOUNT_NAME, percentage=DEFAULT_DISCOUNT_PERCENTAGE, is_active=True
+            )
+        _default_discount = (version, discount)
+    return _default_discount[1]
+
+
+def upsert_subscriber(phone, email, discount):
+    """
+    Crea el suscriptor o actualiza su email y descuento en una sola sentencia
+    INSERT ... ON CONFLICT (phone) que retorna la fila. Retorna (suscriptor, creado)
+    y lanza Discount.DoesNotExist (sin escribir nada) si el descuento ya no existe. Si el descuento
+    cambió, borra el resumen de los carritos del suscriptor (sus session_id vienen
+    en la misma sentencia).
+    """
+    table = Subscriber._meta.db_table
+    sql = f"""
+        WITH previous AS (
+            SELECT discount_id FROM {table} WHERE phone = %(phone)s
+        ), upserted AS (
+            INSERT INTO {table} (phone, email, is_active, discount_id, created_at, updated_at)
+            SELECT %(phone)s, %(email)s, TRUE, id, %(now)s, %(now)s
+            FROM {Discount._meta.db_table} WHERE id = %(discount)s
+            ON CONFLICT (phone) DO UPDATE
+            SET email = EXCLUDED.email, discount_id = EXCLUDED.discount_id, updated_at = EXCLUDED.updated_at
+            RETURNING *, (xmax = 0) AS created
+        )
+        SELECT upserted.*, CASE
+            WHEN NOT upserted.created AND upserted.discount_id IS DISTINCT FROM (SELECT discount_id FROM previous)
+            THEN ARRAY(SELECT session_id FROM {Cart._meta.db_table} WHERE subscriber_id = upserted.id)
+        END AS changed_sessions
+        FROM upserted
+    """
+    params = {'phone': phone, 'email': email, 'discount': discount.pk, 'now': timezone.now()}
+    subscriber = next(iter(Subscriber.objects.raw(sql, params)), None)
+    if subscriber is None:
+        # Sin fila: el descuento ya no existe (p. ej. el guardado en memoria se eliminó en otro proceso)
+        raise Discount.DoesNotExist('Discount not found')
+    invalidate_cart_summaries(*(subscriber.changed_sessions or []))
+    subscriber.discount = discount
+    return subscriber, subscriber.created
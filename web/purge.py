@@ -0,0 +1,91 @@
+"""
+Purga (y archivo opcional) de carritos abandonados.
+
+Se recorren los carritos purgables por orden de id en lotes de tamaño fijo, cada lote
+(id > último id del lote anterior, LIMIT tamaño) en su propia transacción, así los
+huecos en los ids no generan consultas vacías. Se borra con DELETE directos por id en
+lugar del recolector de cascadas del ORM, que cargaría cada carrito e item en memoria.
+Los carritos del lote se bloquean con SKIP LOCKED, así un carrito que se está
+modificando se salta y vuelve a evaluarse en la próxima ejecución.
+"""
+import json
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q
+
+from .cache import invalidate_cart_summaries
+from .models import Cart, CartItem, StockReservation, UsedPromotion
+from .reservations import release_cart_stock
+
+
+def purgeable_carts(cutoff):
+    """
+    Carritos creados antes de cutoff, inactivos o anónimos, sin items agregados desde
+    cutoff. Los que registran una promoción usada se conservan: borrarlos eliminaría
+    en cascada el registro que impide volver a usarla.
+    """
+    return Cart.objects.filter(
+        Q(is_active=False) | Q(subscriber__isnull=True),
+        created_at__lt=cutoff,
+    ).exclude(
+        Exists(CartItem.objects.filter(cart=OuterRef('pk'), created_at__gte=cutoff))
+    ).exclude(
+        Exists(UsedPromotion.objects.filter(cart=OuterRef('pk')))
+    )
+
+
+def archive_lines(cart_ids):
+    """Carritos con sus items como líneas JSON (una por carrito)"""
+    items = {}
+    for item in CartItem.objects.filter(cart_id__in=cart_ids).order_by('pk').values(
+        'cart_id', 'product_id', 'quantity', 'created_at'
+    ):
+        items.setdefault(item.pop('cart_id'), []).append(item)
+    for cart in Cart.objects.filter(pk__in=cart_ids).order_by('pk').values(
+        'id', 'session_id', 'subscriber_id', 'created_at', 'is_active'
+    ):
+        cart['items'] = items.get(cart['id'], [])
+        yield json.dumps(cart, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def delete_carts(cart_ids):
+    """Borra los carritos y sus items por id (devuelve antes el stock que tenían reservado)"""
+    release_cart_stock(cart_ids)
+    with connection.cursor() as cursor:
+        for model in (StockReservation, CartItem):
+            cursor.execute(f'DELETE FROM {model._meta.db_table} WHERE cart_id = ANY(%s)', [cart_ids])
+        items = cursor.rowcount
+        cursor.execute(f'DELETE FROM {Cart._meta.db_table} WHERE id = ANY(%s) RETURNING session_id', [cart_ids])
+        session_ids = [session_id for session_id, in cursor.fetchall()]
+    invalidate_cart_summaries(*session_ids)
+    return len(session_ids), items
+
+
+def purge_carts(cutoff, chunk_size, pause=0, archive=None, dry_run=False):
+    """
+    Purga los carritos de purgeable_carts(cutoff) en lotes de chunk_size carritos,
+    esperando pause segundos entre lotes. Si archive (archivo de texto) se indica,
+    escribe antes cada carrito en JSONL. Genera (último id del lote, carritos, items)
+    por cada lote.
+    """
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            cart_ids = list(
+                purgeable_carts(cutoff).filter(pk__gt=last_id).order_by('pk')
+                .select_for_update(skip_locked=True).values_list('pk', flat=True)[:chunk_size]
+            )
+            if not cart_ids:
+                return
+            last_id = cart_ids[-1]
+            if dry_run:
+                carts, items = len(cart_ids), CartItem.objects.filter(cart_id__in=cart_ids).count()
+            else:
+                if archive is not None:
+                    archive.writelines(archive_lines(cart_ids))
+                carts, items = delete_carts(cart_ids)
+        yield last_id, carts, items
+        if pause:
+            time.sleep(pause)
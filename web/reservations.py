@@ -0,0 +1,189 @@
+"""
+Reservas de stock de los carritos.
+
+Product.reserved es la suma de las filas StockReservation del producto y solo se
+modifica con UPDATE condicionales (... WHERE stock - reserved >= n) que bloquean la
+fila de cada producto afectado, nunca la tabla. Los productos se bloquean siempre por
+orden de id, así dos transacciones concurrentes no pueden interbloquearse.
+
+hold_cart_stock ajusta las reservas de un carrito a sus items con el carrito bloqueado
+(SELECT ... FOR UPDATE), y la liberación en bloque salta los carritos bloqueados
+(SKIP LOCKED), así una reserva nunca se libera mientras su carrito la está ajustando.
+Con product_ids solo se ajustan las líneas que tocó la operación: una línea sin stock
+suficiente de otro producto no deshace la operación, se informa aparte.
+Las reservas vencen a los STOCK_RESERVATION_TTL segundos sin actividad del carrito.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product, StockReservation
+
+RELEASE_BATCH_SIZE = 1000
+
+_tables = {
+    'cart': Cart._meta.db_table,
+    'item': CartItem._meta.db_table,
+    'product': Product._meta.db_table,
+    'reservation': StockReservation._meta.db_table,
+}
+
+# Diferencia entre los items del carrito (todos o solo los de %(products)s) y lo que
+# ya tiene reservado. Reserva la diferencia de los productos con stock disponible
+# (bloqueados por id), ajusta las filas de reserva y retorna los productos sin stock
+# suficiente con lo disponible.
+HOLD_SQL = """
+    WITH requested AS (
+        SELECT item.product_id, item.quantity, item.quantity - COALESCE(held.quantity, 0) AS delta
+        FROM {item} item
+        LEFT JOIN {reservation} held ON held.cart_id = item.cart_id AND held.product_id = item.product_id
+        WHERE item.cart_id = %(cart)s
+          AND (%(products)s::bigint[] IS NULL OR item.product_id = ANY(%(products)s::bigint[]))
+        UNION ALL
+        SELECT held.product_id, 0, -held.quantity
+        FROM {reservation} held
+        WHERE held.cart_id = %(cart)s
+          AND (%(products)s::bigint[] IS NULL OR held.product_id = ANY(%(products)s::bigint[]))
+          AND NOT EXISTS (
+            SELECT 1 FROM {item} item WHERE item.cart_id = held.cart_id AND item.product_id = held.product_id
+        )
+    ), locked AS (
+        SELECT product.id FROM {product} product
+        WHERE product.id IN (SELECT product_id FROM requested WHERE delta <> 0)
+        ORDER BY product.id
+        FOR UPDATE
+    ), adjusted AS (
+        UPDATE {product} product SET reserved = product.reserved + requested.delta
+        FROM requested JOIN locked ON locked.id = requested.product_id
+        WHERE product.id = requested.product_id
+          AND (requested.delta < 0 OR product.stock - product.reserved >= requested.delta)
+        RETURNING product.id
+    ), renewed AS (
+        INSERT INTO {reservation} (cart_id, product_id, quantity, expires_at, created_at)
+        SELECT %(cart)s, product_id, quantity, %(expires_at)s, %(now)s FROM requested
+        WHERE quantity > 0 AND (delta <= 0 OR product_id IN (SELECT id FROM adjusted))
+        ON CONFLICT (cart_id, product_id) DO UPDATE
+        SET quantity = EXCLUDED.quantity, expires_at = EXCLUDED.expires_at
+    ), dropped AS (
+        DELETE FROM {reservation}
+        WHERE cart_id = %(cart)s AND product_id IN (SELECT product_id FROM requested WHERE quantity = 0)
+    )
+    SELECT requested.product_id, product.stock - product.reserved
+    FROM requested JOIN {product} product ON product.id = requested.product_id
+    WHERE requested.delta > 0 AND requested.product_id NOT IN (SELECT id FROM adjusted)
+    ORDER BY requested.product_id
+""".format(**_tables)
+
+# Borra un lote de reservas (con SKIP LOCKED salta las de carritos bloqueados) y
+# descuenta sus cantidades de Product.reserved, bloqueando los productos por id
+RELEASE_SQL = """
+    WITH expired AS (
+        SELECT reservation.id FROM {reservation} reservation
+        JOIN {cart} cart ON cart.id = reservation.cart_id
+        WHERE {{condition}}
+        ORDER BY reservation.id
+        LIMIT %(limit)s
+        FOR UPDATE {{skip_locked}}
+    ), released AS (
+        DELETE FROM {reservation} WHERE id IN (SELECT id FROM expired)
+        RETURNING product_id, quantity
+    ), totals AS (
+        SELECT product_id, SUM(quantity) AS quantity FROM released GROUP BY product_id
+    ), locked AS (
+        SELECT product.id FROM {product} product
+        WHERE product.id IN (SELECT product_id FROM totals)
+        ORDER BY product.id
+        FOR UPDATE
+    )
+    UPDATE {product} product SET reserved = product.reserved - totals.quantity
+    FROM totals JOIN locked ON locked.id = totals.product_id
+    WHERE product.id = totals.product_id
+    RETURNING totals.quantity
+""".format(**_tables)
+
+
+def _hold(cart_id, now, product_ids):
+    expires_at = now + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    params = {'cart': cart_id, 'products': product_ids, 'expires_at': expires_at, 'now': now}
+    with connection.cursor() as cursor:
+        cursor.execute(HOLD_SQL, params)
+        return cursor.fetchall()
+
+
+def unheld_cart_lines(cart):
+    """Líneas del carrito sin reserva completa, como [(product_id, disponible)] por id"""
+    held = StockReservation.objects.filter(cart=cart, product=OuterRef('product_id')).values('quantity')
+    return [
+        (product_id, max(available, 0)) for product_id, available in
+        CartItem.objects.filter(cart=cart).annotate(held=Coalesce(Subquery(held), 0))
+        .filter(held__lt=F('quantity')).order_by('product_id')
+        .values_list('product_id', F('product__stock') - F('product__reserved'))
+    ]
+
+
+def hold_cart_stock(cart, product_ids=None):
+    """
+    Ajusta las reservas del carrito a las cantidades de sus items (reserva lo que
+    falta, libera lo que sobra) y renueva su vencimiento. Debe llamarse en la misma
+    transacción que modificó los items: si algún producto no tiene stock disponible
+    lanza ValidationError (con el producto en params['product_id']) para deshacerla.
+
+    Con product_ids solo se ajustan esas líneas (las que cambió la operación); las
+    demás solo renuevan su vencimiento. Retorna las otras líneas que no tienen su
+    cantidad reservada (ver unheld_cart_lines), para informarlas sin deshacer nada.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT id FROM {_tables["cart"]} WHERE id = %s FOR UPDATE', [cart.pk])
+    now = timezone.now()
+    if product_ids is not None:
+        product_ids = sorted(set(product_ids))
+    failed = _hold(cart.pk, now, product_ids)
+    if failed:
+        # Lo que falta puede estar retenido por reservas vencidas aún no liberadas
+        if release_expired_reservations(product_ids=[product_id for product_id, _ in failed], now=now):
+            failed = _hold(cart.pk, now, product_ids)
+    if failed:
+        product_id, available = failed[0]
+        raise ValidationError(
+            f'No hay suficiente stock. Disponible: {max(available, 0)}', params={'product_id': product_id}
+        )
+    if product_ids is None:
+        return []
+    StockReservation.objects.filter(cart=cart).update(
+        expires_at=now + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    )
+    return unheld_cart_lines(cart)
+
+
+def _release(condition, params, batch_size, skip_locked=True):
+    """Libera en lotes las reservas que cumplen condition; retorna las unidades liberadas"""
+    sql = RELEASE_SQL.format(condition=condition, skip_locked='SKIP LOCKED' if skip_locked else '')
+    released = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {**params, 'limit': batch_size})
+            rows = cursor.fetchall()
+        # Sin filas: no quedan reservas o (con skip_locked) las restantes son de carritos bloqueados
+        if not rows:
+            return released
+        released += sum(quantity for quantity, in rows)
+
+
+def release_expired_reservations(product_ids=None, now=None, batch_size=RELEASE_BATCH_SIZE):
+    """Libera en bloque las reservas vencidas (opcionalmente solo de product_ids)"""
+    condition = 'reservation.expires_at <= %(now)s'
+    params = {'now': now or timezone.now()}
+    if product_ids is not None:
+        condition += ' AND reservation.product_id = ANY(%(products)s)'
+        params['products'] = list(product_ids)
+    return _release(condition, params, batch_size)
+
+
+def release_cart_stock(cart_ids, batch_size=RELEASE_BATCH_SIZE):
+    """Libera todas las reservas de los carritos (antes de eliminarlos), esperando a los que estén bloqueados"""
+    return _release('reservation.cart_id = ANY(%(carts)s)', {'carts': list(cart_ids)}, batch_size, skip_locked=False)
@@ -0,0 +1,120 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connections
+from django.db.models import Case, CharField, F, FloatField, IntegerField, Q, Value, When
+from django.db.models.functions import Cast, Coalesce
+
+from .models import LOW_STOCK_LIMIT
+
+
+def search_products(queryset, term):
+    """
+    Filtra y ordena por relevancia un queryset de productos.
+
+    Combina el full-text sobre Product.search_vector (nombre, SKU, categorías y
+    descripción) con similitud trigram sobre nombre y SKU para tolerar errores de
+    escritura. Ambos filtros usan los índices GIN de Product.
+    """
+    term = term.strip()
+    if not term:
+        return queryset
+
+    query = SearchQuery(term, config=settings.SEARCH_CONFIG, search_type='websearch')
+    return queryset.filter(
+        Q(search_vector=query)
+        | Q(name__trigram_similar=term)
+        | Q(sku__trigram_similar=term)
+    ).annotate(
+        # double precision: el cursor guarda el valor como texto y un real no vuelve exacto desde su texto
+        search_rank=Cast(
+            Coalesce(SearchRank(F('search_vector'), query), Value(0.0), output_field=FloatField())
+            + TrigramSimilarity('name', term),
+            FloatField(),
+        )
+    ).order_by('-search_rank', 'pk')
+
+
+# --- Facetas ---
+
+# Bits de GROUPING(category_id, subcategory_id, facet_stock, facet_price) de cada conjunto
+_CATEGORY_SET, _SUBCATEGORY_SET, _STOCK_SET, _PRICE_SET, _TOTAL_SET = 0b0111, 0b0011, 0b1101, 0b1110, 0b1111
+
+
+def _stock_case():
+    return Case(
+        When(stock=0, then=Value('Sin stock')),
+        When(stock__lte=LOW_STOCK_LIMIT, then=Value('Stock bajo')),
+        default=Value('En stock'),
+        output_field=CharField(),
+    )
+
+
+def _price_case(boundaries):
+    return Case(
+        *[When(price__lt=upper, then=Value(index)) for index, upper in enumerate(boundaries[1:])],
+        default=Value(len(boundaries) - 1),
+        output_field=IntegerField(),
+    )
+
+
+def product_facets(queryset):
+    """
+    Conteos de productos por categoría, subcategoría, estado de stock y rango de
+    precio del queryset filtrado, calculados en una sola consulta con GROUPING SETS.
+    """
+    boundaries = settings.PRICE_FACET_BOUNDARIES
+    source = queryset.order_by().annotate(
+        facet_category_slug=F('category__slug'),
+        facet_category_name=F('category__name'),
+        facet_subcategory_slug=F('subcategory__slug'),
+        facet_subcategory_name=F('subcategory__name'),
+        facet_stock=_stock_case(),
+        facet_price=_price_case(boundaries),
+    ).values(
+        'category_id', 'facet_category_slug', 'facet_category_name',
+        'subcategory_id', 'facet_subcategory_slug', 'facet_subcategory_name',
+        'facet_stock', 'facet_price',
+    )
+    source_sql, params = source.query.sql_with_params()
+    sql = f"""
+        SELECT GROUPING(category_id, subcategory_id, facet_stock, facet_price),
+               category_id, facet_category_slug, facet_category_name,
+               subcategory_id, facet_subcategory_slug, facet_subcategory_name,
+               facet_stock, facet_price, COUNT(*)
+        FROM ({source_sql}) AS facet_source
+        GROUP BY GROUPING SETS (
+            (category_id, facet_category_slug, facet_category_name),
+            (subcategory_id, facet_subcategory_slug, facet_subcategory_name, category_id),
+            (facet_stock),
+            (facet_price),
+            ()
+        )
+    """
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    facets = {'total': 0, 'categories': [], 'subcategories': [], 'stock_status': [], 'price_ranges': []}
+    for (grouping, category_id, category_slug, category_name, subcategory_id,
+         subcategory_slug, subcategory_name, stock, price_index, count) in rows:
+        if grouping == _TOTAL_SET:
+            facets['total'] = count
+        elif grouping == _CATEGORY_SET:
+            facets['categories'].append(
+                {'id': category_id, 'slug': category_slug, 'name': category_name, 'count': count}
+            )
+        elif grouping == _SUBCATEGORY_SET and subcategory_id is not None:
+            facets['subcategories'].append({
+                'id': subcategory_id, 'slug': subcategory_slug, 'name': subcategory_name,
+                'category': category_id, 'count': count,
+            })
+        elif grouping == _STOCK_SET:
+            facets['stock_status'].append({'value': stock, 'count': count})
+        elif grouping == _PRICE_SET:
+            upper = boundaries[price_index + 1] if price_index + 1 < len(boundaries) else None
+            facets['price_ranges'].append({'min': boundaries[price_index], 'max': upper, 'count': count})
+
+    for key in ('categories', 'subcategories'):
+        facets[key].sort(key=lambda facet: facet['name'])
+    facets['price_ranges'].sort(key=lambda facet: facet['min'])
+    return facets
@@ -0,0 +1,256 @@
+from django.db import connections, transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_migrate
+from django.dispatch import receiver
+
+from .cache import (
+    bump_cart_pricing_version, bump_catalog_version, bump_discount_version, invalidate_cart_summaries, invalidate_tags,
+)
+from .models import (
+    Category, Subcategory, Product, ProductImage, Promotion, PriceRule, Subscriber, Cart, CartItem, Discount,
+    LIST_FIELDS, SEARCH_FIELDS, log_catalog_changes, pricing_changed, products_changed, refresh_main_images,
+    refresh_product_documents, refresh_product_prices, refresh_products_count, refresh_search_vectors,
+)
+from .reservations import release_cart_stock
+
+
+# --- Contadores de productos por categoría y subcategoría ---
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, raw=False, **kwargs):
+    """Actualiza los contadores si el producto cambió de categoría, subcategoría o estado"""
+    if raw:
+        return
+
+    old_state = getattr(instance, '_counter_state', None)
+    new_state = instance.counter_state()
+    instance._counter_state = new_state
+    if not created and old_state == new_state:
+        return
+
+    category_ids = {new_state[0]}
+    subcategory_ids = {new_state[1]}
+    if old_state is not None:
+        category_ids.add(old_state[0])
+        subcategory_ids.add(old_state[1])
+    refresh_products_count(category_ids, subcategory_ids)
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    """Descuenta el producto eliminado (también en borrados en cascada)"""
+    refresh_products_count({instance.category_id}, {instance.subcategory_id})
+
+
+# --- Búsqueda de productos ---
+
+
+@receiver(pre_migrate)
+def create_search_extensions(sender, using, **kwargs):
+    """Instala pg_trgm antes de crear los índices trigram de Product"""
+    connection = connections[using]
+    if sender.name == 'web' and connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+
+@receiver(post_save, sender=Product)
+def product_search_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Recalcula el vector de búsqueda del producto guardado"""
+    if raw or (update_fields is not None and not SEARCH_FIELDS.intersection(update_fields)):
+        return
+    refresh_search_vectors([instance.pk])
+
+
+@receiver(post_save, sender=Category)
+def category_search_saved(sender, instance, raw=False, **kwargs):
+    """El nombre de la categoría forma parte del vector de sus productos"""
+    if not raw:
+        refresh_search_vectors(category_ids=[instance.pk])
+
+
+@receiver(post_save, sender=Subcategory)
+def subcategory_search_saved(sender, instance, raw=False, **kwargs):
+    """El nombre de la subcategoría forma parte del vector de sus productos"""
+    if not raw:
+        refresh_search_vectors(subcategory_ids=[instance.pk])
+
+
+# --- Imagen principal desnormalizada ---
+
+
+@receiver(post_delete, sender=ProductImage)
+def product_image_deleted(sender, instance, origin=None, **kwargs):
+    """Elige otra imagen principal si se eliminó la actual (también en borrados masivos)"""
+    # En la cascada de un producto (o de su categoría) el producto también se elimina:
+    # recalcularlo volvería a insertar el documento que la cascada ya borró
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if origin is None or origin_model is ProductImage:
+        refresh_main_images([instance.product_id])
+
+
+# --- Precios efectivos ---
+# Antes que los documentos: el receptor de Product recalcula el precio que el
+# documento del producto incluye.
+
+
+@receiver(post_save, sender=Product)
+def product_price_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw and (created or 'price' in instance.changed_fields()):
+        refresh_product_prices([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=PriceRule)
+def price_rule_changed(sender, instance, raw=False, **kwargs):
+    # Al confirmar: si la regla se borró en cascada con su producto, ya no hay precio que recalcular
+    if not raw:
+        product_id = instance.product_id
+        transaction.on_commit(lambda: pricing_changed(refresh_product_prices([product_id])))
+
+
+@receiver(post_save, sender=Promotion)
+def promotion_pricing_saved(sender, instance, raw=False, **kwargs):
+    """El descuento y el estado de la promoción se aplican a los productos de sus reglas"""
+    if not raw:
+        pricing_changed(refresh_product_prices(promotion_ids=[instance.pk]))
+
+
+# --- Documentos JSON precalculados ---
+# Los cambios de imágenes llegan por refresh_main_images, que actualiza Product con
+# ProductQuerySet.update y por tanto regenera el documento del producto.
+
+
+@receiver(post_save, sender=Product)
+def product_document_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        refresh_product_documents([instance.pk])
+
+
+@receiver(post_save, sender=Category)
+def category_document_saved(sender, instance, raw=False, **kwargs):
+    """Los documentos incluyen el slug de la categoría"""
+    if not raw:
+        refresh_product_documents(category_ids=[instance.pk])
+
+
+@receiver(post_save, sender=Subcategory)
+def subcategory_document_saved(sender, instance, raw=False, **kwargs):
+    """Los documentos incluyen el slug de la subcategoría"""
+    if not raw:
+        refresh_product_documents(subcategory_ids=[instance.pk])
+
+
+# --- Registro de cambios para la sincronización incremental ---
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Subcategory)
+def catalog_object_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        log_catalog_changes(sender, [instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Subcategory)
+def catalog_object_deleted(sender, instance, **kwargs):
+    """Deja una baja (tombstone) para que los clientes eliminen su copia"""
+    log_catalog_changes(sender, [instance.pk], deleted=True)
+
+
+# --- Versión del catálogo y cache de respuestas ---
+
+
+@receiver([post_save, post_delete], sender=Promotion)
+def catalog_changed(sender, **kwargs):
+    """Invalida las entradas cacheadas del catálogo"""
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Product)
+def product_cache_saved(sender, instance, created, raw=False, **kwargs):
+    """Invalida las respuestas del producto, y los listados si pudo cambiar su contenido u orden"""
+    if raw:
+        return
+    list_changed = created or bool(LIST_FIELDS.intersection(instance.changed_fields()))
+    products_changed([instance.pk], list_changed=list_changed)
+
+
+@receiver(post_delete, sender=Product)
+def product_cache_deleted(sender, instance, **kwargs):
+    products_changed([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_cache_changed(sender, instance, **kwargs):
+    bump_catalog_version()
+    invalidate_tags(f'category:{instance.pk}', 'category-list')
+
+
+@receiver([post_save, post_delete], sender=Subcategory)
+def subcategory_cache_changed(sender, instance, **kwargs):
+    # Las categorías anidan sus subcategorías: la actual y, si se movió, la anterior
+    category_ids = {instance.category_id, getattr(instance, '_loaded_category_id', None)}
+    instance._loaded_category_id = instance.category_id
+    bump_catalog_version()
+    invalidate_tags(
+        f'subcategory:{instance.pk}', 'category-list',
+        *[f'category:{category_id}' for category_id in category_ids if category_id is not None]
+    )
+
+
+# --- Reservas de stock ---
+
+
+@receiver(pre_delete, sender=Cart)
+def cart_deleting(sender, instance, **kwargs):
+    """Devuelve el stock reservado antes de que la cascada borre las reservas del carrito"""
+    release_cart_stock([instance.pk])
+
+
+# --- Resumen compartido de carritos ---
+
+
+@receiver(post_save, sender=Product)
+def product_pricing_saved(sender, instance, created, raw=False, **kwargs):
+    """Un cambio de precio cambia el total de todos los carritos con el producto"""
+    if not raw and not created and 'price' in instance.changed_fields():
+        bump_cart_pricing_version()
+
+
+@receiver(post_delete, sender=Product)
+@receiver([post_save, post_delete], sender=Discount)
+def cart_pricing_changed(sender, **kwargs):
+    bump_cart_pricing_version()
+
+
+@receiver([post_save, post_delete], sender=Discount)
+def discount_changed(sender, **kwargs):
+    """El descuento por defecto guardado en memoria de cada proceso se vuelve a leer"""
+    bump_discount_version()
+
+
+@receiver(post_save, sender=Subscriber)
+def subscriber_carts_changed(sender, instance, created, raw=False, **kwargs):
+    """El descuento del suscriptor se aplica al total con descuento de sus carritos"""
+    if not raw and not created:
+        invalidate_cart_summaries(*instance.carts.values_list('session_id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Cart)
+def cart_changed(sender, instance, raw=False, **kwargs):
+    """Estado, suscriptor o baja del carrito desde cualquier origen (admin, vistas, shell)"""
+    if not raw:
+        invalidate_cart_summaries(instance.session_id)
+
+
+@receiver([post_save, post_delete], sender=CartItem)
+def cart_item_changed(sender, instance, raw=False, origin=None, **kwargs):
+    # En las cascadas (carrito, suscriptor, producto) la señal del origen ya invalida los resúmenes
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if not raw and (origin is None or origin_model is CartItem):
+        instance.clear_cart_cache()
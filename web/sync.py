@@ -0,0 +1,130 @@
+"""
+Sincronización incremental del catálogo a partir del registro CatalogChange.
+
+Los ids se asignan al insertar pero los registros se ven al confirmar la transacción,
+así que un id bajo puede aparecer después de uno alto. Por eso los registros se
+ordenan por (txid, id) y solo se entregan los de transacciones anteriores al xmin
+del snapshot de la consulta (la transacción más antigua aún en curso): esas ya
+terminaron, y cualquier registro que se confirme después tendrá un txid mayor o
+igual a ese xmin. El token es la posición "txid-id" del último registro entregado,
+así que no depende de cuánto tarden en confirmar las transacciones del catálogo.
+
+prune_catalog_changes borra los registros con más de CATALOG_CHANGES_RETENTION_DAYS
+días y convierte el último borrado en un registro PRUNED: un token anterior a esa
+posición puede haber perdido cambios y lanza SyncTokenExpired (410 en la API).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import Category, Subcategory, Product, ProductImage, CatalogChange
+
+# Modelos del registro por kind (model_name)
+SYNC_MODELS = {model._meta.model_name: model for model in (Product, ProductImage, Category, Subcategory)}
+
+# Transacción más antigua aún en curso según el snapshot de la sentencia
+SNAPSHOT_XMIN_SQL = 'pg_snapshot_xmin(pg_current_snapshot())::text::bigint'
+
+
+class SyncTokenExpired(Exception):
+    """El token es anterior a los registros purgados: el cliente debe sincronizar todo de nuevo"""
+
+
+def encode_token(txid, change_id):
+    return f'{txid}-{change_id}'
+
+
+def decode_token(token):
+    """(txid, id) del token; lanza ValueError si no tiene la forma txid-id"""
+    txid, separator, change_id = token.partition('-')
+    if not separator:
+        raise ValueError(token)
+    return int(txid), int(change_id)
+
+
+def _after(txid, change_id):
+    """Registros posteriores a la posición (txid, change_id)"""
+    return Q(txid__gt=txid) | Q(txid=txid, id__gt=change_id)
+
+
+def _visible_changes():
+    return CatalogChange.objects.filter(txid__lt=RawSQL(SNAPSHOT_XMIN_SQL, []))
+
+
+def current_changes_token():
+    """Token desde el que un cliente recién sincronizado por completo debe pedir cambios"""
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {SNAPSHOT_XMIN_SQL}')
+        xmin, = cursor.fetchone()
+    # Todo lo anterior a xmin ya es visible para la descarga completa que sigue
+    return encode_token(xmin, 0)
+
+
+def changes_since(since, limit=None):
+    """
+    Cambios posteriores al token since, como (next_token, has_more, changes) donde
+    changes es {kind: (ids modificados, ids eliminados)}. De cada objeto cuenta solo
+    su último registro, y un objeto modificado que ya no existe se reporta eliminado.
+    Lanza ValueError si el token no es válido y SyncTokenExpired si es anterior a
+    los registros purgados.
+    """
+    limit = limit or settings.CATALOG_CHANGES_PAGE_SIZE
+    if since.isdigit():
+        # Token anterior al orden por transacción (solo el id): no indica qué falta
+        raise SyncTokenExpired(since)
+    position = decode_token(since)
+    pruned = CatalogChange.objects.filter(kind=CatalogChange.PRUNED).values_list('txid', 'id').first()
+    if pruned is not None and position < pruned:
+        raise SyncTokenExpired(since)
+
+    entries = list(
+        _visible_changes().filter(_after(*position)).exclude(kind=CatalogChange.PRUNED).order_by('txid', 'id')
+        .values_list('txid', 'id', 'kind', 'object_id', 'deleted')[:limit + 1]
+    )
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    latest = {}
+    for _, _, kind, object_id, deleted in entries:
+        latest[kind, object_id] = deleted
+
+    changes = {kind: (set(), set()) for kind in SYNC_MODELS}
+    for (kind, object_id), deleted in latest.items():
+        if kind in changes:
+            changes[kind][1 if deleted else 0].add(object_id)
+
+    for kind, (updated, deleted) in changes.items():
+        if updated:
+            existing = set(SYNC_MODELS[kind].objects.filter(pk__in=updated).values_list('pk', flat=True))
+            deleted.update(updated - existing)
+            updated.intersection_update(existing)
+
+    next_token = encode_token(*entries[-1][:2]) if entries else since
+    return next_token, has_more, changes
+
+
+def prune_catalog_changes(days=None):
+    """
+    Borra los registros entregables con más de days días (por defecto
+    CATALOG_CHANGES_RETENTION_DAYS). El último de ellos queda como registro PRUNED,
+    que marca desde qué posición los tokens siguen siendo válidos. Retorna la
+    cantidad de registros borrados.
+    """
+    days = settings.CATALOG_CHANGES_RETENTION_DAYS if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    with transaction.atomic():
+        boundary = _visible_changes().filter(created_at__lt=cutoff).order_by('-txid', '-id').values_list(
+            'txid', 'id'
+        ).first()
+        if boundary is None:
+            return 0
+        txid, change_id = boundary
+        deleted, _ = CatalogChange.objects.filter(
+            Q(txid__lt=txid) | Q(txid=txid, id__lt=change_id)
+        ).delete()
+        CatalogChange.objects.filter(pk=change_id).update(kind=CatalogChange.PRUNED, object_id=0, deleted=False)
+    return deleted
@@ -1,3 +1,868 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import threading
+from base64 import urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from web import models
+from web.api.mixins import catalog_validators
+from web.api.rendering import product_rows, render_json, render_product_rows
+from web.api.serializers import ProductSerializer, SubscriberSerializer
+from web.models import (
+    CatalogChange, Category, Subcategory, Product, ProductDocument, ProductImage, Promotion, PriceRule,
+    PromotionRedemption, Subscriber, Cart, CartItem, StockReservation, UsedPromotion, get_or_create_cart, redeem_promotion,
+    get_cart_summary, get_default_discount, upsert_cart_item, Discount, DEFAULT_DISCOUNT_PERCENTAGE, MAX_BIGINT,
+    MAX_QUANTITY,
+)
+from web.cache import cart_summary_key, set_cart_summary
+from web.checks import check_shared_cache
+from web.export import accepts_gzip
+from web.purge import purge_carts, purgeable_carts
+from web.reservations import hold_cart_stock, release_expired_reservations
+from web.sync import prune_catalog_changes
+
+
+class ProductFastPathTests(TestCase):
+    """La ruta rápida de los listados debe producir exactamente los mismos bytes que ProductSerializer"""
+
+    @classmethod
+    def setUpTestData(cls):
+        electronics = Category.objects.create(name='Electrónica')
+        clothes = Category.objects.create(name='Ropa')
+        laptops = Subcategory.objects.create(name='Laptops', category=electronics)
+        products = [
+            Product.objects.create(
+                name='Laptop Ñandú 14"', sku='LAP-1', price=Decimal('15999.90'), stock=3,
+                description='Pantalla 14" con acentos: áéíóú', category=electronics, subcategory=laptops,
+                is_featured=True,
+            ),
+            Product.objects.create(name='Camisa', price=Decimal('0.10'), stock=0, category=clothes),
+            Product.objects.create(
+                name='Mouse', sku='MOU-1', price=Decimal('250'), stock=40, description='',
+                category=electronics, is_featured=True,
+            ),
+        ]
+        for i in range(25):
+            products.append(Product.objects.create(
+                name=f'Producto {i:02}', sku=f'P-{i}', price=Decimal(i) + Decimal('0.99'), stock=i,
+                category=clothes, is_featured=i % 3 == 0,
+            ))
+        ProductImage.objects.create(product=products[0], image='products/frente.jpg', order=1)
+        ProductImage.objects.create(product=products[0], image='products/lado izquierdo.jpg', order=0, is_main=True)
+        ProductImage.objects.create(product=products[2], image='products/mouse.png', order=0)
+        # Los precios efectivos se recalculan al confirmar la transacción
+        with cls.captureOnCommitCallbacks(execute=True):
+            PriceRule.objects.create(product=products[2], percentage=Decimal('15'))
+            promotion = Promotion.objects.create(name='Liquidación', discount=Decimal('33.33'))
+            for product in products[5:9]:
+                PriceRule.objects.create(product=product, promotion=promotion)
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def get_both(self, url):
+        """Respuesta de la ruta rápida y la del serializer para la misma URL"""
+        cache.clear()
+        fast = self.client.get(url)
+        cache.clear()
+        with override_settings(PRODUCT_FAST_RENDERING=False):
+            slow = self.client.get(url)
+        self.assertEqual(fast.status_code, 200)
+        self.assertEqual(slow.status_code, 200)
+        return fast, slow
+
+    def test_rows_match_serializer(self):
+        queryset = Product.objects.filter(is_active=True).order_by('name')
+        expected = JSONRenderer().render(
+            ProductSerializer(queryset.prefetch_related('images'), many=True, context={'compact': True}).data
+        )
+        self.assertEqual(render_json(render_product_rows(product_rows(queryset))), expected)
+
+    def test_endpoints_match_serializer(self):
+        urls = [
+            '/api/products/',
+            '/api/products/?ordering=-price',
+            '/api/products/?ordering=created_at&count=false',
+            '/api/products/?category=ropa&min_price=3',
+            '/api/products/?search=laptop',
+            '/api/products/?page=2',
+            '/api/products/featured/',
+            '/api/products/on_sale/',
+            '/api/products/new_arrivals/?page=2',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                fast, slow = self.get_both(url)
+                self.assertEqual(fast.content, slow.content)
+                self.assertEqual(fast['Content-Type'], slow['Content-Type'])
+
+    def test_cursor_pages_match_serializer(self):
+        url = '/api/products/?ordering=-price'
+        while url:
+            fast, slow = self.get_both(url)
+            self.assertEqual(fast.content, slow.content)
+            url = fast.json()['next']
+
+    def test_cursor_filter_bounds_the_index_scan(self):
+        cache.clear()
+        next_url = self.client.get('/api/products/?ordering=price').json()['next']
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(next_url)
+        # La página se filtra con la cota sobre el campo ordenado, sin OFFSET
+        page_queries = [query['sql'] for query in queries if '"web_product"."price" >=' in query['sql']]
+        self.assertEqual(len(page_queries), 1)
+        self.assertIn('LIMIT', page_queries[0])
+        self.assertNotIn('OFFSET', page_queries[0])
+
+    def test_tampered_cursors_are_rejected(self):
+        cursors = [
+            ('price', {'v': 'barato', 'pk': 1}),
+            ('-created_at', {'v': 'ayer', 'pk': 1}),
+            ('-created_at', {'v': ['2024-01-01'], 'pk': 1}),
+            ('name', {'v': None, 'pk': 1}),
+        ]
+        for ordering, token in cursors:
+            with self.subTest(ordering=ordering, token=token):
+                cache.clear()
+                cursor = urlsafe_b64encode(json.dumps(token).encode('utf-8')).decode('ascii')
+                response = self.client.get(f'/api/products/?ordering={ordering}&cursor={cursor}')
+                self.assertEqual(response.status_code, 404)
+
+    def test_search_cursors_reach_all_results(self):
+        url, ids = '/api/products/?search=producto', []
+        for _ in range(5):
+            fast, slow = self.get_both(url)
+            self.assertEqual(fast.content, slow.content)
+            ids += [product['id'] for product in fast.json()['results']]
+            url = fast.json()['next']
+            if url is None:
+                break
+        self.assertIsNone(url)
+        self.assertEqual(len(ids), fast.json()['count'])
+        self.assertEqual(len(set(ids)), 25)
+
+    def test_detail_matches_serializer(self):
+        for product in Product.objects.all()[:3]:
+            with self.subTest(product=product.slug):
+                fast, slow = self.get_both(f'/api/products/{product.slug}/')
+                self.assertEqual(fast.content, slow.content)
+
+    def test_documents_follow_changes(self):
+        product = Product.objects.get(sku='MOU-1')
+        category = product.category
+        category.slug = 'tecnologia'
+        category.save()
+        ProductImage.objects.create(product=product, image='products/mouse-2.png', order=1, is_main=True)
+        Product.objects.filter(pk=product.pk).update(stock=2)
+        for url in ['/api/products/?category=tecnologia', f'/api/products/{product.slug}/']:
+            with self.subTest(url=url):
+                fast, slow = self.get_both(url)
+                self.assertEqual(fast.content, slow.content)
+                self.assertIn(b'mouse-2.png', fast.content)
+
+    def test_expanded_category_is_prefetched(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as compact:
+            self.client.get('/api/products/?fields=id,category')
+        cache.clear()
+        with CaptureQueriesContext(connection) as expanded:
+            response = self.client.get('/api/products/?expand=category')
+        subcategories = {
+            subcategory['slug'] for product in response.json()['results']
+            for subcategory in product['category']['subcategories']
+        }
+        self.assertEqual(subcategories, {'laptops'})
+        # Solo la consulta de las subcategorías, no una por producto
+        self.assertEqual(len(expanded), len(compact) + 1)
+
+    def test_sparse_fields_use_serializer(self):
+        cache.clear()
+        response = self.client.get('/api/products/?fields=id,name')
+        self.assertEqual(set(response.json()['results'][0]), {'id', 'name'})
+
+
+class ProductCounterTests(TestCase):
+    """Guardar una categoría o subcategoría cargada antes de un cambio no pisa sus contadores"""
+
+    def test_stale_instances_keep_counters(self):
+        category = Category.objects.create(name='Electrónica')
+        subcategory = Subcategory.objects.create(name='Laptops', category=category)
+        Product.objects.create(name='Laptop', price=Decimal('10'), stock=1, category=category, subcategory=subcategory)
+
+        category.name = 'Tecnología'
+        category.save()
+        subcategory.save()
+
+        category.refresh_from_db()
+        subcategory.refresh_from_db()
+        self.assertEqual((category.name, category.products_count), ('Tecnología', 1))
+        self.assertEqual(subcategory.products_count, 1)
+
+
+class ConditionalGetTests(TestCase):
+    """El ETag sigue los cambios y las bajas del catálogo aunque la versión en cache no cambie"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.category = Category.objects.create(name='Electrónica')
+        self.promotion = Promotion.objects.create(name='Liquidación', discount=Decimal('10'))
+
+    def test_changes_without_cache_bump_change_etag(self):
+        # En TestCase los on_commit no se ejecutan: la versión en cache no cambia
+        subcategory = Subcategory.objects.create(name='Laptops', category=self.category)
+        changes = [
+            lambda: Category.objects.filter(pk=self.category.pk).update(name='Tecnología', updated_at=timezone.now()),
+            # Las bajas se detectan por su registro en CatalogChange
+            lambda: Subcategory.objects.filter(pk=subcategory.pk).delete(),
+            lambda: Promotion.objects.filter(pk=self.promotion.pk).update(is_active=False, updated_at=timezone.now()),
+        ]
+        for url, change in zip(['/api/categories/', '/api/categories/tree/', '/api/promotions/'], changes):
+            with self.subTest(url=url):
+                etag = self.client.get(url)['ETag']
+                change()
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_cache_hit_skips_database(self):
+        cache.clear()
+        first = self.client.get('/api/categories/')
+        with CaptureQueriesContext(connection) as queries:
+            hit = self.client.get('/api/categories/')
+            not_modified = self.client.get('/api/categories/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(len(queries), 0)
+        self.assertEqual((hit['X-Cache'], hit['ETag'], hit.content), ('HIT', first['ETag'], first.content))
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_validators_use_index_lookups(self):
+        with CaptureQueriesContext(connection) as queries:
+            catalog_validators()
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('COUNT', queries[0]['sql'].upper())
+
+
+class ProductExportTests(TestCase):
+    """La exportación NDJSON se transmite en streaming y se comprime solo si el cliente acepta gzip"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Electrónica')
+        cls.products = [
+            Product.objects.create(name=f'Producto {i}', price=Decimal('10'), stock=i, category=category)
+            for i in range(5)
+        ]
+        Product.objects.create(name='Inactivo', price=Decimal('10'), stock=1, category=category, is_active=False)
+
+    def export(self, accept_encoding):
+        response = self.client.get('/api/products/export/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        return response, b''.join(response.streaming_content)
+
+    def assertLines(self, content):
+        lines = [json.loads(line) for line in content.decode('utf-8').splitlines()]
+        self.assertEqual([line['id'] for line in lines], [product.pk for product in self.products])
+
+    def test_gzip_export(self):
+        response, content = self.export('br;q=1.0, gzip;q=0.8')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertLines(gzip.decompress(content))
+
+    def test_refused_gzip_is_not_used(self):
+        for accept_encoding in ['gzip;q=0', 'identity', '', '*;q=0']:
+            with self.subTest(accept_encoding=accept_encoding):
+                response, content = self.export(accept_encoding)
+                self.assertFalse(response.has_header('Content-Encoding'))
+                self.assertLines(content)
+
+    def test_accepts_gzip(self):
+        self.assertTrue(accepts_gzip('gzip, deflate'))
+        self.assertTrue(accepts_gzip('*'))
+        self.assertFalse(accepts_gzip('gzip;q=0, *'))
+        self.assertFalse(accepts_gzip('deflate'))
+
+
+class ProductFacetsTests(TestCase):
+    """Los conteos de las facetas (GROUPING SETS) coinciden con los listados filtrados"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.electronics = Category.objects.create(name='Electrónica')
+        clothes = Category.objects.create(name='Ropa')
+        cls.laptops = Subcategory.objects.create(name='Laptops', category=cls.electronics)
+        Product.objects.create(name='Laptop', price=Decimal('1500'), stock=3, category=cls.electronics, subcategory=cls.laptops)
+        Product.objects.create(name='Mouse', price=Decimal('50'), stock=0, category=cls.electronics)
+        Product.objects.create(name='Camisa', price=Decimal('20'), stock=40, category=clothes)
+        Product.objects.create(name='Inactiva', price=Decimal('10'), stock=1, category=clothes, is_active=False)
+
+    def facets(self, query=''):
+        cache.clear()
+        response = self.client.get(f'/api/products/facets/{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_counts(self):
+        facets = self.facets()
+        self.assertEqual(facets['total'], 3)
+        self.assertEqual(
+            [(facet['name'], facet['count']) for facet in facets['categories']], [('Electrónica', 2), ('Ropa', 1)]
+        )
+        self.assertEqual(
+            [(facet['id'], facet['category'], facet['count']) for facet in facets['subcategories']],
+            [(self.laptops.pk, self.electronics.pk, 1)],
+        )
+        self.assertEqual(
+            {facet['value']: facet['count'] for facet in facets['stock_status']},
+            {'Sin stock': 1, 'Stock bajo': 1, 'En stock': 1},
+        )
+        self.assertEqual(
+            [(facet['min'], facet['max'], facet['count']) for facet in facets['price_ranges']],
+            [(0, 100, 2), (1000, 5000, 1)],
+        )
+
+    def test_filtered_counts_match_listing(self):
+        for query in [f'?category={self.electronics.slug}', '?max_price=100', '?search=laptop']:
+            with self.subTest(query=query):
+                cache.clear()
+                listing = self.client.get(f'/api/products/{query}').json()
+                self.assertEqual(self.facets(query)['total'], listing['count'])
+
+
+class ProductBatchLookupTests(TestCase):
+    """/api/products/batch/ respeta el orden pedido y reporta las claves sin producto activo"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Electrónica')
+        cls.mouse = Product.objects.create(name='Mouse', price=Decimal('10'), stock=1, category=category)
+        cls.keyboard = Product.objects.create(name='Teclado', price=Decimal('20'), stock=1, category=category)
+        cls.inactive = Product.objects.create(name='Viejo', price=Decimal('5'), stock=1, category=category, is_active=False)
+
+    def batch(self, query):
+        cache.clear()
+        return self.client.get(f'/api/products/batch/?{query}')
+
+    def test_lookup_by_ids_and_slugs(self):
+        cases = [
+            (f'ids={self.keyboard.pk},{self.mouse.pk},{self.inactive.pk},{self.keyboard.pk}',
+             [self.keyboard.pk, self.mouse.pk], [self.inactive.pk]),
+            (f'slugs={self.mouse.slug},no-existe', [self.mouse.pk], ['no-existe']),
+        ]
+        for fast in (True, False):
+            for query, found, missing in cases:
+                with self.subTest(query=query, fast=fast), override_settings(PRODUCT_FAST_RENDERING=fast):
+                    data = self.batch(query).json()
+                    self.assertEqual([product['id'] for product in data['results']], found)
+                    self.assertEqual(data['missing'], missing)
+
+    def test_invalid_requests(self):
+        queries = ['', f'ids=1&slugs={self.mouse.slug}', 'ids=uno', f'ids={MAX_BIGINT + 1}', 'ids=0']
+        for query in queries:
+            with self.subTest(query=query):
+                self.assertEqual(self.batch(query).status_code, 400)
+        with override_settings(PRODUCT_BATCH_MAX_SIZE=2):
+            self.assertEqual(self.batch('ids=1,2,3').status_code, 400)
+
+
+class CatalogDeletionTests(TestCase):
+    """Borrar productos con imágenes (directamente o en cascada) no regenera sus documentos"""
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Electrónica')
+        self.product = Product.objects.create(
+            name='Mouse', sku='MOU-1', price=Decimal('10'), stock=5, category=self.category
+        )
+        ProductImage.objects.create(product=self.product, image='products/mouse.png', order=0, is_main=True)
+        ProductImage.objects.create(product=self.product, image='products/mouse-2.png', order=1)
+
+    def assertDeleted(self):
+        # Las FK se validan al confirmar: se fuerza la verificación dentro de la prueba
+        connection.check_constraints()
+        self.assertFalse(Product.objects.filter(pk=self.product.pk).exists())
+        self.assertFalse(ProductDocument.objects.filter(product_id=self.product.pk).exists())
+
+    def test_delete_product_with_images(self):
+        self.product.delete()
+        self.assertDeleted()
+
+    def test_delete_category_with_products(self):
+        self.category.delete()
+        self.assertDeleted()
+
+    def test_delete_image_refreshes_main_image(self):
+        self.product.images.get(is_main=True).delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.main_image.image.name, 'products/mouse-2.png')
+        self.assertIn(b'mouse-2.png', self.product.document.content.encode())
+
+
+class ConcurrentTestCase(TransactionTestCase):
+    """Ejecuta una función desde varios hilos, cada uno con su conexión"""
+    workers = 8
+
+    def run_concurrently(self, func, times):
+        def task(index):
+            try:
+                return func(index)
+            except ValidationError:
+                return None
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(task, range(times)))
+
+
+class CartUpsertConcurrencyTests(ConcurrentTestCase):
+    """Los upserts del carrito no pierden incrementos ni superan el stock con peticiones simultáneas"""
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Electrónica')
+
+    def test_concurrent_adds_are_not_lost(self):
+        product = Product.objects.create(
+            name='Mouse', sku='MOU-1', price=Decimal('10'), stock=1000, category=self.category
+        )
+        cart, _ = get_or_create_cart('concurrent-session')
+
+        results = self.run_concurrently(lambda _: upsert_cart_item(cart, product.pk, 2), 40)
+
+        self.assertTrue(all(results))
+        self.assertEqual(CartItem.objects.get(cart=cart, product=product).quantity, 80)
+
+    def test_concurrent_adds_respect_stock(self):
+        product = Product.objects.create(
+            name='Teclado', sku='TEC-1', price=Decimal('10'), stock=15, category=self.category
+        )
+        cart, _ = get_or_create_cart('stock-session')
+
+        results = self.run_concurrently(lambda _: upsert_cart_item(cart, product.pk, 1), 40)
+
+        self.assertEqual(sum(result is not None for result in results), 15)
+        self.assertEqual(CartItem.objects.get(cart=cart, product=product).quantity, 15)
+
+    def test_concurrent_cart_creation(self):
+        results = self.run_concurrently(lambda _: get_or_create_cart('same-session'), 20)
+
+        self.assertEqual(len({cart.pk for cart, _ in results}), 1)
+        self.assertEqual(sum(created for _, created in results), 1)
+
+
+class CartBatchTests(TestCase):
+    """Las operaciones inválidas de /api/carts/batch/ responden 400 sin modificar el carrito"""
+
+    def setUp(self):
+        self.client = APIClient()
+        category = Category.objects.create(name='Electrónica')
+        self.product = Product.objects.create(name='Mouse', sku='MOU-1', price=Decimal('10'), stock=10, category=category)
+        self.cart, _ = get_or_create_cart('batch-session')
+        self.item_id, _ = upsert_cart_item(self.cart, self.product.pk, 1)
+
+    def batch(self, *operations):
+        return self.client.post(
+            '/api/carts/batch/', {'session_id': 'batch-session', 'operations': list(operations)}, format='json'
+        )
+
+    def assertCartUnchanged(self):
+        self.assertEqual(list(self.cart.items.values_list('product_id', 'quantity')), [(self.product.pk, 1)])
+
+    def test_applies_operations_in_order(self):
+        response = self.batch(
+            {'op': 'add', 'product_id': self.product.pk, 'quantity': 2},
+            {'op': 'set', 'item_id': self.item_id, 'quantity': 5},
+            {'op': 'add', 'product_id': self.product.pk},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.cart.items.get().quantity, 6)
+
+    def test_out_of_range_values_are_rejected(self):
+        operations = [
+            {'op': 'add', 'product_id': MAX_BIGINT + 1},
+            {'op': 'remove', 'item_id': MAX_BIGINT + 1},
+            {'op': 'set', 'product_id': self.product.pk, 'quantity': MAX_QUANTITY + 1},
+        ]
+        for operation in operations:
+            with self.subTest(operation=operation):
+                self.assertEqual(self.batch(operation).status_code, 400)
+        self.assertCartUnchanged()
+
+    def test_add_item_rejects_out_of_range_values(self):
+        for data in [{'product_id': MAX_BIGINT + 1}, {'product_id': self.product.pk, 'quantity': MAX_QUANTITY + 1}]:
+            with self.subTest(data=data):
+                response = self.client.post('/api/carts/add-item/', {'session_id': 'batch-session', **data}, format='json')
+                self.assertEqual(response.status_code, 400)
+                self.assertNotIn('out of range', response.content.decode())
+        self.assertCartUnchanged()
+
+    def test_add_rejects_item_id(self):
+        response = self.batch({'op': 'add', 'product_id': self.product.pk, 'item_id': self.item_id})
+        self.assertEqual(response.status_code, 400)
+        self.assertCartUnchanged()
+
+    def test_folded_quantity_overflow_is_rejected(self):
+        response = self.batch(
+            {'op': 'add', 'product_id': self.product.pk, 'quantity': MAX_QUANTITY},
+            {'op': 'add', 'product_id': self.product.pk, 'quantity': 1},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['product_id'], self.product.pk)
+        self.assertCartUnchanged()
+
+    def test_increment_past_integer_range_is_rejected_by_stock(self):
+        # El item ya tiene 1: la suma en la base de datos supera el rango de integer
+        Product.objects.filter(pk=self.product.pk).update(stock=MAX_QUANTITY)
+        response = self.batch({'op': 'add', 'product_id': self.product.pk, 'quantity': MAX_QUANTITY})
+        self.assertEqual(response.status_code, 400)
+        self.assertCartUnchanged()
+
+
+class SharedCacheCheckTests(TestCase):
+    """Fuera de DEBUG la cache por proceso es un error de configuración"""
+
+    def test_locmem_cache_is_rejected(self):
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=locmem, DEBUG=False):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['web.E001'])
+        with override_settings(CACHES=locmem, DEBUG=True):
+            self.assertEqual(check_shared_cache(None), [])
+        with override_settings(DEBUG=False):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class SubscriberListTests(TestCase):
+    """with_cart_stats anota carritos y el carrito activo sin consultas por suscriptor"""
+
+    def setUp(self):
+        category = Category.objects.create(name='Electrónica')
+        mouse = Product.objects.create(name='Mouse', price=Decimal('10'), stock=10, category=category)
+        keyboard = Product.objects.create(name='Teclado', price=Decimal('20'), stock=10, category=category)
+        with self.captureOnCommitCallbacks(execute=True):
+            PriceRule.objects.create(product=mouse, percentage=Decimal('50'))
+
+        self.buyer = Subscriber.objects.create(phone='0991111111', email='comprador@example.com')
+        Cart.objects.create(session_id='closed', subscriber=self.buyer, is_active=False)
+        self.active_cart = Cart.objects.create(session_id='open', subscriber=self.buyer)
+        Cart.objects.create(session_id='second', subscriber=self.buyer)
+        upsert_cart_item(self.active_cart, mouse.pk, 2)
+        upsert_cart_item(self.active_cart, keyboard.pk, 1)
+        self.idle = Subscriber.objects.create(phone='0992222222', email='nuevo@example.com')
+
+    def test_cart_stats(self):
+        queryset = Subscriber.objects.select_related('discount').with_cart_stats().order_by('pk')
+        with self.assertNumQueries(2):
+            data = SubscriberSerializer(queryset, many=True).data
+
+        buyer, idle = data
+        self.assertEqual(buyer['total_carts'], 3)
+        self.assertEqual(
+            (buyer['active_cart']['id'], buyer['active_cart']['total'], buyer['active_cart']['items_count']),
+            (self.active_cart.pk, Decimal('30.00'), 2),
+        )
+        self.assertEqual((idle['total_carts'], idle['active_cart']), (0, None))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DefaultDiscountTests(TestCase):
+    """El descuento por defecto se guarda en memoria del proceso hasta que cambia un Discount"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(setattr, models, '_default_discount', None)
+        self.discount = get_default_discount(refresh=True)
+
+    def test_cached_in_process(self):
+        self.assertEqual(self.discount.percentage, DEFAULT_DISCOUNT_PERCENTAGE)
+        with self.assertNumQueries(0):
+            self.assertIs(get_default_discount(), self.discount)
+
+    def test_changes_invalidate(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.discount.percentage = Decimal('10')
+            self.discount.save()
+        self.assertEqual(get_default_discount().percentage, Decimal('10'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.discount.delete()
+        recreated = get_default_discount()
+        self.assertNotEqual(recreated.pk, self.discount.pk)
+        self.assertEqual(recreated.percentage, DEFAULT_DISCOUNT_PERCENTAGE)
+
+    def test_subscribe_rereads_deleted_discount(self):
+        # Otro proceso borró el descuento y la versión aún no cambió en este
+        with self.captureOnCommitCallbacks(execute=False):
+            Discount.objects.filter(pk=self.discount.pk).delete()
+        response = APIClient().post(
+            '/api/subscribers/subscribe/', {'phone': '0993333333', 'email': 'nuevo@example.com'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        discount = Subscriber.objects.get(phone='0993333333').discount
+        self.assertNotEqual(discount.pk, self.discount.pk)
+        self.assertEqual(discount.percentage, DEFAULT_DISCOUNT_PERCENTAGE)
+
+
+class CartSummaryCacheTests(TestCase):
+    """Una lectura anterior a una modificación confirmada no repone un resumen viejo"""
+
+    def test_read_before_commit_does_not_restore_stale_summary(self):
+        category = Category.objects.create(name='Electrónica')
+        product = Product.objects.create(name='Mouse', sku='MOU-1', price=Decimal('10'), stock=10, category=category)
+        cart, _ = get_or_create_cart('summary-session')
+        upsert_cart_item(cart, product.pk, 1)
+        stale = get_cart_summary('summary-session')
+
+        # La lectura obtiene su clave, la modificación se confirma y luego la lectura escribe
+        key = cart_summary_key('summary-session')
+        with self.captureOnCommitCallbacks(execute=True):
+            upsert_cart_item(cart, product.pk, 2)
+        set_cart_summary(key, stale, overwrite=False)
+
+        self.assertEqual(get_cart_summary('summary-session')['total'], Decimal('30'))
+
+
+class StockReservationTests(TestCase):
+    """Una operación reserva solo las líneas que tocó; las demás sin stock se informan aparte"""
+
+    def test_unrelated_line_without_stock_does_not_fail_operation(self):
+        category = Category.objects.create(name='Electrónica')
+        mouse = Product.objects.create(name='Mouse', sku='MOU-1', price=Decimal('10'), stock=5, category=category)
+        keyboard = Product.objects.create(name='Teclado', sku='TEC-1', price=Decimal('20'), stock=5, category=category)
+        client = APIClient()
+        client.post('/api/carts/add-item/', {'product_id': mouse.pk, 'quantity': 2, 'session_id': 'hold-session'}, format='json')
+
+        # La reserva del mouse vence y otro comprador se lleva el stock
+        StockReservation.objects.update(expires_at=timezone.now())
+        release_expired_reservations()
+        Product.objects.filter(pk=mouse.pk).update(stock=1)
+
+        response = client.post(
+            '/api/carts/add-item/', {'product_id': keyboard.pk, 'quantity': 1, 'session_id': 'hold-session'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['unavailable_items'], [{'product_id': mouse.pk, 'available': 1}])
+        self.assertEqual(
+            dict(StockReservation.objects.values_list('product_id', 'quantity')), {keyboard.pk: 1}
+        )
+
+
+class CartPurgeTests(TestCase):
+    """Purga de carritos abandonados: selección, archivo JSONL y devolución del stock reservado"""
+
+    def setUp(self):
+        category = Category.objects.create(name='Electrónica')
+        self.product = Product.objects.create(name='Mouse', sku='MOU-1', price=Decimal('10'), stock=10, category=category)
+        self.cutoff = timezone.now() - timedelta(days=30)
+        old = self.cutoff - timedelta(days=1)
+        subscriber = Subscriber.objects.create(phone='0999999999', email='cliente@example.com')
+
+        self.abandoned = self.cart('abandoned', quantity=2)
+        self.inactive = self.cart('inactive', subscriber=subscriber, is_active=False)
+        self.kept = [
+            self.cart('subscriber', subscriber=subscriber),
+            self.cart('recent-item', quantity=1),
+            self.cart('promotion'),
+        ]
+        recent = self.cart('recent')
+        UsedPromotion.objects.create(
+            subscriber=subscriber, promotion=Promotion.objects.create(name='Promo', discount=Decimal('5')),
+            cart=self.kept[2],
+        )
+        Cart.objects.exclude(pk=recent.pk).update(created_at=old)
+        CartItem.objects.exclude(cart=self.kept[1]).update(created_at=old)
+
+    def cart(self, session_id, quantity=0, **fields):
+        cart = Cart.objects.create(session_id=session_id, **fields)
+        if quantity:
+            upsert_cart_item(cart, self.product.pk, quantity)
+            hold_cart_stock(cart)
+        return cart
+
+    def test_purgeable_carts(self):
+        self.assertEqual(
+            set(purgeable_carts(self.cutoff).values_list('pk', flat=True)), {self.abandoned.pk, self.inactive.pk}
+        )
+
+    def test_purge_archives_and_releases_stock(self):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, 3)
+        archive = io.StringIO()
+
+        results = list(purge_carts(self.cutoff, chunk_size=1, archive=archive))
+
+        self.assertEqual(results, [(self.abandoned.pk, 1, 1), (self.inactive.pk, 1, 0)])
+        lines = [json.loads(line) for line in archive.getvalue().splitlines()]
+        self.assertEqual([line['session_id'] for line in lines], ['abandoned', 'inactive'])
+        self.assertEqual([(item['product_id'], item['quantity']) for item in lines[0]['items']], [(self.product.pk, 2)])
+        self.assertFalse(Cart.objects.filter(pk__in=[self.abandoned.pk, self.inactive.pk]).exists())
+        self.assertEqual(Cart.objects.count(), 4)
+        # Solo queda la reserva del carrito conservado
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, 1)
+        self.assertFalse(StockReservation.objects.filter(cart=self.abandoned).exists())
+
+    def test_dry_run_keeps_carts(self):
+        results = list(purge_carts(self.cutoff, chunk_size=10, dry_run=True))
+        self.assertEqual(results, [(self.inactive.pk, 2, 1)])
+        self.assertEqual(Cart.objects.count(), 6)
+
+
+class StockReservationConcurrencyTests(ConcurrentTestCase):
+    """Carritos simultáneos no reservan más stock del disponible y las reservas vencidas se liberan"""
+
+    def reserve(self, product, index):
+        with transaction.atomic():
+            cart, _ = get_or_create_cart(f'session-{index}')
+            upsert_cart_item(cart, product.pk, 1)
+            hold_cart_stock(cart)
+        return cart
+
+    def test_concurrent_reservations_respect_stock(self):
+        category = Category.objects.create(name='Electrónica')
+        product = Product.objects.create(name='Mouse', sku='MOU-1', price=Decimal('10'), stock=15, category=category)
+
+        results = self.run_concurrently(lambda index: self.reserve(product, index), 40)
+
+        product.refresh_from_db()
+        self.assertEqual(sum(result is not None for result in results), 15)
+        self.assertEqual(product.reserved, 15)
+        self.assertEqual(StockReservation.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'], 15)
+
+        StockReservation.objects.update(expires_at=timezone.now())
+        self.assertEqual(release_expired_reservations(), 15)
+        product.refresh_from_db()
+        self.assertEqual(product.reserved, 0)
+        self.assertFalse(StockReservation.objects.exists())
+
+
+class PromotionRedemptionConcurrencyTests(ConcurrentTestCase):
+    """Canjes simultáneos de la misma promoción: uno solo se aplica y todos quedan auditados"""
+
+    def setUp(self):
+        category = Category.objects.create(name='Electrónica')
+        product = Product.objects.create(name='Mouse', sku='MOU-1', price=Decimal('80'), stock=10, category=category)
+        self.subscriber = Subscriber.objects.create(phone='0999999999', email='cliente@example.com')
+        self.promotion = Promotion.objects.create(name='Black Friday', discount=Decimal('25'))
+        self.cart, _ = get_or_create_cart('promo-session')
+        upsert_cart_item(self.cart, product.pk, 2)
+
+    def redeem(self, key):
+        return redeem_promotion(self.subscriber, self.cart, self.promotion, key)
+
+    def test_concurrent_redemptions_apply_once(self):
+        results = self.run_concurrently(lambda index: self.redeem(f'key-{index}'), 40)
+
+        self.assertEqual([result for result in results if result is not None], [(Decimal('40.00'), Decimal('160.00'), False)])
+        self.assertEqual(UsedPromotion.objects.get().discount_amount, Decimal('40.00'))
+        outcomes = list(PromotionRedemption.objects.values_list('outcome', flat=True))
+        self.assertEqual(outcomes.count(PromotionRedemption.REDEEMED), 1)
+        self.assertEqual(outcomes.count(PromotionRedemption.REJECTED), 39)
+
+    def test_concurrent_retries_replay_redemption(self):
+        results = self.run_concurrently(lambda _: self.redeem('same-key'), 40)
+
+        self.assertEqual({result[:2] for result in results}, {(Decimal('40.00'), Decimal('160.00'))})
+        self.assertEqual(sum(not replayed for _, _, replayed in results), 1)
+        self.assertEqual(UsedPromotion.objects.count(), 1)
+        self.assertEqual(
+            PromotionRedemption.objects.filter(outcome=PromotionRedemption.REPLAYED).count(), 39
+        )
+
+
+class CatalogSyncTests(TransactionTestCase):
+    """Los tokens de sincronización no saltan cambios de transacciones largas y expiran con la purga"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.category = Category.objects.create(name='Electrónica')
+
+    def changes(self, token):
+        response = self.client.get(f'/api/products/changes/?since={token}')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return data['next_since'], {product['name'] for product in data['products']}
+
+    def test_long_transaction_changes_are_not_skipped(self):
+        token = self.client.get('/api/products/changes/').json()['next_since']
+        started, release = threading.Event(), threading.Event()
+
+        def long_transaction():
+            try:
+                with transaction.atomic():
+                    Product.objects.create(name='Lento', price=Decimal('1'), stock=1, category=self.category)
+                    started.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=long_transaction)
+        thread.start()
+        started.wait(10)
+        other = Category.objects.create(name='Ropa')
+        Product.objects.create(name='Rápido', price=Decimal('1'), stock=1, category=other)
+
+        # Mientras la transacción larga sigue abierta no se entrega nada posterior a ella
+        token, names = self.changes(token)
+        self.assertEqual(names, set())
+        release.set()
+        thread.join()
+
+        token, names = self.changes(token)
+        self.assertEqual(names, {'Lento', 'Rápido'})
+
+    @override_settings(CATALOG_CHANGES_PAGE_SIZE=2)
+    def test_pages_and_deletions(self):
+        token = self.client.get('/api/products/changes/').json()['next_since']
+        products = [
+            Product.objects.create(name=name, price=Decimal('1'), stock=1, category=self.category)
+            for name in ('Uno', 'Dos', 'Tres')
+        ]
+        products[1].delete()
+
+        names, deleted, pages, has_more = set(), set(), 0, True
+        while has_more:
+            data = self.client.get(f'/api/products/changes/?since={token}').json()
+            token, has_more, pages = data['next_since'], data['has_more'], pages + 1
+            names.update(product['name'] for product in data['products'])
+            deleted.update(data['deleted']['products'])
+
+        self.assertGreater(pages, 1)
+        self.assertEqual(names, {'Uno', 'Tres'})
+        self.assertEqual(deleted, {products[1].pk})
+        self.assertEqual(self.client.get('/api/products/changes/?since=abc').status_code, 400)
+
+    def test_repeated_pruning_keeps_one_boundary(self):
+        self.assertEqual(prune_catalog_changes(days=30), 0)
+        for name in ('Uno', 'Dos'):
+            Product.objects.create(name=name, price=Decimal('1'), stock=1, category=self.category)
+            CatalogChange.objects.exclude(kind=CatalogChange.PRUNED).update(created_at=timezone.now() - timedelta(days=60))
+            prune_catalog_changes(days=30)
+        token = self.client.get('/api/products/changes/').json()['next_since']
+
+        self.assertEqual(CatalogChange.objects.filter(kind=CatalogChange.PRUNED).count(), 1)
+        self.assertEqual(self.changes(token), (token, set()))
+
+    def test_pruned_tokens_expire(self):
+        token = self.client.get('/api/products/changes/').json()['next_since']
+        Product.objects.create(name='Viejo', price=Decimal('1'), stock=1, category=self.category)
+        CatalogChange.objects.update(created_at=timezone.now() - timedelta(days=60))
+        Product.objects.create(name='Nuevo', price=Decimal('1'), stock=1, category=self.category)
+        current = self.client.get('/api/products/changes/').json()['next_since']
+
+        self.assertGreater(prune_catalog_changes(days=30), 0)
+
+        self.assertEqual(self.client.get(f'/api/products/changes/?since={token}').status_code, 410)
+        self.assertEqual(self.client.get('/api/products/changes/?since=15').status_code, 410)
+        self.assertEqual(self.changes(current), (current, set()))
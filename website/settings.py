@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.humanize',
+    'django.contrib.postgres',
     'rest_framework',
     'corsheaders',
     'web'
@@ -164,3 +165,60 @@ REST_FRAMEWORK = {
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True  # Solo para desarrollo
 CORS_ALLOW_CREDENTIALS = True
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Las versiones del catálogo, de las respuestas y de los resúmenes de carrito deben
+# compartirse entre procesos: por defecto la cache vive en PostgreSQL (crear la tabla
+# con `python manage.py createcachetable`); Redis o Memcached también sirven.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': config('CACHE_LOCATION', default='ram_system_cache'),
+    }
+}
+
+# Tiempo de vida de los datos del catálogo en cache (las claves se versionan al cambiar el catálogo)
+CATALOG_CACHE_TIMEOUT = config('CATALOG_CACHE_TIMEOUT', cast=int, default=60 * 60)
+
+# Búsqueda de productos (configuración de texto de PostgreSQL para el full-text)
+SEARCH_CONFIG = config('SEARCH_CONFIG', default='spanish')
+
+# Listas materializadas de productos (destacados, en oferta, novedades)
+PRODUCT_LISTS_MAX_SIZE = config('PRODUCT_LISTS_MAX_SIZE', cast=int, default=100)
+PRODUCT_LISTS_TIMEOUT = config('PRODUCT_LISTS_TIMEOUT', cast=int, default=15 * 60)
+NEW_ARRIVALS_DAYS = config('NEW_ARRIVALS_DAYS', cast=int, default=30)
+
+# Cache de respuestas GET anónimas del catálogo (invalidadas por etiquetas)
+RESPONSE_CACHE_TIMEOUT = config('RESPONSE_CACHE_TIMEOUT', cast=int, default=5 * 60)
+
+# Límites de los rangos de precio de las facetas de búsqueda (el último rango queda abierto)
+PRICE_FACET_BOUNDARIES = [
+    int(value) for value in config('PRICE_FACET_BOUNDARIES', default='0,100,500,1000,5000').split(',')
+]
+
+# Listados de productos sin serializer (values() + JSON directo); False fuerza ProductSerializer
+PRODUCT_FAST_RENDERING = config('PRODUCT_FAST_RENDERING', cast=bool, default=True)
+
+# Sincronización incremental (/api/products/changes/): días que se conservan los cambios
+# (ver prune_catalog_changes; tokens más viejos reciben 410) y registros por respuesta
+CATALOG_CHANGES_RETENTION_DAYS = config('CATALOG_CHANGES_RETENTION_DAYS', cast=int, default=30)
+CATALOG_CHANGES_PAGE_SIZE = config('CATALOG_CHANGES_PAGE_SIZE', cast=int, default=500)
+
+# Exportación NDJSON del catálogo: filas leídas por viaje del cursor del servidor
+PRODUCT_EXPORT_CHUNK_SIZE = config('PRODUCT_EXPORT_CHUNK_SIZE', cast=int, default=2000)
+
+# Consulta de varios productos por ids o slugs (/api/products/batch/): máximo por petición
+PRODUCT_BATCH_MAX_SIZE = config('PRODUCT_BATCH_MAX_SIZE', cast=int, default=50)
+
+# Operaciones por petición en /api/carts/batch/
+CART_BATCH_MAX_OPERATIONS = config('CART_BATCH_MAX_OPERATIONS', cast=int, default=100)
+
+# Reservas de stock de los carritos: segundos sin actividad del carrito hasta que vencen
+STOCK_RESERVATION_TTL = config('STOCK_RESERVATION_TTL', cast=int, default=30 * 60)
+
+# Días que se conservan los carritos inactivos o anónimos sin actividad (comando purge_carts)
+CART_RETENTION_DAYS = config('CART_RETENTION_DAYS', cast=int, default=30)
+
+# Resumen compartido de carritos (total, items, total con descuento) en cache, en segundos
+CART_SUMMARY_TIMEOUT = config('CART_SUMMARY_TIMEOUT', cast=int, default=10 * 60)